@@ -0,0 +1,220 @@
+from typing import Optional, Dict, Any, Tuple, Set, List, AsyncIterator
+from contextlib import asynccontextmanager
+import asyncio
+import logging
+import os
+import signal
+import time
+
+from collector import record
+from collector import speedtest
+from collector import watch
+from collector.scheduler import DeadlineQueue, sync_queue
+from collector.state import StateStore
+from utils import config_watch
+import config
+
+_l = logging.getLogger(__name__)
+
+"""
+asyncio engine for the collector
+--------------------------------
+
+Selected with `config.collector_engine = 'asyncio'`; `exec.main` hands over to `main` here. It does
+what the threaded engine in `exec` does, on the event loop's thread, except for appending results
+(below) and compacting them (see `compaction`, which `exec.main` starts either way):
+
+* Scheduling: a `DeadlineQueue`, with the loop sleeping until the next deadline or until something
+  changes.
+* Tests: `speedtest` runs through `asyncio.create_subprocess_exec`; concurrency is capped with a
+  semaphore instead of a thread pool.
+* Interface checks: the netlink socket is watched with `add_reader` (or `if_nameindex` is polled).
+* Config watching: the inotify descriptor of `utils.config_watch` is watched with `add_reader` (or
+  the config file is `stat`ed on a timer), and the config is reloaded on the loop, so coroutines
+  never see it change under them.
+* Results: appended on the loop's default executor. An append can block for a while (a `.json`
+  file is rewritten in full, the first one builds the rollups, and any may wait for a compaction to
+  let go of the results file), and the loop has to keep running tests meanwhile.
+"""
+
+
+class _Uplink:
+    """Same as `exec._Uplink`, for coroutines."""
+
+    def __init__(self) -> None:
+        self._run_lock = asyncio.Lock()
+        self._next_start = 0.0
+
+    @asynccontextmanager
+    async def slot(self, serialize: bool, stagger_sec: float) -> AsyncIterator[None]:
+        if serialize:
+            await self._run_lock.acquire()
+        try:
+            now = time.time()
+            start = max(now, self._next_start)
+            self._next_start = start + stagger_sec
+            if start > now:
+                _l.debug(f'Staggering test by {start - now:.1f} seconds.')
+                await asyncio.sleep(start - now)
+            yield
+        finally:
+            if serialize:
+                self._run_lock.release()
+
+
+async def _run(interface: Optional[str], nickname: Optional[str]) -> Dict[str, Any]:
+    result = record.new_result(interface, nickname)
+    try:
+        for a in range(config.n_attempts):
+            run = await speedtest.run_speedtest_async(interface=interface)
+            if record.add_attempt(result, run, a):
+                return result
+        raise RuntimeError(f'Failed to run after {config.n_attempts} tries.')
+    except Exception as e:
+        record.add_exception(result, e)
+        return result
+
+
+class _Engine:
+    def __init__(self) -> None:
+        self.queue = DeadlineQueue()
+        self.state = StateStore(os.path.abspath(config.state_file))
+        self.targets: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+        self.missing: Set[str] = set()  # interfaces that weren't in the system when last due.
+        self.in_flight: Dict[str, asyncio.Task] = {}
+        self.uplinks: Dict[Tuple[str, ...], _Uplink] = {}
+        self.slots = asyncio.Semaphore(config.max_concurrent_tests)
+        self.changed = asyncio.Event()
+        self.replan = False
+
+    def wake(self, replan: bool = True) -> None:
+        """Makes the main loop look at the queue again; with `replan`, after reloading config."""
+        self.replan = self.replan or replan
+        self.changed.set()
+
+    def log_queue(self) -> None:
+        now = time.time()
+        queue = ', '.join(f'"{key}" in {(due - now) / 60:.1f} min'
+                          for due, key in self.queue.snapshot())
+        _l.info(f'Test queue: {queue or "(empty)"}.')
+
+    def plan(self) -> None:
+        """Brings the queue in line with the configured interfaces."""
+        config.refresh()
+        self.targets = record.targets()
+        sync_queue(self.queue, self.targets.keys(), self.in_flight.keys(), self.missing,
+                   watch.interface_names(), lambda name: self.state.get(name).next_due)
+        self.log_queue()
+
+    async def _record(self, interface: Optional[str], nickname: Optional[str]) -> Dict[str, Any]:
+        group = None if interface is None else record.uplink_group(interface)
+        async with self.slots:
+            if group is None:
+                _l.info(record.describe(interface, nickname))
+                result = await _run(interface, nickname)
+            else:
+                uplink = self.uplinks.setdefault(group, _Uplink())
+                async with uplink.slot(config.serialize_shared_uplinks,
+                                       config.uplink_stagger_sec):
+                    _l.info(record.describe(interface, nickname))
+                    result = await _run(interface, nickname)
+        await asyncio.get_running_loop().run_in_executor(None, record.append_result, result)
+        return result
+
+    async def _test(self, name: str, interface: Optional[str], nickname: Optional[str]) -> None:
+        try:
+            return_code = (await self._record(interface, nickname))['returnCode']
+        except Exception as e:
+            _l.error('Test task failed.')
+            _l.exception(e)
+            return_code = -1
+        finally:
+            del self.in_flight[name]
+        interval_min = self.state.update(name, return_code)
+        _l.info(f'Will test again on "{name}" in {interval_min:.1f} minutes...')
+        if name in self.targets:
+            self.queue.schedule(name, time.time() + interval_min * 60)
+            self.wake(replan=False)
+
+    def _launch(self, name: str) -> None:
+        if name not in self.targets:
+            return
+        interface, nickname = self.targets[name]
+        if interface is not None and nickname is not None \
+                and not record.interface_exists(interface, nickname):
+            self.missing.add(name)
+            self.queue.schedule(name, time.time() + config.test_interval_min * 60)
+            return
+        self.in_flight[name] = asyncio.create_task(self._test(name, interface, nickname),
+                                                   name=f'test {name}')
+
+    async def _poll_interfaces(self) -> None:
+        names = watch.interface_names()
+        while True:
+            await asyncio.sleep(watch.interface_poll_sec)
+            new_names = watch.interface_names()
+            if new_names != names:
+                names = new_names
+                self.wake()
+
+    async def _poll_config(self) -> None:
+        while True:
+            await asyncio.sleep(watch.config_poll_sec)
+            config.refresh()
+
+    def _on_config_change(self, options: Set[str]) -> None:
+        if options & watch.plan_options:
+            self.wake()
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGUSR1, self.log_queue)
+        watchers: List[asyncio.Task] = []
+        # Not `watch.watch_config`, which reloads the config from another thread.
+        config_watch.subscribe(self._on_config_change)
+        config_fd = config_watch.open_watch(config.__file__)
+        if config_fd is not None:
+            os.set_blocking(config_fd, False)
+
+            def on_config_fd() -> None:
+                assert config_fd is not None
+                if config_watch.read_watch(config_fd, config.__file__):
+                    try:
+                        config.refresh()
+                    except Exception as e:
+                        _l.error(f'Failed to handle config file change: {e!r}')
+            loop.add_reader(config_fd, on_config_fd)
+        else:
+            watchers.append(asyncio.create_task(self._poll_config(), name='poll config'))
+        netlink = watch.open_netlink()
+        if netlink is not None:
+            netlink.setblocking(False)
+
+            def on_netlink() -> None:
+                assert netlink is not None
+                netlink.recv(65536)  # We don't care what changed, just that something did.
+                self.wake()
+            loop.add_reader(netlink, on_netlink)
+        else:
+            watchers.append(asyncio.create_task(self._poll_interfaces(), name='poll interfaces'))
+
+        self.plan()
+        while True:
+            self.changed.clear()
+            if self.replan:
+                self.replan = False
+                self.plan()
+            for name in self.queue.pop_due(time.time()):
+                self._launch(name)
+            nxt = self.queue.peek()
+            timeout = None if nxt is None else max(0.0, nxt[0] - time.time())
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def main() -> None:
+    """Runs the collector until cancelled."""
+    _l.info('Using the asyncio engine.')
+    await _Engine().run()
@@ -0,0 +1,67 @@
+from typing import Dict, Optional
+import logging
+import os
+import threading
+import time
+
+from utils import results_store
+from utils.timing import TimeIt
+import config
+
+_l = logging.getLogger(__name__)
+
+"""
+Applying `config.retention_days` to the results file: a daemon thread that compacts it (see
+`results_store.compact`) at startup and every `config.compaction_interval_hrs`, alongside the tests.
+"""
+
+_day_sec = 24 * 60 * 60
+
+
+def retention_starts(now: float) -> Dict[str, Optional[float]]:
+    """
+    The oldest time (seconds since the epoch) to keep at each resolution of `config.retention_days`,
+    rounded down to the start of a UTC day, so the results and rollups that remain start on a whole
+    bucket of every level that the dashboard combines them at.
+    """
+    return {level: None if days is None else (now - days * _day_sec) // _day_sec * _day_sec
+            for level, days in config.retention_days.items()}
+
+
+def _policy() -> str:
+    """Describes `config.retention_days`, or returns an empty string if it keeps everything."""
+    kept = [f'{level} for {days:g} days' for level, days in config.retention_days.items()
+            if days is not None]
+    return ', '.join(kept)
+
+
+def compact() -> None:
+    """Drops the history of `config.results_db` that's older than `config.retention_days`."""
+    filename = os.path.abspath(config.results_db)
+    policy = _policy()
+    if not policy:
+        return
+    _l.info(f'Compacting "{filename}": keeping {policy}, the rest forever.')
+    with TimeIt(f'Compaction of "{filename}"', log=_l):
+        dropped = results_store.compact(filename, retention_starts(time.time()))
+    if any(dropped.values()):
+        n_records = sum(n for level, n in dropped.items() if level != 'raw')
+        _l.info(f'Dropped {dropped.get("raw", 0):,} old results and {n_records:,} old rollup '
+                f'records.')
+
+
+def _run() -> None:
+    while True:
+        try:
+            compact()
+        except Exception as e:
+            _l.error('Failed to compact the results.')
+            _l.exception(e)
+        time.sleep(config.compaction_interval_hrs * 60 * 60)
+
+
+def start() -> None:
+    """Starts the daemon thread."""
+    if not _policy():
+        _l.info('Keeping all history; set `config.retention_days` to drop old results.')
+    threading.Thread(target=_run, daemon=True, name='compaction').start()
@@ -1,13 +1,22 @@
-from typing import List, Optional, Dict, Any
+from typing import Optional, Dict, Any, Tuple, Iterator, Set
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+import asyncio
+import functools
 import logging
 import os
+import signal
 import time
-import json
-from datetime import datetime
-import socket
+import threading
 
 from utils import log
+from utils import results_store
+from collector import compaction
+from collector import record
 from collector import speedtest
+from collector import watch
+from collector.scheduler import Scheduler, sync_queue
+from collector.state import StateStore
 import config
 
 
@@ -19,144 +28,154 @@ log.configure_logging(log_to_file=config.log_file)
 _l = logging.getLogger(__name__)
 
 
-def _isotime() -> str:
-    return datetime.utcnow().isoformat()[:-4]+'Z'
-
-
 def _run(interface: Optional[str], nickname: Optional[str]) -> Dict[str, Any]:
-    result: Dict[str, Any] = {}
-
-    result['timestamp'] = _isotime()
-    if interface is None:
-        result['interface'] = 'none'
-    else:
-        result['interface'] = interface
-
-    if interface is not None and nickname is None:
-        result['nickname'] = interface
-    else:
-        result['nickname'] = nickname
-
+    result = record.new_result(interface, nickname)
     try:
         for a in range(config.n_attempts):
-            returncode, output = speedtest.run_speedtest(interface=interface)
-            result['returnCode'] = returncode
-            if returncode == 0:
-                result['output'] = output
-                return result
-            if returncode == speedtest.limit_reached:
-                # We're being throttled for trying too often.
-                result['output'] = {'error': {'type': 'speedtest',
-                                              'message': 'Too many requests received.'}}
-                _l.error(f'[Attempt {a+1} of {config.n_attempts}] '
-                         f'`speedtest` exited with status {returncode}: too many requests.')
+            run = speedtest.run_speedtest(interface=interface)
+            if record.add_attempt(result, run, a):
                 return result
-
-            _l.error(f'[Attempt {a+1} of {config.n_attempts}] '
-                     f'`speedtest` exited with status {returncode}.\n{output}')
         raise RuntimeError(f'Failed to run after {config.n_attempts} tries.')
     except Exception as e:
-        _l.exception(e)
-        result['output'] = {'exception': {'type': type(e).__name__, 'message': str(e)}}
-        result['returnCode'] = -1
+        record.add_exception(result, e)
         return result
 
 
-_l.debug(f'Starting execution at {_isotime()}.')
-
-waits_min: Dict[str, float] = {}
-"""How long to wait to retest each interface."""
-last_test: Dict[str, float] = {}
-"""Last time each interface was tested."""
-
-
-def _is_time_to_test(interface: str) -> bool:
-    # Note default values guarantee a return value of True
-    delta_sec = time.time() - last_test.get(interface, 0)
-    if delta_sec >= waits_min.get(interface, 0) * 60:
-        return True
-    else:
-        return False
-
-
-def _set_wait_time(interface: str, result: dict) -> float:
-    if result['returnCode'] == 0 or result['returnCode'] == speedtest.limit_reached:
-        waits_min[interface] = config.test_interval_min
+class _Uplink:
+    """Keeps tests on interfaces that share a physical uplink from running into each other."""
+
+    def __init__(self) -> None:
+        self._run_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._next_start = 0.0
+
+    @contextmanager
+    def slot(self, serialize: bool, stagger_sec: float) -> Iterator[None]:
+        """Blocks until a test may start on this uplink; the test should run inside the context."""
+        if serialize:
+            self._run_lock.acquire()
+        try:
+            with self._start_lock:
+                now = time.time()
+                start = max(now, self._next_start)
+                self._next_start = start + stagger_sec
+            if start > now:
+                _l.debug(f'Staggering test by {start - now:.1f} seconds.')
+                time.sleep(start - now)
+            yield
+        finally:
+            if serialize:
+                self._run_lock.release()
+
+
+_uplinks: Dict[Tuple[str, ...], _Uplink] = {}
+_uplinks_lock = threading.Lock()
+
+
+def _uplink(interface: str) -> Optional[_Uplink]:
+    """Returns the uplink `interface` shares with others, or None if it doesn't share one."""
+    group = record.uplink_group(interface)
+    if group is None:
+        return None
+    with _uplinks_lock:
+        return _uplinks.setdefault(group, _Uplink())
+
+
+def _record(interface: Optional[str], nickname: Optional[str]) -> Dict[str, Any]:
+    """Runs a test and saves the result, which it returns."""
+    info = record.describe(interface, nickname)
+
+    uplink = None if interface is None else _uplink(interface)
+    if uplink is None:
+        _l.info(info)
+        result = _run(interface, nickname)
     else:
-        waits_min[interface] = config.retry_interval_min
-    return waits_min[interface]
+        with uplink.slot(config.serialize_shared_uplinks, config.uplink_stagger_sec):
+            _l.info(info)
+            result = _run(interface, nickname)
+    record.append_result(result)
+    return result
 
 
-def _load_results_from_disk(results_path: str) -> List[dict]:
-    if not os.path.exists(results_path):
-        _l.debug(f'Results file "{results_path}" does not exist.')
-        os.makedirs(os.path.dirname(results_path), exist_ok=True)
-        return []
-    else:
-        _l.debug(f'Loading results from "{results_path}"...')
-        with open(results_path, 'r') as f:
-            return json.loads(f.read())
-
-
-def _save_results_to_disk(results_path: str, results: List[dict]) -> None:
-    temp_results_path = results_path+'.tmp'
-    _l.debug(f'Saving results to "{temp_results_path}".')
-    with open(temp_results_path, 'w') as f:
-        f.write(json.dumps(results, sort_keys=True, indent=4))
-    _l.debug(f'Transferring results to "{results_path}".')
-    os.replace(temp_results_path, results_path)
-
+scheduler = Scheduler()
+"""When each interface (or "all", if `config.interfaces` isn't set) is next due for a test."""
 
-def _append_result(result: dict) -> None:
-    results_path = os.path.abspath(config.results_db)
-    results = _load_results_from_disk(results_path)
-    results.append(result)
-    _save_results_to_disk(results_path, results)
 
+def log_queue() -> None:
+    """Logs the scheduler's queue. Also done on `SIGUSR1`."""
+    now = time.time()
+    queue = ', '.join(f'"{key}" in {(due - now) / 60:.1f} min' for due, key in scheduler.snapshot())
+    _l.info(f'Test queue: {queue or "(empty)"}.')
 
-def _record(interface: Optional[str], nickname: Optional[str]) -> None:
-    if interface is None:
-        name = 'all'
-        info = 'Running test without specifying interface...'
-    else:
-        name = interface
-        info = f'Running test on interface "{name}", a.k.a. "{nickname}"...'
 
-    if not _is_time_to_test(name):
+def main() -> None:
+    _l.debug(f'Starting execution at {record.isotime()}.')
+    results_store.migrate_legacy(os.path.abspath(config.results_db))
+    compaction.start()
+    if config.collector_engine == 'asyncio':
+        from collector import aio
+        asyncio.run(aio.main())
         return
-
-    _l.info(info)
-
-    result = _run(interface, nickname)
-    _append_result(result)
-    interval_min = _set_wait_time(name, result)
-    _l.info(f'Will test again on interface "{name}", a.k.a. "{nickname}" '
-            f'in {interval_min} minutes...')
-    last_test[name] = time.time()
-
-
-def _interface_exists(interface: str, nickname: str) -> bool:
-    iface_names = [i[1] for i in socket.if_nameindex()]
-    if interface not in iface_names:
-        waits_min[interface] = config.test_interval_min
-        last_test[interface] = time.time()
-        avail = ', '.join([f'"{i}"' for i in iface_names])
-        _l.error(f'Interface "{interface}", a.k.a. "{nickname}" is not in the system. '
-                 f'Available interfaces: {avail}. '
-                 f'Will try again in {waits_min[interface]} minutes...')
-        return False
-    return True
-
-
-while True:
-    config.refresh()
-
-    if hasattr(config, 'interfaces'):
-        for name, nickname in config.interfaces:
-            if not _interface_exists(name, nickname):
+    signal.signal(signal.SIGUSR1, lambda signum, frame: log_queue())
+    state = StateStore(os.path.abspath(config.state_file))
+
+    # Each worker runs tests for one interface at a time. An interface is taken out of the
+    # scheduler's queue while it's in `in_flight`, and put back when its test finishes.
+    pool = ThreadPoolExecutor(max_workers=config.max_concurrent_tests,
+                              thread_name_prefix='speedtest')
+    in_flight: Set[str] = set()
+    in_flight_lock = threading.Lock()
+    targets = record.targets()
+    missing: Set[str] = set()  # interfaces that weren't in the system when last due.
+
+    def finished(name: str, future: Future) -> None:
+        with in_flight_lock:
+            in_flight.discard(name)
+        e = future.exception()
+        if e is None:
+            return_code = future.result()['returnCode']
+        else:
+            _l.error('Test worker failed.')
+            _l.exception(e)
+            return_code = -1
+        interval_min = state.update(name, return_code)
+        _l.info(f'Will test again on "{name}" in {interval_min:.1f} minutes...')
+        if name in targets:
+            scheduler.schedule(name, time.time() + interval_min * 60)
+
+    def plan() -> None:
+        """Brings the queue in line with the configured interfaces."""
+        nonlocal targets
+        config.refresh()
+        targets = record.targets()
+        with in_flight_lock:
+            # Interfaces not queued yet pick up where they left off before a restart.
+            sync_queue(scheduler, targets.keys(), in_flight, missing, watch.interface_names(),
+                       lambda name: state.get(name).next_due)
+        log_queue()
+
+    plan()
+    watch.start(on_change=scheduler.wake)
+
+    while True:
+        due = scheduler.wait()
+        if not due:
+            plan()  # Woken up early: something changed.
+            continue
+        for name in due:
+            if name not in targets:
                 continue
-            _record(interface=name, nickname=nickname)
-    else:
-        _record(interface=None, nickname=None)
+            interface, nickname = targets[name]
+            if interface is not None and nickname is not None \
+                    and not record.interface_exists(interface, nickname):
+                missing.add(name)
+                scheduler.schedule(name, time.time() + config.test_interval_min * 60)
+                continue
+            with in_flight_lock:
+                in_flight.add(name)
+            future = pool.submit(_record, interface=interface, nickname=nickname)
+            future.add_done_callback(functools.partial(finished, name))
+
 
-    time.sleep(10)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+from typing import Optional, Dict, Any, Tuple
+import logging
+import os
+import socket
+from datetime import datetime
+
+from utils import results_store
+from collector import speedtest
+import config
+
+_l = logging.getLogger(__name__)
+
+"""
+Running a test and recording its result: the parts shared by the collector's engines (the threaded
+one in `exec` and the asyncio one in `aio`).
+"""
+
+
+def isotime() -> str:
+    return datetime.utcnow().isoformat()[:-4]+'Z'
+
+
+def describe(interface: Optional[str], nickname: Optional[str]) -> str:
+    if interface is None:
+        return 'Running test without specifying interface...'
+    else:
+        return f'Running test on interface "{interface}", a.k.a. "{nickname}"...'
+
+
+def new_result(interface: Optional[str], nickname: Optional[str]) -> Dict[str, Any]:
+    """Starts a result for a test that's about to run."""
+    result: Dict[str, Any] = {}
+
+    result['timestamp'] = isotime()
+    if interface is None:
+        result['interface'] = 'none'
+    else:
+        result['interface'] = interface
+
+    if interface is not None and nickname is None:
+        result['nickname'] = interface
+    else:
+        result['nickname'] = nickname
+    return result
+
+
+def add_attempt(result: Dict[str, Any], run: speedtest.SpeedtestRun, attempt: int) -> bool:
+    """
+    Records attempt number `attempt` (0-based) of a test in `result`. Returns True if that's the
+    final word, i.e. there's no point in trying again.
+    """
+    returncode = run.returncode
+    result['returnCode'] = returncode
+    if returncode in (0, speedtest.limit_reached):
+        # What an earlier attempt left behind doesn't describe this outcome.
+        result.pop('partial', None)
+    if returncode == 0:
+        result['output'] = run.result
+        result['phaseSec'] = run.phase_sec
+        return True
+    if returncode == speedtest.limit_reached:
+        # We're being throttled for trying too often.
+        result['output'] = {'error': {'type': 'speedtest',
+                                      'message': 'Too many requests received.'}}
+        _l.error(f'[Attempt {attempt+1} of {config.n_attempts}] '
+                 f'`speedtest` exited with status {returncode}: too many requests.')
+        return True
+
+    # Keep what we got, in case this is the last attempt.
+    result['partial'] = run.summary()
+    _l.error(f'[Attempt {attempt+1} of {config.n_attempts}] '
+             f'`speedtest` exited with status {returncode}.\n' + '\n'.join(run.lines))
+    return False
+
+
+def add_exception(result: Dict[str, Any], e: Exception) -> None:
+    _l.exception(e)
+    result['output'] = {'exception': {'type': type(e).__name__, 'message': str(e)}}
+    result['returnCode'] = -1
+
+
+def append_result(result: dict) -> None:
+    results_path = os.path.abspath(config.results_db)
+    os.makedirs(os.path.dirname(results_path), exist_ok=True)
+    results_store.append(results_path, result, archive_raw=config.archive_raw_results)
+
+
+def uplink_group(interface: str) -> Optional[Tuple[str, ...]]:
+    """Returns the `config.shared_uplinks` group `interface` is in, if any."""
+    for group in getattr(config, 'shared_uplinks', ()):
+        if interface in group:
+            return tuple(group)
+    return None
+
+
+def interface_exists(interface: str, nickname: str) -> bool:
+    iface_names = [i[1] for i in socket.if_nameindex()]
+    if interface not in iface_names:
+        avail = ', '.join([f'"{i}"' for i in iface_names])
+        _l.error(f'Interface "{interface}", a.k.a. "{nickname}" is not in the system. '
+                 f'Available interfaces: {avail}. '
+                 f'Will try again when interfaces change, or in {config.test_interval_min} '
+                 'minutes...')
+        return False
+    return True
+
+
+def targets() -> Dict[str, Tuple[Optional[str], Optional[str]]]:
+    """Returns `(interface, nickname)` to test, keyed by the name used for scheduling."""
+    if hasattr(config, 'interfaces'):
+        return {name: (name, nickname) for name, nickname in config.interfaces}
+    else:
+        return {'all': (None, None)}
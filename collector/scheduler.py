@@ -0,0 +1,161 @@
+from typing import List, Dict, Tuple, Optional, Union, Collection, Set, Callable
+import heapq
+import itertools
+import threading
+import time
+
+
+class DeadlineQueue:
+    """
+    Priority queue of keys (e.g. interface names) ordered by the time they are next due. Each key is
+    in the queue at most once; scheduling a key that's already queued moves it.
+
+    Superseded heap entries are left in place and skipped when they reach the top, which keeps every
+    operation O(log n).
+    """
+
+    def __init__(self) -> None:
+        self._heap: List[Tuple[float, int, str]] = []
+        self._due: Dict[str, Tuple[float, int]] = {}  # the live entry for each key.
+        self._counter = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._due
+
+    def schedule(self, key: str, due: float) -> None:
+        """Queues `key` to be due at `due` (seconds since the epoch), replacing any earlier time."""
+        entry = (due, next(self._counter))
+        self._due[key] = entry
+        heapq.heappush(self._heap, (entry[0], entry[1], key))
+
+    def remove(self, key: str) -> None:
+        """Removes `key` from the queue, if it's there."""
+        self._due.pop(key, None)
+
+    def _prune(self) -> None:
+        while self._heap:
+            due, seq, key = self._heap[0]
+            if self._due.get(key) == (due, seq):
+                return
+            heapq.heappop(self._heap)
+
+    def peek(self) -> Optional[Tuple[float, str]]:
+        """Returns `(due, key)` for the next key due, or None if the queue is empty."""
+        self._prune()
+        if not self._heap:
+            return None
+        due, _, key = self._heap[0]
+        return due, key
+
+    def pop_due(self, now: float) -> List[str]:
+        """Removes and returns every key due at or before `now`, earliest first."""
+        keys: List[str] = []
+        while True:
+            nxt = self.peek()
+            if nxt is None or nxt[0] > now:
+                return keys
+            heapq.heappop(self._heap)
+            del self._due[nxt[1]]
+            keys.append(nxt[1])
+
+    def snapshot(self) -> List[Tuple[float, str]]:
+        """Returns `(due, key)` for every queued key, earliest first."""
+        return sorted((due, key) for key, (due, _) in self._due.items())
+
+
+class Scheduler:
+    """
+    Thread-safe `DeadlineQueue` that can be waited on: `wait` sleeps exactly until the next key is
+    due, or until `wake` is called from another thread.
+    """
+
+    def __init__(self) -> None:
+        self._queue = DeadlineQueue()
+        self._cond = threading.Condition()
+        self._woken = False
+
+    def __contains__(self, key: str) -> bool:
+        with self._cond:
+            return key in self._queue
+
+    def schedule(self, key: str, due: float) -> None:
+        """Queues `key` to be due at `due` (seconds since the epoch), replacing any earlier time."""
+        with self._cond:
+            self._queue.schedule(key, due)
+            self._cond.notify_all()
+
+    def remove(self, key: str) -> None:
+        """Removes `key` from the queue, if it's there."""
+        with self._cond:
+            self._queue.remove(key)
+
+    def wake(self) -> None:
+        """Makes `wait` return right away, e.g. because the configuration changed."""
+        with self._cond:
+            self._woken = True
+            self._cond.notify_all()
+
+    def wait(self) -> List[str]:
+        """
+        Blocks until at least one key is due and returns the keys that are, removing them from the
+        queue. Returns an empty list if woken up by `wake` first.
+        """
+        with self._cond:
+            while True:
+                if self._woken:
+                    self._woken = False
+                    return []
+                now = time.time()
+                due = self._queue.pop_due(now)
+                if due:
+                    return due
+                nxt = self._queue.peek()
+                # The timeout is relative; if the wall clock jumps meanwhile, the loop re-checks.
+                self._cond.wait(None if nxt is None else nxt[0] - now)
+
+    def snapshot(self) -> List[Tuple[float, str]]:
+        """Returns `(due, key)` for every queued key, earliest first."""
+        with self._cond:
+            return self._queue.snapshot()
+
+
+def sync_queue(queue: Union[DeadlineQueue, Scheduler],
+               keys: Collection[str],
+               busy: Collection[str],
+               missing: Set[str],
+               available: Collection[str],
+               next_due: Callable[[str], float]) -> None:
+    """
+    Brings `queue` in line with the keys that should be scheduled.
+
+    Parameters
+    ----------
+    queue : Union[DeadlineQueue, Scheduler]
+        The queue to update.
+    keys : Collection[str]
+        Every key that should be scheduled. Others are removed from the queue.
+    busy : Collection[str]
+        Keys that are being worked on, and so are left out of the queue for now.
+    missing : Set[str]
+        Keys whose interface was missing when last due. Those that are now in `available` are
+        removed from this set and made due right away.
+    available : Collection[str]
+        Names of the interfaces in the system.
+    next_due : Callable[[str], float]
+        When a key that isn't queued yet is due, e.g. as saved before a restart.
+    """
+    for _, key in queue.snapshot():
+        if key not in keys:
+            queue.remove(key)
+    now = time.time()
+    for key in keys:
+        if key in busy:
+            continue
+        if key in missing and key in available:
+            missing.discard(key)
+            queue.schedule(key, now)
+        elif key not in queue:
+            queue.schedule(key, max(now, next_due(key)))
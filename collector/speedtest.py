@@ -1,8 +1,12 @@
-from typing import List, Optional, Dict, Any, Tuple
+from typing import List, Optional, Dict, Any
+from dataclasses import dataclass, field
+import asyncio
 import json
 import os
 import logging
+import selectors
 import subprocess
+import time
 
 import config
 
@@ -11,20 +15,204 @@ _l = logging.getLogger(__name__)
 limit_reached = 173
 """Return code for exceeding the maximum number of requests over some period."""
 
+timed_out = 124
+"""Return code we report when `speedtest` had to be killed for taking too long (as `timeout`)."""
 
-def _parse_output(out: str) -> Dict[str, Any]:
+phases = ('start', 'ping', 'download', 'upload')
+"""
+The phases of a test, in order. "start" lasts from launching `speedtest` until the first ping event.
+The others are named after the `type` of the progress events `speedtest --format=jsonl` emits.
+"""
+
+
+@dataclass
+class SpeedtestRun:
+    """The outcome of one `speedtest` run, complete or not."""
+
+    returncode: int
+    result: Dict[str, Any] = field(default_factory=dict)
+    """The final result, as output by `speedtest`. Empty unless the run completed."""
+    progress: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    """The latest progress event for each phase that was reached."""
+    phase_sec: Dict[str, float] = field(default_factory=dict)
+    """How long each phase that was reached took."""
+    timed_out_phase: Optional[str] = None
     """
-    Parses the output string, assuming the last line is valid JSON content.
+    The phase during which the run was killed for taking too long ("total" for the overall limit),
+    or None.
+    """
+    lines: List[str] = field(default_factory=list)
+    """Every line of output."""
+
+    @property
+    def partial(self) -> bool:
+        return not self.result
 
-    Around 2024-08-12, the output of `speedtest` started including more than
-    one independent JSON string, so decoding the thing as a whole raised
-    exceptions.
+    def summary(self) -> Dict[str, Any]:
+        """Phase timings and whatever was measured, for recording alongside a failed result."""
+        return {'phase_sec': self.phase_sec,
+                'timed_out_phase': self.timed_out_phase,
+                'progress': self.progress}
+
+
+class _Progress:
+    """
+    Follows the output of `speedtest --format=jsonl` line by line. Not every line is JSON, and
+    since around 2024-08-12 there's more than one JSON object per run, so the result is the line
+    whose `type` is "result".
     """
-    lines = out.split('\n')
-    return json.loads(lines[-2])
 
+    def __init__(self, run: SpeedtestRun) -> None:
+        self._run = run
+        self.phase = phases[0]
+        self.phase_start = time.monotonic()
+
+    def _enter(self, phase: str) -> None:
+        now = time.monotonic()
+        self._run.phase_sec[self.phase] = now - self.phase_start
+        self.phase = phase
+        self.phase_start = now
+
+    def close(self) -> None:
+        """Records the duration of the current phase."""
+        self._run.phase_sec[self.phase] = time.monotonic() - self.phase_start
 
-def run_speedtest(interface: Optional[str]) -> Tuple[int, Dict[str, Any]]:
+    def feed(self, line: str) -> None:
+        self._run.lines.append(line)
+        try:
+            event = json.loads(line)
+        except ValueError:
+            return  # Not everything `speedtest` says is JSON.
+        if not isinstance(event, dict):
+            return
+        kind = event.get('type')
+        if kind == 'result':
+            self._run.result = event
+        elif kind in phases:
+            if kind != self.phase and phases.index(kind) > phases.index(self.phase):
+                self._enter(kind)
+            self._run.progress[kind] = event.get(kind, event)
+        elif kind is None and 'download' in event and 'upload' in event:
+            # `--format=json` output, or a `speedtest` that doesn't label its result.
+            self._run.result = event
+
+
+def _kill(proc: subprocess.Popen) -> None:
+    proc.terminate()
+    try:
+        proc.wait(timeout=config.speedtest_kill_grace_sec)
+    except subprocess.TimeoutExpired:
+        _l.warning('`speedtest` ignored SIGTERM; killing it.')
+        proc.kill()
+        proc.wait()
+
+
+def _stream(args: List[str], dump: Any) -> SpeedtestRun:
+    """Runs `speedtest`, following its progress and enforcing the timeouts in `config`."""
+    run = SpeedtestRun(returncode=0)
+    progress = _Progress(run)
+    total_deadline = time.monotonic() + config.speedtest_timeout_sec
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    assert proc.stdout is not None
+    fd = proc.stdout.fileno()
+    os.set_blocking(fd, False)
+    buffer = b''
+    with selectors.DefaultSelector() as sel:
+        sel.register(fd, selectors.EVENT_READ)
+        while True:
+            now = time.monotonic()
+            phase_deadline = progress.phase_start + config.speedtest_phase_timeout_sec
+            if now >= total_deadline or now >= phase_deadline:
+                run.timed_out_phase = 'total' if now >= total_deadline else progress.phase
+                _l.error(f'`speedtest` timed out during "{run.timed_out_phase}"; killing it.')
+                _kill(proc)
+                break
+            if not sel.select(min(total_deadline, phase_deadline) - now):
+                continue
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break  # EOF: `speedtest` exited.
+            dump.write(chunk.decode(errors='replace'))
+            buffer += chunk
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                progress.feed(line.decode(errors='replace'))
+    if buffer:
+        progress.feed(buffer.decode(errors='replace'))
+    progress.close()
+    proc.stdout.close()
+    if run.timed_out_phase is None:
+        try:
+            run.returncode = proc.wait(timeout=max(0.0, total_deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            run.timed_out_phase = 'total'
+            _l.error('`speedtest` closed its output but did not exit; killing it.')
+            _kill(proc)
+    if run.timed_out_phase is not None:
+        run.returncode = timed_out
+    if run.returncode == 0 and not run.result:
+        _l.error('`speedtest` exited normally without a result.')
+        run.returncode = -1
+    return run
+
+
+async def _kill_async(proc: asyncio.subprocess.Process) -> None:
+    proc.terminate()
+    try:
+        await asyncio.wait_for(proc.wait(), timeout=config.speedtest_kill_grace_sec)
+    except asyncio.TimeoutError:
+        _l.warning('`speedtest` ignored SIGTERM; killing it.')
+        proc.kill()
+        await proc.wait()
+
+
+async def _stream_async(args: List[str], dump: Any) -> SpeedtestRun:
+    """Same as `_stream`, on the event loop."""
+    run = SpeedtestRun(returncode=0)
+    progress = _Progress(run)
+    total_deadline = time.monotonic() + config.speedtest_timeout_sec
+    proc = await asyncio.create_subprocess_exec(*args,
+                                                stdout=asyncio.subprocess.PIPE,
+                                                stderr=asyncio.subprocess.STDOUT,
+                                                limit=1024 * 1024)
+    assert proc.stdout is not None
+    while True:
+        now = time.monotonic()
+        phase_deadline = progress.phase_start + config.speedtest_phase_timeout_sec
+        if now >= total_deadline or now >= phase_deadline:
+            run.timed_out_phase = 'total' if now >= total_deadline else progress.phase
+            _l.error(f'`speedtest` timed out during "{run.timed_out_phase}"; killing it.')
+            await _kill_async(proc)
+            break
+        try:
+            # A cancelled `readline` leaves a partial line in the buffer for the next call.
+            raw = await asyncio.wait_for(proc.stdout.readline(),
+                                         min(total_deadline, phase_deadline) - now)
+        except asyncio.TimeoutError:
+            continue
+        if not raw:
+            break  # EOF: `speedtest` exited.
+        line = raw.decode(errors='replace')
+        dump.write(line)
+        progress.feed(line.rstrip('\n'))
+    progress.close()
+    if run.timed_out_phase is None:
+        try:
+            run.returncode = await asyncio.wait_for(
+                proc.wait(), timeout=max(0.0, total_deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            run.timed_out_phase = 'total'
+            _l.error('`speedtest` closed its output but did not exit; killing it.')
+            await _kill_async(proc)
+    if run.timed_out_phase is not None:
+        run.returncode = timed_out
+    if run.returncode == 0 and not run.result:
+        _l.error('`speedtest` exited normally without a result.')
+        run.returncode = -1
+    return run
+
+
+def _command(interface: Optional[str]) -> List[str]:
     s = config.speedtest_path
     _l.debug(f'Speedtest is at "{s}".')
 
@@ -38,26 +226,41 @@ def run_speedtest(interface: Optional[str]) -> Tuple[int, Dict[str, Any]]:
     if interface is not None:
         args.append(f'--interface={interface}')
 
-    args.append('--format=json')
+    args.append('--format=jsonl')
+    return args
+
+
+def _dump_file(interface: Optional[str]) -> str:
+    results_dir = os.path.dirname(os.path.abspath(config.results_db))
+    os.makedirs(results_dir, exist_ok=True)
+    return results_dir + f'/last_speedtest_{interface}.out'
+
+
+def _log_run(run: SpeedtestRun) -> None:
+    _l.debug(f'`speedtest` exited with status {run.returncode}; phases took ' +
+             ', '.join(f'{p} {sec:.1f} s' for p, sec in run.phase_sec.items()) + '.')
+
+
+def run_speedtest(interface: Optional[str]) -> SpeedtestRun:
+    args = _command(interface)
     cmd = ' '.join(args)
     _l.debug(f'Executing "{cmd}".')
 
-    dump_file = (os.path.dirname(os.path.abspath(config.results_db))
-                 + f'/last_speedtest_{interface}.out')
+    with open(_dump_file(interface), 'w') as f:
+        f.write(f'> {cmd}\n')
+        run = _stream(args, f)
+    _log_run(run)
+    return run
 
-    try:
-        f = open(dump_file, 'w')
+
+async def run_speedtest_async(interface: Optional[str]) -> SpeedtestRun:
+    """Same as `run_speedtest`, on the event loop."""
+    args = _command(interface)
+    cmd = ' '.join(args)
+    _l.debug(f'Executing "{cmd}".')
+
+    with open(_dump_file(interface), 'w') as f:
         f.write(f'> {cmd}\n')
-        try:
-            result_out = subprocess.check_output(args, stderr=subprocess.STDOUT).decode()
-            f.write(result_out)
-            f.close()
-            result_json = _parse_output(result_out)
-            returncode = 0
-        except subprocess.CalledProcessError as e:
-            result_json = {}
-            returncode = e.returncode
-    finally:
-        f.close()
-
-    return returncode, result_json
+        run = await _stream_async(args, f)
+    _log_run(run)
+    return run
@@ -0,0 +1,117 @@
+from typing import Dict, Any
+from dataclasses import dataclass, asdict, fields
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import config
+from collector import speedtest
+
+_l = logging.getLogger(__name__)
+
+
+@dataclass
+class InterfaceState:
+    """
+    What the scheduler remembers about an interface between runs. Times are seconds since the epoch;
+    0 means never.
+    """
+
+    last_attempt: float = 0
+    last_success: float = 0
+    failures: int = 0
+    """Consecutive failed tests, not counting rate limiting."""
+    rate_limits: int = 0
+    """Consecutive tests refused because of `speedtest.limit_reached`."""
+    next_due: float = 0
+
+
+def _jitter(minutes: float) -> float:
+    j = config.backoff_jitter
+    return minutes * random.uniform(1 - j, 1 + j)
+
+
+def _backoff_min(base_min: float, n: int, max_min: float) -> float:
+    """Exponential backoff: `base_min` after the first failure, doubling up to `max_min`."""
+    return min(base_min * 2 ** max(n - 1, 0), max_min)
+
+
+class StateStore:
+    """
+    Per-interface `InterfaceState`, saved to a JSON file after every change so a restart picks up
+    the schedule where it left off instead of testing every interface at once. Thread-safe.
+    """
+
+    def __init__(self, filename: str) -> None:
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._states: Dict[str, InterfaceState] = {}
+        if os.path.exists(filename):
+            try:
+                with open(filename, 'r') as f:
+                    saved: Dict[str, Dict[str, Any]] = json.loads(f.read())
+                known = {f.name for f in fields(InterfaceState)}
+                for name, s in saved.items():
+                    self._states[name] = InterfaceState(**{k: v for k, v in s.items()
+                                                           if k in known})
+                _l.debug(f'Restored scheduler state for {len(self._states)} interfaces '
+                         f'from "{filename}".')
+            except Exception as e:
+                _l.error(f'Failed to restore scheduler state from "{filename}": {e}')
+
+    def get(self, name: str) -> InterfaceState:
+        with self._lock:
+            return self._states.setdefault(name, InterfaceState())
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self._filename)), exist_ok=True)
+        temp_filename = self._filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            f.write(json.dumps({name: asdict(s) for name, s in self._states.items()},
+                               sort_keys=True, indent=4))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filename, self._filename)
+
+    def update(self, name: str, return_code: int) -> float:
+        """
+        Records the outcome of a test and works out when the next one is due.
+
+        Parameters
+        ----------
+        name : str
+            The interface's scheduling name.
+        return_code : int
+            The result's `returnCode`.
+
+        Returns
+        -------
+        float
+            Minutes until the next test.
+        """
+        now = time.time()
+        with self._lock:
+            s = self._states.setdefault(name, InterfaceState())
+            s.last_attempt = now
+            if return_code == 0:
+                s.last_success = now
+                s.failures = 0
+                s.rate_limits = 0
+                wait_min = config.test_interval_min
+            elif return_code == speedtest.limit_reached:
+                s.rate_limits += 1
+                wait_min = _jitter(_backoff_min(config.rate_limit_backoff_min, s.rate_limits,
+                                                config.rate_limit_backoff_max_min))
+            else:
+                s.failures += 1
+                wait_min = _jitter(_backoff_min(config.retry_interval_min, s.failures,
+                                                config.retry_backoff_max_min))
+            s.next_due = now + wait_min * 60
+            try:
+                self._save()
+            except OSError as e:
+                _l.error(f'Failed to save scheduler state to "{self._filename}": {e}')
+        return wait_min
@@ -0,0 +1,80 @@
+from typing import Any, Callable, Optional, Set
+import logging
+import socket
+import threading
+import time
+
+import config
+from utils import config_watch
+
+_l = logging.getLogger(__name__)
+
+_RTMGRP_LINK = 0x1
+_RTMGRP_IPV4_IFADDR = 0x10
+
+config_poll_sec: float = 2
+"""
+How often to check whether the config file changed, when inotify isn't available. A `stat` is all
+it costs.
+"""
+
+plan_options = {'interfaces'}
+"""Config options that change which interfaces get tested (see `record.targets`)."""
+
+interface_poll_sec: float = 10
+"""How often to list interfaces when the kernel can't notify us of changes (i.e. not on Linux)."""
+
+
+def interface_names() -> Set[str]:
+    return {i[1] for i in socket.if_nameindex()}
+
+
+def open_netlink() -> Optional[socket.socket]:
+    """Returns a socket that receives a message whenever a link or address changes, if possible."""
+    try:
+        s = socket.socket(socket.AF_NETLINK,  # type: ignore[attr-defined]
+                          socket.SOCK_RAW,
+                          socket.NETLINK_ROUTE)  # type: ignore[attr-defined]
+        s.bind((0, _RTMGRP_LINK | _RTMGRP_IPV4_IFADDR))
+        return s
+    except (AttributeError, OSError) as e:
+        _l.debug(f'Netlink not available ({e}); will poll interfaces.')
+        return None
+
+
+def _watch_interfaces(on_change: Callable[[], None]) -> None:
+    s = open_netlink()
+    if s is not None:
+        while True:
+            s.recv(65536)  # We don't care what changed, just that something did.
+            on_change()
+    else:
+        names = interface_names()
+        while True:
+            time.sleep(interface_poll_sec)
+            new_names = interface_names()
+            if new_names != names:
+                names = new_names
+                on_change()
+
+
+def watch_config(on_change: Callable[[], Any]) -> None:
+    """
+    Starts a daemon thread that reloads the config whenever the file changes (see
+    `utils.config_watch`), and calls `on_change` from it if any of `plan_options` changed.
+    """
+    def changed(options: Set[str]) -> None:
+        if options & plan_options:
+            on_change()
+    config_watch.subscribe(changed)
+    config_watch.start(config.__file__, config.refresh, poll_sec=config_poll_sec)
+
+
+def start(on_change: Callable[[], None]) -> None:
+    """
+    Starts daemon threads that call `on_change` whenever `plan_options` or the set of network
+    interfaces (or their addresses) change. Other config changes are loaded without calling it.
+    """
+    watch_config(on_change)
+    threading.Thread(target=_watch_interfaces, args=(on_change,), daemon=True,
+                     name=_watch_interfaces.__name__).start()
@@ -1,29 +1,128 @@
-from typing import Tuple, Union, Dict
+from typing import Tuple, Union, Dict, Set, Optional
 
 test_interval_min: float = 20
-"""How often to run the speed test. Note there's a 10 second resolution."""
+"""How often to run the speed test."""
 assert test_interval_min >= 10/60.0
 
 retry_interval_min: float = 1
-"""How soon to re-run the speed test if there's an error. Note there's a 10 second resolution."""
+"""How soon to re-run the speed test if there's an error."""
 assert retry_interval_min >= 10/60.0
 
+retry_backoff_max_min: float = 20
+"""
+Consecutive failures back off exponentially: the first retry is after `retry_interval_min`, and the
+wait doubles after every failure, up to this.
+"""
+assert retry_backoff_max_min >= retry_interval_min
+
+rate_limit_backoff_min: float = 60
+"""
+How long to wait after `speedtest` refuses to run because of too many requests. Doubles with every
+consecutive refusal, up to `rate_limit_backoff_max_min`.
+"""
+assert rate_limit_backoff_min > 0
+
+rate_limit_backoff_max_min: float = 24 * 60
+"""Longest wait after consecutive refusals for too many requests."""
+assert rate_limit_backoff_max_min >= rate_limit_backoff_min
+
+backoff_jitter: float = 0.1
+"""
+Backoff waits are randomly stretched or shrunk by up to this fraction, so that interfaces that
+failed together don't retry in lockstep.
+"""
+assert 0 <= backoff_jitter < 1
+
 speedtest_path: str = '/usr/bin/speedtest'
 """Path to Ooklah speedtest CLI executable."""
 
-results_db: str = './results/results.json'
-"""Path to database results file."""
+results_db: str = './results/results.jsonl'
+"""
+Path to database results file. The extension picks the format (see `utils.results_store`):
+`.jsonl` is append-only; `.json` is the original format, rewritten in full on every test; `.col`
+only stores the fields the dashboard uses, in compact columns (convert an existing file with
+`scripts/convert_results.py`).
+If this is a `.jsonl` file that doesn't exist, the collector (or the dashboard, if it starts first)
+migrates the `.json` file with the same name at startup.
+"""
+
+archive_raw_results: bool = True
+"""
+For `.col` results files: whether to also keep each test's complete `speedtest` output, compressed,
+in `<results_db>.blob`. Without it, server, ISP and external IP address are all that's kept beyond
+what the dashboard uses.
+"""
+
+retention_days: Dict[str, Optional[float]] = {'raw': None,
+                                              'hourly': None,
+                                              'daily': None,
+                                              'weekly': None,
+                                              }
+"""
+How many days of history to keep at each resolution, or None to keep it forever: "raw" is the
+results file itself, and the others are its rollups (summaries per hour, day and week; see
+`utils.rollups`). The collector drops what's older every `compaction_interval_hrs`; the dashboard
+fills in from the rollups where the results no longer go back far enough. Each resolution must be
+kept at least as long as the finer ones.
+By default nothing is ever dropped. For example, `{'raw': 90, 'hourly': 2 * 365, 'daily': None,
+'weekly': None}` keeps 90 days of individual tests, 2 years of hourly summaries and daily and
+weekly summaries forever. Dropped data can't be recovered.
+"""
+assert set(retention_days.keys()) == {'raw', 'hourly', 'daily', 'weekly'}
+assert all(days is None or days > 0 for days in retention_days.values())
+assert all((retention_days[fine] or float('inf')) <= (retention_days[coarse] or float('inf'))
+           for fine, coarse in (('raw', 'hourly'), ('hourly', 'daily'), ('daily', 'weekly')))
+
+compaction_interval_hrs: float = 24
+"""How often the collector applies `retention_days`. It also does it at startup."""
+assert compaction_interval_hrs > 0
+
+state_file: str = './results/collector_state.json'
+"""
+Path to the file where the collector keeps when each interface was last tested, so that a restart
+doesn't test every interface at once.
+"""
 
 data_load_interval_min: float = 5
 """How often to load data from disk."""
 assert data_load_interval_min > 0
 
+shared_snapshot: bool = True
+"""
+True for dashboard processes (e.g. gunicorn workers) to share one copy of the processed data: one of
+them loads it and publishes a snapshot next to the results file, which the others memory-map. False
+for each process to load the data itself. Either way, the dashboard starts from the latest snapshot
+and only reads the results added since.
+"""
+
+snapshot_poll_sec: float = 5
+"""How often dashboard processes that don't load the data check for a new snapshot."""
+assert snapshot_poll_sec > 0
+
 log_file: Union[bool, str] = './results/run.log'
 """
 Log file location. See `log.configure_logging`.
 Changes to this only take effect at startup.
 """
 
+speedtest_timeout_sec: float = 180
+"""Longest a single `speedtest` run may take before it's killed."""
+assert speedtest_timeout_sec > 0
+
+speedtest_kill_grace_sec: float = 5
+"""
+How long `speedtest` gets to exit after being told to (when it times out) before it's killed
+outright.
+"""
+assert speedtest_kill_grace_sec > 0
+
+speedtest_phase_timeout_sec: float = 60
+"""
+Longest a single phase of a `speedtest` run (start-up, ping, download, upload) may take before the
+run is killed.
+"""
+assert speedtest_phase_timeout_sec > 0
+
 server_id: str = '9436'  # Comcast Sacramento, CA
 """
 [Optional] Specify a specific Speedtest server by ID.
@@ -41,13 +140,54 @@ displaying results.
 Comment this out if you don't want it.
 """
 
+collector_engine: str = 'threads'
+"""
+How the collector runs: "threads" uses a worker thread per concurrent test; "asyncio" does
+everything on a single thread with an event loop. Changes to this only take effect at startup.
+"""
+assert collector_engine in ('threads', 'asyncio')
+
+max_concurrent_tests: int = 4
+"""
+Maximum number of interfaces to test at the same time. Must be at least 1.
+Changes to this only take effect at startup.
+"""
+assert max_concurrent_tests >= 1
+
+shared_uplinks: Tuple[Tuple[str, ...], ...] = (
+    # ('enx8cae4cdd62b9', 'enx8cae4cdd62d6'),
+)
+"""
+[Optional] Groups of interface names that share a physical uplink, so that testing them at the same
+time would make each test measure only part of the bandwidth. See `serialize_shared_uplinks` and
+`uplink_stagger_sec`.
+"""
+
+serialize_shared_uplinks: bool = True
+"""True to never run tests at the same time on interfaces in the same `shared_uplinks` group."""
+
+uplink_stagger_sec: float = 0
+"""Minimum number of seconds between the starts of tests on interfaces in the same group."""
+assert uplink_stagger_sec >= 0
+
 n_attempts: int = 5
 """Number of times to execute `speedtest` while the return code is not 0. Must be at least 1."""
 assert n_attempts > 0
 
+max_disorder_sec: float = n_attempts * (speedtest_timeout_sec + speedtest_kill_grace_sec) + 5 * 60
+"""
+Results are stamped when a test starts but appended when it finishes, so when interfaces are tested
+concurrently, timestamps in a results file are only sorted to within the longest a test can take:
+`n_attempts` runs of up to `speedtest_timeout_sec` each, plus `speedtest_kill_grace_sec` to stop
+each one, plus some time to spare for waiting on the results file. Anything seeking by timestamp
+widens its search by this much; too small a value would miss results.
+"""
+assert max_disorder_sec >= n_attempts * (speedtest_timeout_sec + speedtest_kill_grace_sec)
+
 plot_hrs: Dict[str, int] = {'log': 24,
                             'daily': 24 * 28,
-                            'hourly': 24 * 28
+                            'hourly': 24 * 28,
+                            'heatmap': 24 * 28,
                             }
 """
 Maximum number of hours of results to to show on the plot by default, keyed by endpoint.
@@ -55,6 +195,28 @@ Changes to this only take effect at startup.
 """
 assert all(plot_hrs.values()) > 0
 
+page_cache_entries: int = 64
+"""
+Maximum number of rendered pages the dashboard keeps. Pages are re-rendered when the data or the
+options they depend on change.
+"""
+assert page_cache_entries > 0
+
+page_cache_mb: float = 64
+"""
+Maximum total size, in megabytes, of the pages the dashboard keeps.
+"""
+assert page_cache_mb > 0
+
+rollup_plot_hrs: int = 24 * 7 * 8
+"""
+Hourly and daily plots that span more than this many hours, or that go back further than the
+results do (see `retention_days`), are computed from the hourly rollups (summaries kept next to the
+results file) rather than from individual tests. They're not smoothed and count every failed test,
+regardless of `keep_consecutive_failures`.
+"""
+assert rollup_plot_hrs > 0
+
 hourly_plot_days = 10
 """
 Default number of days' worth of data to show in the hourly plot.
@@ -68,9 +230,45 @@ Changes to this only take effect at startup.
 """
 
 n_time_avg = 5
-"""Number of points to use for time average smoothing of the plot. Must be at least 1."""
+"""
+Number of points to use for time average smoothing of the plot. Must be at least 1. Can be
+overridden with the `window` query parameter.
+"""
 assert n_time_avg >= 1
 
+smoothing: str = 'mean'
+"""
+How to smooth the plot: "mean" (moving average), "ewma" (exponentially weighted moving average
+with the same center of mass as a `n_time_avg` point moving average) or "median" (rolling median).
+Can be overridden with the `smooth` query parameter, which also accepts "none".
+"""
+assert smoothing in ('mean', 'ewma', 'median')
+
+decimation: str = 'lttb'
+"""
+How to thin out the log plot when it has more points than it can show: "lttb"
+(Largest-Triangle-Three-Buckets, which keeps the shape of the curve) or "minmax" (the lowest and
+highest point per pixel column). Failures and the tests around them are always kept. Can be
+overridden with the `decimate` query parameter, which also accepts "none".
+"""
+assert decimation in ('lttb', 'minmax')
+
+points_per_px: float = 1
+"""
+Point budget of each interface on the log plot, per pixel of the plot's width. Can be overridden
+with the `points` query parameter (the number of points; 0 for all of them).
+"""
+assert points_per_px > 0
+
+decimation_headroom: float = 20
+"""
+The log plot shows individual tests, thinned out to its point budget (see `decimation` and
+`points_per_px`), as long as no interface has more than this many times the budget in the plotted
+range; failures are never thinned out. Past that, it shows the finest buckets of tests (10 minutes,
+an hour or a day) that are within this many times the budget, thinned out the same way.
+"""
+assert decimation_headroom >= 1
+
 keep_consecutive_failures: bool = False
 """
 True to show every failed test on the plot, False to show only the first failure and the last
@@ -81,21 +279,41 @@ straight days.
 """
 
 
-def refresh() -> None:
-    """Reloads the configuration file and updates the `config` module."""
+def refresh() -> Set[str]:
+    """
+    Reloads the configuration file and updates the `config` module, if the file changed (see
+    `utils.config_watch`); cheap otherwise. Returns the names of the options that changed, which
+    subscribers to `utils.config_watch` are also told.
+    """
     import os
     import logging
-    import importlib.util
-    import sys
+    from utils import config_watch
 
     _l = logging.getLogger(__name__)
 
     filename = __file__
     if not os.path.exists(filename):
         _l.error(f'Cannot find config file at "{filename}".')
-        return
+        return set()
+
+    with config_watch.lock:
+        code = config_watch.read_if_changed(filename)
+        if code is None:
+            return set()
+        changed = _reload(filename, code)
+    if changed:
+        config_watch.notify(changed)
+    return changed
+
 
-    code = open(filename, 'r', encoding='utf-8').read()
+def _reload(filename: str, code: str) -> Set[str]:
+    """Executes `code` and updates the `config` module with it."""
+    import logging
+    import importlib.util
+    import sys
+    from utils import config_watch
+
+    _l = logging.getLogger(__name__)
 
     try:
         # Much confusion here as to how to do this. `spec_from_loader` with `loader`
@@ -113,7 +331,7 @@ def refresh() -> None:
         module.refresh = refresh  # type: ignore[attr-defined]
     except Exception as e:
         _l.error(f'Failed to refresh config: {e}')
-        return
+        return set()
 
     # If we've already been imported, shoehorn in the new version. This will update all references
     # with the current config.
@@ -124,14 +342,18 @@ def refresh() -> None:
         # Note: we can't just clear the `__dict__`, because that dictionary, in this case, is also
         # `globals`. So clearing it would "unimport" sys.
         m_dict = sys.modules[__name__].__dict__
+        changed = config_watch.changed_options(m_dict, module.__dict__)
         old_attrs = list(m_dict.keys())  # [k for k in list(m_dict.keys()) if k not in keep]
         # Don't delete a few things:
         old_attrs.remove('refresh')  # We'll need this.
-        old_attrs.remove('__warningregistry__')  # no idea what this is.
+        if '__warningregistry__' in old_attrs:
+            old_attrs.remove('__warningregistry__')  # no idea what this is.
         for k in old_attrs:
             if k not in module.__dict__.keys():
                 del m_dict[k]
         sys.modules[__name__].__dict__.update(module.__dict__)
+        return changed
+    return set()
 
 
 # refresh()
@@ -0,0 +1,111 @@
+from typing import Sequence, Dict, Tuple
+import logging
+
+import numpy
+
+from utils import sketch
+
+_l = logging.getLogger(__name__)
+
+"""
+Grouped aggregation
+-------------------
+
+Statistics of values grouped by one or more small integer keys (e.g. hour of day, or weekday and
+hour), computed for every group at once with `bincount`, instead of a loop over groups.
+Percentiles are estimated from quantile sketches (see `utils.sketch`), which take a fixed amount of
+memory per group and can be merged, e.g. from rollups.
+"""
+
+
+def group_by(keys: Sequence[numpy.ndarray],
+             shape: Tuple[int, ...],
+             values: Dict[str, numpy.ndarray],
+             success: numpy.ndarray,
+             percentiles: Sequence[float] = (5, 50, 95)) -> Dict[str, numpy.ndarray]:
+    """
+    Computes statistics of `values` for each combination of `keys`. Failed tests count as 0, as
+    they do on the plots.
+
+    Parameters
+    ----------
+    keys : Sequence[numpy.ndarray]
+        One integer array per dimension, e.g. `(weekday, hour)`.
+    shape : Tuple[int, ...]
+        Number of possible values of each key, e.g. `(7, 24)`; key values must be in
+        `range(shape[i])`.
+    values : Dict[str, numpy.ndarray]
+        Arrays to aggregate, by name, e.g. `download_mbps`.
+    success : numpy.ndarray
+        Whether each test succeeded.
+    percentiles : Sequence[float]
+        Which percentiles of `values` to compute.
+
+    Returns
+    -------
+    Dict[str, numpy.ndarray]
+        Arrays of shape `shape`: `num_tests` and `num_tests_failed`, and for each of `values`,
+        `<name>_mean`, `<name>_std` and `<name>_p<percentile>` (NaN where there are no tests).
+        Percentiles are within `sketch.relative_accuracy` of the exact ones.
+    """
+    n_groups = int(numpy.prod(shape))
+    group = numpy.ravel_multi_index(tuple(numpy.asarray(k, dtype=numpy.int64) for k in keys),
+                                    shape)
+    counts = numpy.bincount(group, minlength=n_groups)
+    stats: Dict[str, numpy.ndarray] = {
+        'num_tests': counts,
+        'num_tests_failed': numpy.bincount(group, weights=~success, minlength=n_groups)
+                                 .astype(numpy.int64),
+    }
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        for name, vals in values.items():
+            vals = vals.astype(numpy.float64)
+            mean = numpy.bincount(group, weights=vals, minlength=n_groups) / counts
+            # Sum of squared deviations, via each value's group mean, for accuracy.
+            sq_dev = numpy.bincount(group, weights=(vals - mean[group]) ** 2, minlength=n_groups)
+            stats[f'{name}_mean'] = mean
+            stats[f'{name}_std'] = numpy.sqrt(sq_dev / counts)
+            sketches = sketch.build(group, vals, n_groups)
+            for q, p in sketch.quantiles(sketches, percentiles).items():
+                stats[f'{name}_p{q:g}'] = p
+    return {name: stat.reshape(shape) for name, stat in stats.items()}
+
+
+def group_sums(keys: Sequence[numpy.ndarray],
+               shape: Tuple[int, ...],
+               counts: numpy.ndarray,
+               failures: numpy.ndarray,
+               sums: Dict[str, Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]],
+               percentiles: Sequence[float] = (5, 50, 95)) -> Dict[str, numpy.ndarray]:
+    """
+    Same as `group_by`, from partial sums (e.g. rollups) rather than individual values.
+
+    Parameters
+    ----------
+    counts : numpy.ndarray
+        Number of tests summed in each entry.
+    failures : numpy.ndarray
+        Number of those that failed.
+    sums : Dict[str, Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]]
+        Sum, sum of squares and sketches (shape `(len(counts), sketch.n_bins)`) of each value, by
+        name.
+    """
+    n_groups = int(numpy.prod(shape))
+    group = numpy.ravel_multi_index(tuple(numpy.asarray(k, dtype=numpy.int64) for k in keys),
+                                    shape)
+    n = numpy.bincount(group, weights=counts, minlength=n_groups)
+    stats: Dict[str, numpy.ndarray] = {
+        'num_tests': n.astype(numpy.int64),
+        'num_tests_failed': numpy.bincount(group, weights=failures, minlength=n_groups)
+                                 .astype(numpy.int64),
+    }
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        for name, (total, total_sq, sketches) in sums.items():
+            mean = numpy.bincount(group, weights=total, minlength=n_groups) / n
+            mean_sq = numpy.bincount(group, weights=total_sq, minlength=n_groups) / n
+            stats[f'{name}_mean'] = mean
+            stats[f'{name}_std'] = numpy.sqrt(numpy.maximum(mean_sq - mean ** 2, 0))
+            merged = sketch.merge(group, sketches, n_groups)
+            for q, p in sketch.quantiles(merged, percentiles).items():
+                stats[f'{name}_p{q:g}'] = p
+    return {name: stat.reshape(shape) for name, stat in stats.items()}
@@ -0,0 +1,74 @@
+from typing import Optional, Hashable
+from collections import OrderedDict
+import hashlib
+import logging
+import threading
+
+_l = logging.getLogger(__name__)
+
+
+class PageCache:
+    """
+    Least-recently-used cache of rendered pages, limited by both the number of pages and their total
+    size. Thread-safe.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._pages: 'OrderedDict[Hashable, bytes]' = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def etag(key: Hashable) -> str:
+        """An entity tag for the page cached under `key`; equal keys make equal tags."""
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        with self._lock:
+            page = self._pages.get(key)
+            if page is None:
+                self.misses += 1
+                return None
+            self._pages.move_to_end(key)
+            self.hits += 1
+            return page
+
+    def put(self, key: Hashable, page: bytes) -> None:
+        if len(page) > self.max_bytes:
+            _l.debug(f'Not caching a {len(page):,} byte page; it is over the limit.')
+            return
+        with self._lock:
+            old = self._pages.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._pages[key] = page
+            self._bytes += len(page)
+            self._evict()
+
+    def _evict(self) -> None:
+        while len(self._pages) > self.max_entries or self._bytes > self.max_bytes:
+            _, evicted = self._pages.popitem(last=False)
+            self._bytes -= len(evicted)
+
+    def resize(self, max_entries: int, max_bytes: int) -> None:
+        """Changes the limits, evicting the least recently used pages if they're now over."""
+        with self._lock:
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._pages.clear()
+            self._bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._pages)
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
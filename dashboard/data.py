@@ -1,250 +1,200 @@
-from typing import List, Sequence, Dict, Tuple, Any, Optional, cast
-import json
+from typing import Dict, Optional, Sequence
 from flask import current_app as app
-from collections import defaultdict
-from datetime import datetime
+import time
 
 import numpy
-import dateutil.parser
-from dateutil import tz
 
 from bokeh.models import ColumnDataSource
 
 import config
 from utils.timing import TimeIt
-
-
-def _latency_stats(latency: Dict[str, float]) -> str:
-    lo = float(latency['low'])
-    hi = float(latency['high'])
-    jt = float(latency['jitter'])
-    return f'{lo:.1f} - {hi:.1f} ({jt:.1f}) msec'
+from utils import rollups
+from .dataset import Dataset, Columns, local_time
+from . import smoothing
+from . import aggregate
 
 
 def proc_results(span_hrs: Optional[int]) -> Dict[str, ColumnDataSource]:
     """Returns a `ColumnDataSource` for each interface, keyed by nickname."""
     config.refresh()
-    filename = config.results_db
-    with TimeIt('Opening JSON results file', log=app.logger):
-        with open(filename, 'r') as f:
-            results: List[Dict[str, Any]] = json.loads(f.read())
-    results = list(reversed(results))
-    speeds: Dict[str, Dict[str, list]] = {}
-    last_succeeded: Dict[str, bool] = {}  # for keeping track of consecutive failures.
-    first_timestamp_sec = None
-    for idx in range(len(results)):
-        result = results[idx]
-        utc = dateutil.parser.isoparse(result['timestamp'])
-        if first_timestamp_sec is None:
-            first_timestamp_sec = utc.timestamp()
-        else:
-            if span_hrs is not None and (first_timestamp_sec-utc.timestamp()) / 60 / 60 > span_hrs:
-                break  # We've exceed the maximum time span.
-        nickname = result['nickname']
-        if nickname not in last_succeeded.keys():
-            # We need an initial value in case the first result is a failure.
-            # If the first result is a failure, we want to show it, so we set this to True
-            # regardless of the value of `success`.
-            last_succeeded[nickname] = True
-        success = bool(result['returnCode'] == 0)
-        if config.keep_consecutive_failures is False:  # need to check for consecutive failures.
-            # We need to check three things:
-            # 1. Did this test fail?
-            # 2. Did the previous test succeed? If so, we want to keep this failure.
-            # 3. Did the next test succeed? If so, we want to keep this failure.
-            # Otherwise, we discard this point, as it's got a failure on both sides.
-            if success is False:  # 1
-                if last_succeeded[nickname] is False:  # 2: last test also failed; do #3
-                    def get_next_success() -> bool:
-                        for n in range(idx+1, len(results)):  # 3a: look for next test.
-                            next_result = results[n]
-                            next_nickname = next_result['nickname']
-                            if next_nickname == nickname:
-                                # this is the next test
-                                next_success = bool(next_result['returnCode'] == 0)
-                                return next_success
-                        else:
-                            # Never found the next test. Abort.
-                            return True  # This ensures the current result is included.
-                    next_success = get_next_success()
-                    if next_success is False:  # 3b: next test is also a failure; skip.
-                        continue
-        last_succeeded[nickname] = success
-        if nickname not in speeds.keys():
-            speeds[nickname] = defaultdict(list)
-        speeds[nickname]['nickname'].append(nickname)
-        utc = utc.replace(tzinfo=tz.UTC)
-        local = utc.astimezone(tz.tzlocal())
-        speeds[nickname]['date'].append(local)
-        if success:
-            try:
-                speedtest = result['output']
-                download_mbps = float(speedtest['download']['bandwidth']) * 8 / 1000 / 1000
-                upload_mbps = float(speedtest['upload']['bandwidth']) * 8 / 1000 / 1000
-                if 'url' not in speedtest['result'].keys():
-                    url = ''
-                else:
-                    url = speedtest['result']['url']
-
-                speeds[nickname]['success'].append(True)
-                speeds[nickname]['download_mbps'].append(download_mbps)
-                speeds[nickname]['upload_mbps'].append(upload_mbps)
-                speeds[nickname]['url'].append(url)
-
-                lat = _latency_stats(speedtest['ping'])
-                speeds[nickname]['idle_latency_stats'].append(lat)
-                # It appears sometimes latency results are not in the record...
-                if 'latency' in speedtest['download'].keys():
-                    lat = _latency_stats(speedtest['download']['latency'])
-                    speeds[nickname]['down_latency_stats'].append(lat)
-                else:
-                    speeds[nickname]['down_latency_stats'].append('NT')
-
-                if 'latency' in speedtest['upload'].keys():
-                    lat = _latency_stats(speedtest['upload']['latency'])
-                    speeds[nickname]['up_latency_stats'].append(lat)
-                else:
-                    speeds[nickname]['up_latency_stats'].append('NT')
-            except KeyError as ke:
-                _l.error(f'`KeyError` while processing record {idx} from the bottom.')
-                _l.exception(ke)
-        else:
-            speeds[nickname]['success'].append(False)
-            speeds[nickname]['download_mbps'].append(0)
-            speeds[nickname]['upload_mbps'].append(0)
-            speeds[nickname]['url'].append('')
-            speeds[nickname]['idle_latency_stats'].append('NT')
-            speeds[nickname]['down_latency_stats'].append('NT')
-            speeds[nickname]['up_latency_stats'].append('NT')
-
-    sources: Dict[str, ColumnDataSource] = {}
-    for nickname in sorted(speeds.keys()):
-        data = {
-            'date': speeds[nickname]['date'],
-            'weekday': [d.weekday() for d in speeds[nickname]['date']],
-            'hour': [d.hour for d in speeds[nickname]['date']],
-            'success': speeds[nickname]['success'],
-            'download_mbps': speeds[nickname]['download_mbps'],
-            'upload_mbps': speeds[nickname]['upload_mbps'],
-            'nickname': speeds[nickname]['nickname'],
-            'url': speeds[nickname]['url'],
-            'idle_latency_stats': speeds[nickname]['idle_latency_stats'],
-            'down_latency_stats': speeds[nickname]['down_latency_stats'],
-            'up_latency_stats': speeds[nickname]['up_latency_stats'],
-        }
-        sources[nickname] = ColumnDataSource(data)
-    return sources
-
-
-def filter(sources: Dict[str, ColumnDataSource], span_hrs: int) -> Dict[str, ColumnDataSource]:
-    """Returns `sources` with data for only the most recent `span_hrs`."""
-    now = datetime.now().replace(tzinfo=tz.tzlocal())
-    cutoff_by_nickname: Dict[str, int] = {}
-
-    def find_span_idx(dates: List[datetime]) -> int:
-        for idx, date in enumerate(dates):
-            diff_hours = (now-date).total_seconds() / (60 * 60)
-            if diff_hours > span_hrs:
-                return idx
-        return len(dates) - 1
-
-    for nickname, data in sources.items():
-        data_dates: List[datetime] = data.data['date']
-        cutoff_by_nickname[nickname] = find_span_idx(data_dates)
-
-    # Now create new `ColumnDataSource`s cut off for the given span.
-    filtered: Dict[str, ColumnDataSource] = {}
-    for nickname, data in sources.items():
-        e = cutoff_by_nickname[nickname]
-        if e == 0:
-            continue  # don't show this interface
-        data = {field: seq[0:e] for field, seq in sources[nickname].data.items()}
-        filtered[nickname] = ColumnDataSource(data=data)
-    return filtered
-
-
-def _time_average(vals: Sequence[float], *, n_avg: int, keep_zero: bool) -> List[float]:
-    window = [vals[0]] * n_avg
-    averaged: List[float] = []
-    for i in range(len(vals)):
-        val = vals[i]
-        window.append(val)
-        window.pop(0)
-        if keep_zero and val == 0:
-            averaged.append(val)
-        else:
-            averaged.append(float(numpy.mean(window)))
-    return averaged
-
-
-def smooth(sources: Dict[str, ColumnDataSource]) -> Dict[str, ColumnDataSource]:
-    config.refresh()
-    n_avg = config.n_time_avg
+    if span_hrs is None:
+        start = None
+    else:
+        start = time.time() - span_hrs * 60 * 60
+    dataset = Dataset()
+    with TimeIt('Opening results file', log=app.logger):
+        dataset.update(config.results_db)
+    series, _ = dataset.window(start=start)
+    return {nickname: ColumnDataSource(data=columns) for nickname, columns in series.items()}
+
+
+def smooth(sources: Dict[str, Columns], *,
+           kernel: Optional[str] = None,
+           n_avg: Optional[int] = None) -> Dict[str, Columns]:
+    """
+    Smooths the transfer rates in `sources`, keeping failures at 0.
+
+    Parameters
+    ----------
+    sources : Dict[str, Columns]
+        Series of tests, oldest first.
+    kernel : Optional[str]
+        One of `smoothing.kernels`; None for `config.smoothing`.
+    n_avg : Optional[int]
+        Window size; None for `config.n_time_avg`.
+    """
+    kernel = config.smoothing if kernel is None else kernel
+    n_avg = config.n_time_avg if n_avg is None else n_avg
     if n_avg == 1:
         return sources
 
-    smoothed: Dict[str, ColumnDataSource] = {}
-    for source, cds in sources.items():
-        data: Dict[str, list] = {}
-        for key in cds.data.keys():
-            if key in ['download_mbps', 'upload_mbps']:
-                data[key] = _time_average(cast(Sequence[float], cds.data[key]),
-                                          n_avg=n_avg, keep_zero=True)
-            else:
-                data[key] = cast(list, cds.data[key])
-        smoothed[source] = ColumnDataSource(data=data)
+    smoothed: Dict[str, Columns] = {}
+    for source, columns in sources.items():
+        data = dict(columns)
+        for key in ['download_mbps', 'upload_mbps']:
+            data[key] = smoothing.smooth(columns[key], kernel=kernel, n=n_avg, keep_zero=True)
+        smoothed[source] = data
     return smoothed
 
 
-def down_up_by_val(sources: Dict[str, ColumnDataSource],
-                   val_name: str) -> Dict[str, ColumnDataSource]:
-    by_val_speeds: Dict[str, Dict[str, list]] = {}
+series_columns = ('date', 'nickname', 'success', 'download_mbps', 'upload_mbps', 'url',
+                  'idle_latency_stats', 'down_latency_stats', 'up_latency_stats',
+                  'num_tests', 'num_failed', 'download_min', 'download_max', 'upload_min',
+                  'upload_max')
+"""Columns of the tests (or buckets of them; see `Dataset.window`) sent to the log plot."""
+
+outage_columns = ('start', 'end', 'ongoing', 'num_failed', 'duration_min', 'nickname')
+"""Columns of the outages sent to the log plot."""
+
+
+def with_ranges(sources: Dict[str, Columns]) -> Dict[str, Columns]:
+    """
+    Adds the columns of buckets of tests (see `Dataset.window`) to individual tests, as if each
+    were a bucket of its own, so the log plot gets the same columns at every level.
+    """
+    ranged: Dict[str, Columns] = {}
+    for nickname, columns in sources.items():
+        data = dict(columns)
+        data['num_tests'] = numpy.ones(len(columns['success']), dtype=numpy.int64)
+        data['num_failed'] = (~columns['success']).astype(numpy.int64)
+        for d in ('download', 'upload'):
+            data[f'{d}_min'] = data[f'{d}_max'] = columns[f'{d}_mbps']
+        ranged[nickname] = data
+    return ranged
+
+
+def to_json(sources: Dict[str, Columns], columns: Sequence[str]) -> Dict[str, Dict[str, list]]:
+    """
+    Converts `columns` of `sources` to JSON-serializable lists. Dates become milliseconds since the
+    epoch (of local time, as Bokeh expects), rates are rounded to 0.01 Mbps, and bytes (from a
+    snapshot) are decoded. Columns a source doesn't have (e.g. the URL of a bucket of tests) are
+    sent as empty strings.
+    """
+    converted: Dict[str, Dict[str, list]] = {}
     for nickname, source in sources.items():
-        vals = source.data[val_name]
-        dns = source.data['download_mbps']
-        ups = source.data['upload_mbps']
-        successes = source.data['success']
-        by_val_dn_up: Dict[int, List[Tuple[float, float]]] = defaultdict(list)
-        fails: Dict[int, int] = defaultdict(lambda: 0)
-        for val, dn, up, suc in zip(vals, dns, ups, successes):
-            by_val_dn_up[val].append((dn, up))
-            if not suc:
-                fails[val] += 1
-        for k in by_val_dn_up.keys():
-            if k not in fails.keys():
-                fails[k] = 0
-        by_val_dn_up = dict(sorted(by_val_dn_up.items(), key=lambda i: i[0]))
-
-        dn_by_val = [[i[0] for i in by_val_dn_up[k]] for k in by_val_dn_up.keys()]
-        up_by_val = [[i[1] for i in by_val_dn_up[k]] for k in by_val_dn_up.keys()]
-        mean_dn_by_val = [numpy.mean(d) for d in dn_by_val]
-        mean_up_by_val = [numpy.mean(u) for u in up_by_val]
-        std_dn_by_val = [numpy.std(d) for d in dn_by_val]
-        std_up_by_val = [numpy.std(u) for u in up_by_val]
-        n_by_val = [len(d) for d in dn_by_val]
-        fails_by_val = [f for f in fails.values()]
-
-        by_val_speeds[nickname] = {}
-        by_val_speeds[nickname][val_name] = list(by_val_dn_up.keys())
-        by_val_speeds[nickname]['download_mbps_mean'] = mean_dn_by_val
-        by_val_speeds[nickname]['upload_mbps_mean'] = mean_up_by_val
-        by_val_speeds[nickname]['download_mbps_std'] = std_dn_by_val
-        by_val_speeds[nickname]['upload_mbps_std'] = std_up_by_val
-        by_val_speeds[nickname]['num_tests'] = n_by_val
-        by_val_speeds[nickname]['num_tests_failed'] = fails_by_val
-
+        data: Dict[str, list] = {}
+        n = len(next(iter(source.values()))) if source else 0
+        for name in columns:
+            if name not in source:
+                data[name] = [''] * n
+                continue
+            column = numpy.asarray(source[name])
+            if column.dtype.kind == 'M':
+                column = column.astype('datetime64[ms]').astype(numpy.int64)
+            elif column.dtype.kind == 'f':
+                column = numpy.round(column.astype(numpy.float64), 2)
+            elif column.dtype.kind == 'S':
+                column = numpy.char.decode(column, 'utf-8')
+            data[name] = column.tolist()
+        converted[nickname] = data
+    return converted
+
+
+key_sizes = {'hour': 24, 'weekday': 7}
+"""Number of possible values of the columns that results can be grouped by."""
+
+
+def down_up_by_val(sources: Dict[str, Columns],
+                   val_name: str) -> Dict[str, ColumnDataSource]:
+    """
+    Returns transfer rate statistics (see `aggregate.group_by`) for each value of column
+    `val_name` (one of `key_sizes`) that has tests, for each interface.
+    """
     by_val: Dict[str, ColumnDataSource] = {}
-    for nickname in sorted(by_val_speeds.keys()):
-        n_points = len(by_val_speeds[nickname][val_name])
-        data = {'nickname': [nickname] * n_points,
-                val_name: by_val_speeds[nickname][val_name],
-                'download_mbps_mean': by_val_speeds[nickname]['download_mbps_mean'],
-                'upload_mbps_mean': by_val_speeds[nickname]['upload_mbps_mean'],
-                'download_mbps_std': by_val_speeds[nickname]['download_mbps_std'],
-                'upload_mbps_std': by_val_speeds[nickname]['upload_mbps_std'],
-                'num_tests': by_val_speeds[nickname]['num_tests'],
-                'num_tests_failed': by_val_speeds[nickname]['num_tests_failed'],
-                }
+    for nickname in sorted(sources.keys()):
+        source = sources[nickname]
+        stats = aggregate.group_by([source[val_name]], (key_sizes[val_name],),
+                                   {k: source[k] for k in ('download_mbps', 'upload_mbps')},
+                                   source['success'])
+        present = numpy.flatnonzero(stats['num_tests'])
+        data = {'nickname': [nickname] * len(present),
+                val_name: present}
+        data.update({k: v[present] for k, v in stats.items()})
         by_val[nickname] = ColumnDataSource(data)
+    return by_val
+
 
+def down_up_by_val_from_rollups(filename: str, val_name: str,
+                                start: Optional[float],
+                                end: Optional[float]) -> Dict[str, ColumnDataSource]:
+    """
+    Same as `down_up_by_val`, from the hourly rollups of results file `filename` instead of
+    individual tests. Buckets are included if they overlap `[start, end)` (seconds since the epoch;
+    None for no limit). Every failed test is counted, regardless of
+    `config.keep_consecutive_failures`. By weekday, the daily rollups fill in where the hourly ones
+    no longer go back far enough (see `config.retention_days`).
+    """
+    by_val: Dict[str, ColumnDataSource] = {}
+    for nickname in rollups.nicknames(filename):
+        records = rollups.load(filename, nickname, 'hourly', start, end)
+        # When each bucket is, for grouping by local time.
+        times = records['start']
+        if val_name == 'weekday':
+            first = rollups.first_start(filename, nickname, 'hourly')
+            daily_end = end
+            if first is not None:
+                first_day = int(rollups.bucket_start(numpy.array(first), 'daily'))
+                daily_end = first_day if end is None else min(end, first_day)
+            daily = rollups.load(filename, nickname, 'daily', start, daily_end)
+            records = numpy.concatenate((daily, records))
+            # UTC days straddle two local ones; go by the middle of the day.
+            times = numpy.concatenate((daily['start'] + 12 * 60 * 60, times))
+        if len(records) == 0:
+            continue
+        local = local_time(times.astype('datetime64[s]'))
+        day = local.astype('datetime64[D]')
+        if val_name == 'hour':
+            key = (local - day).astype('timedelta64[h]').astype(numpy.int64)
+        else:
+            key = (day.astype(numpy.int64) + 3) % 7  # 1970-01-01 was a Thursday.
+        stats = aggregate.group_sums(
+            [key], (key_sizes[val_name],), records['count'], records['failures'],
+            {f'{d}_mbps': (records[f'{d}_sum'], records[f'{d}_sumsq'], records[f'{d}_sketch'])
+             for d in ('download', 'upload')})
+        present = numpy.flatnonzero(stats['num_tests'])
+        data = {'nickname': [nickname] * len(present),
+                val_name: present}
+        data.update({k: v[present] for k, v in stats.items()})
+        by_val[nickname] = ColumnDataSource(data)
     return by_val
+
+
+def down_up_by_hour_of_week(sources: Dict[str, Columns]) -> Dict[str, ColumnDataSource]:
+    """
+    Returns transfer rate statistics (see `aggregate.group_by`) for each hour of the week, for each
+    interface. Every hour is included; those without tests have NaN statistics.
+    """
+    by_hour: Dict[str, ColumnDataSource] = {}
+    shape = (key_sizes['weekday'], key_sizes['hour'])
+    weekday, hour = numpy.indices(shape)
+    for nickname in sorted(sources.keys()):
+        source = sources[nickname]
+        stats = aggregate.group_by([source['weekday'], source['hour']], shape,
+                                   {k: source[k] for k in ('download_mbps', 'upload_mbps')},
+                                   source['success'])
+        data = {'nickname': [nickname] * weekday.size,
+                'weekday': weekday.ravel(),
+                'hour': hour.ravel()}
+        data.update({k: v.ravel() for k, v in stats.items()})
+        by_hour[nickname] = ColumnDataSource(data)
+    return by_hour
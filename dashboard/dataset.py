@@ -0,0 +1,732 @@
+from typing import Sequence, Dict, Any, Optional, Tuple
+import logging
+import time
+from datetime import datetime
+
+import numpy
+import dateutil.parser
+from dateutil import tz
+
+import config
+from utils import columnar_file
+from utils import results_store
+from utils import rollups
+from . import snapshot
+from utils.timing import TimeIt
+
+_l = logging.getLogger(__name__)
+
+
+def _latency_stats(latency: Dict[str, float]) -> str:
+    lo = float(latency['low'])
+    hi = float(latency['high'])
+    jt = float(latency['jitter'])
+    return f'{lo:.1f} - {hi:.1f} ({jt:.1f}) msec'
+
+
+Columns = Dict[str, numpy.ndarray]
+"""Named columns of equal length."""
+
+_string_columns = ('url', 'idle_latency_stats', 'down_latency_stats', 'up_latency_stats')
+
+_test_columns = ('time', 'date', 'success', 'download_mbps', 'upload_mbps') + _string_columns
+"""The columns (see `_ingest`) kept for each interface's tests."""
+
+
+def _fields(result: Dict[str, Any]) -> Tuple[str, str, bool, float, float, str, str, str, str]:
+    """
+    Pulls the fields the dashboard plots out of a result: `(timestamp, nickname, success,
+    download bandwidth, upload bandwidth, url, idle latency, download latency, upload latency)`.
+    Bandwidths are in bytes per second, as `speedtest` reports them.
+    """
+    timestamp = result['timestamp']
+    nickname = result['nickname']
+    if result['returnCode'] != 0:
+        return timestamp, nickname, False, 0.0, 0.0, '', 'NT', 'NT', 'NT'
+    speedtest = result['output']
+    download = speedtest['download']
+    upload = speedtest['upload']
+    # It appears sometimes latency results are not in the record...
+    return (timestamp, nickname, True,
+            float(download['bandwidth']), float(upload['bandwidth']),
+            speedtest['result'].get('url', ''),
+            _latency_stats(speedtest['ping']),
+            _latency_stats(download['latency']) if 'latency' in download else 'NT',
+            _latency_stats(upload['latency']) if 'latency' in upload else 'NT')
+
+
+def _parse_timestamps(timestamps: Sequence[str]) -> numpy.ndarray:
+    """Converts the results' ISO 8601 UTC timestamps to `datetime64[ms]`."""
+    try:
+        # numpy parses ISO 8601 itself, but won't take the "Z".
+        return numpy.array([t[:-1] if t.endswith('Z') else t for t in timestamps],
+                           dtype='datetime64[ms]')
+    except ValueError:
+        _l.warning('Unusual timestamps; parsing them one by one.')
+        return numpy.array([dateutil.parser.isoparse(t).replace(tzinfo=None) for t in timestamps],
+                           dtype='datetime64[ms]')
+
+
+def _utc_offsets(utc: numpy.ndarray) -> numpy.ndarray:
+    """
+    Returns the local time zone's UTC offset at each of the given times (`datetime64[ms]`) as
+    `timedelta64[ms]`. The zone is consulted once per day, and once per hour on days when the offset
+    changes.
+    """
+    local = tz.tzlocal()
+
+    def offset_ms(t: numpy.datetime64) -> int:
+        utc_dt = t.astype('datetime64[ms]').astype(datetime).replace(tzinfo=tz.UTC)
+        return int(utc_dt.astimezone(local).utcoffset().total_seconds() * 1000)
+
+    days, day_idx = numpy.unique(utc.astype('datetime64[D]'), return_inverse=True)
+    at_start = numpy.array([offset_ms(d) for d in days], dtype=numpy.int64)
+    at_end = numpy.array([offset_ms(d + 1) for d in days], dtype=numpy.int64)
+    offsets = at_start[day_idx]
+    for day in numpy.flatnonzero(at_start != at_end):
+        on_day = day_idx == day
+        hours, hour_idx = numpy.unique(utc[on_day].astype('datetime64[h]'), return_inverse=True)
+        offsets[on_day] = numpy.array([offset_ms(h) for h in hours], dtype=numpy.int64)[hour_idx]
+    return offsets.astype('timedelta64[ms]')
+
+
+def local_time(utc: numpy.ndarray) -> numpy.ndarray:
+    """Converts UTC `datetime64`s to local wall clock time."""
+    return utc + _utc_offsets(utc)
+
+
+def _ingest(results: Sequence[Dict[str, Any]],
+            nickname_ids: Dict[str, int]) -> Dict[str, numpy.ndarray]:
+    """
+    Turns results into arrays, one per column:
+
+    * `time` (`datetime64[ms]`, UTC) and `date` (`datetime64[ms]`, local wall clock time, which is
+      how Bokeh shows it).
+    * `nickname_id` (`int16`), an index into the nicknames; `nickname_ids` gets any new ones.
+    * `success` (`bool`).
+    * `download_mbps` and `upload_mbps` (`float32`), 0 for failed tests.
+    * `url` and the latency stats (strings).
+    """
+    rows = []
+    for idx, result in enumerate(results):
+        try:
+            rows.append(_fields(result))
+        except KeyError as ke:
+            _l.error(f'`KeyError` while processing new record {idx}; skipping it.')
+            _l.exception(ke)
+    if rows:
+        columns = list(zip(*rows))
+    else:
+        columns = [()] * 9
+    timestamps, nicknames, success, download, upload = columns[:5]
+    utc = _parse_timestamps(timestamps)
+    for nickname in nicknames:
+        nickname_ids.setdefault(nickname, len(nickname_ids))
+    data = {
+        'time': utc,
+        'date': local_time(utc),
+        'nickname_id': numpy.array([nickname_ids[n] for n in nicknames], dtype=numpy.int16),
+        'success': numpy.array(success, dtype=bool),
+        'download_mbps': (numpy.array(download, dtype=numpy.float64) * 8e-6).astype(numpy.float32),
+        'upload_mbps': (numpy.array(upload, dtype=numpy.float64) * 8e-6).astype(numpy.float32),
+    }
+    for name, column in zip(_string_columns, columns[5:]):
+        data[name] = numpy.array(column, dtype=object)
+    return data
+
+
+def _latency_column(rows: numpy.ndarray, prefix: str, ok: numpy.ndarray) -> numpy.ndarray:
+    """`_latency_stats` of each row of a columnar file, or "NT" where `ok` is False."""
+    stats = numpy.full(len(rows), 'NT', dtype=object)
+    low, high, jitter = (rows[f'{prefix}_{stat}'][ok].tolist()
+                         for stat in ('low', 'high', 'jitter'))
+    stats[ok] = [f'{lo:.1f} - {hi:.1f} ({jt:.1f}) msec' for lo, hi, jt in zip(low, high, jitter)]
+    return stats
+
+
+def _ingest_table(table: columnar_file.Table, first: int,
+                  nickname_ids: Dict[str, int]) -> Dict[str, numpy.ndarray]:
+    """`_ingest` for the rows of a columnar file from `first` on, read as columns."""
+    rows = table.rows[first:]
+    nickname_codes, inverse = numpy.unique(rows['nickname'], return_inverse=True)
+    for code in nickname_codes:
+        nickname_ids.setdefault(table.strings['nickname'][code], len(nickname_ids))
+    ids = numpy.array([nickname_ids[table.strings['nickname'][code]] for code in nickname_codes],
+                      dtype=numpy.int16)
+    utc = numpy.round(rows['timestamp'] * 1000).astype(numpy.int64).astype('datetime64[ms]')
+    success = rows['return_code'] == 0
+    data = {
+        'time': utc,
+        'date': local_time(utc),
+        'nickname_id': ids[inverse.reshape(-1)],
+        'success': success,
+    }
+    for d in ('download', 'upload'):
+        mbps = rows[f'{d}_bandwidth'].astype(numpy.float64) * 8e-6
+        data[f'{d}_mbps'] = numpy.where(success, mbps, 0).astype(numpy.float32)
+    data['url'] = numpy.where(success, numpy.char.decode(rows['url'], 'utf-8'), '').astype(object)
+    data['idle_latency_stats'] = _latency_column(rows, 'ping', success)
+    # Like `_fields`, a download or upload without latency results (NaN) shows "NT".
+    for name, d in (('down_latency_stats', 'download'), ('up_latency_stats', 'upload')):
+        data[name] = _latency_column(rows, f'{d}_latency', success
+                                     & ~numpy.isnan(rows[f'{d}_latency_low']))
+    return data
+
+
+def _failure_runs(success: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Finds the runs of consecutive failures in a chronological series of tests.
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, numpy.ndarray]
+        The index of the first failure of each run, and the index just past its last failure.
+    """
+    edges = numpy.diff(numpy.concatenate(([0], (~success).astype(numpy.int8), [0])))
+    return numpy.flatnonzero(edges == 1), numpy.flatnonzero(edges == -1)
+
+
+def _keep(success: numpy.ndarray) -> numpy.ndarray:
+    """
+    Which points to show, per `config.keep_consecutive_failures`. When it's False, only the first
+    and last failure of each run of failures are shown, so a failure is hidden if the tests before
+    and after it also failed.
+    """
+    if config.keep_consecutive_failures:
+        return numpy.ones(len(success), dtype=bool)
+    keep = success.copy()
+    starts, ends = _failure_runs(success)
+    keep[starts] = True
+    keep[ends - 1] = True
+    return keep
+
+
+def _to_datetime64(epoch_sec: Optional[float]) -> Optional[numpy.datetime64]:
+    return None if epoch_sec is None else numpy.datetime64(int(epoch_sec * 1000), 'ms')
+
+
+def _series(columns: Columns, idx: numpy.ndarray, nickname: str) -> Tuple[Columns, Columns]:
+    """
+    Builds the plotted columns and the outages (see `Dataset.window`) of one interface, from the
+    indices of its results in time order.
+    """
+    success = columns['success'][idx]
+
+    run_starts, run_ends = _failure_runs(success)
+    start_idx = idx[run_starts]
+    # The test that ended the outage, or its last failure if there isn't one yet.
+    end_idx = idx[numpy.minimum(run_ends, len(idx) - 1)]
+    starts = columns['date'][start_idx]
+    ends = columns['date'][end_idx]
+    outages = {
+        'start': starts,
+        'end': ends,
+        'start_time': columns['time'][start_idx],
+        'end_time': columns['time'][end_idx],
+        'ongoing': run_ends == len(idx),
+        'num_failed': run_ends - run_starts,
+        'duration_min': (ends - starts).astype(numpy.float64) / (60 * 1000),
+        'nickname': numpy.full(len(starts), nickname, dtype=object),
+    }
+
+    idx = idx[_keep(success)]
+    date = columns['date'][idx]
+    day = date.astype('datetime64[D]')
+    series = {
+        'time': columns['time'][idx],
+        'date': date,
+        # 1970-01-01 was a Thursday.
+        'weekday': (day.astype(numpy.int64) + 3) % 7,
+        'hour': (date - day).astype('timedelta64[h]').astype(numpy.int64),
+        'nickname': numpy.full(len(idx), nickname, dtype=object),
+    }
+    for name in ('success', 'download_mbps', 'upload_mbps') + _string_columns:
+        series[name] = columns[name][idx]
+    return series, outages
+
+
+levels: Dict[str, int] = {'10min': 10 * 60, 'hourly': 60 * 60, 'daily': 24 * 60 * 60}
+"""
+Bucket width in seconds of each level of the multi-resolution pyramid (see `Dataset.window`),
+finest first. Buckets are aligned in UTC.
+"""
+
+_pyramid_columns = ('time', 'success', 'download_mbps', 'upload_mbps')
+"""The columns of the tests that the pyramid summarizes."""
+
+
+def _reduce(ufunc: numpy.ufunc, values: numpy.ndarray, first: numpy.ndarray) -> numpy.ndarray:
+    """`ufunc.reduceat`, which doesn't take empty arrays."""
+    return ufunc.reduceat(values, first) if len(first) else values[:0]
+
+
+def _buckets(tests: Columns, width_sec: int, nickname: str) -> Columns:
+    """Summarizes chronological tests in buckets of `width_sec`; see `Dataset.window`."""
+    bucket = tests['time'].astype('datetime64[s]').astype(numpy.int64) // width_sec
+    first = numpy.flatnonzero(numpy.diff(bucket, prepend=bucket[:1] - 1))
+    success = tests['success']
+    num_tests = numpy.diff(numpy.append(first, len(bucket)))
+    num_ok = _reduce(numpy.add, success.astype(numpy.int64), first)
+    utc = (bucket[first] * width_sec).astype('datetime64[s]').astype('datetime64[ms]')
+    data = {
+        'time': utc,
+        'date': local_time(utc),
+        'nickname': numpy.full(len(first), nickname, dtype=object),
+        'success': num_ok > 0,
+        'num_tests': num_tests,
+        'num_failed': num_tests - num_ok,
+    }
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        for d in ('download', 'upload'):
+            vals = tests[f'{d}_mbps'].astype(numpy.float64)
+            total = _reduce(numpy.add, numpy.where(success, vals, 0.0), first)
+            lo = _reduce(numpy.minimum, numpy.where(success, vals, numpy.inf), first)
+            hi = _reduce(numpy.maximum, numpy.where(success, vals, -numpy.inf), first)
+            # Buckets where every test failed are at 0, like failed tests.
+            data[f'{d}_mbps'] = numpy.where(num_ok > 0, total / num_ok, 0).astype(numpy.float32)
+            data[f'{d}_min'] = numpy.where(num_ok > 0, lo, 0).astype(numpy.float32)
+            data[f'{d}_max'] = numpy.where(num_ok > 0, hi, 0).astype(numpy.float32)
+    return data
+
+
+def _from_rollups(records: numpy.ndarray, nickname: str) -> Columns:
+    """Converts rollup records (see `utils.rollups`) to buckets like `_buckets` makes."""
+    utc = records['start'].astype('datetime64[s]').astype('datetime64[ms]')
+    num_tests = records['count'].astype(numpy.int64)
+    num_failed = records['failures'].astype(numpy.int64)
+    num_ok = num_tests - num_failed
+    ok = num_ok > 0
+    data = {
+        'time': utc,
+        'date': local_time(utc),
+        'nickname': numpy.full(len(records), nickname, dtype=object),
+        'success': ok,
+        'num_tests': num_tests,
+        'num_failed': num_failed,
+    }
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        for d in ('download', 'upload'):
+            mean = records[f'{d}_sum'] / num_ok
+            data[f'{d}_mbps'] = numpy.where(ok, mean, 0).astype(numpy.float32)
+            data[f'{d}_min'] = numpy.where(ok, records[f'{d}_min'], 0).astype(numpy.float32)
+            data[f'{d}_max'] = numpy.where(ok, records[f'{d}_max'], 0).astype(numpy.float32)
+    return data
+
+
+def _with_history(filename: str, nickname: str, pyramid: Dict[str, Columns]) -> Dict[str, Columns]:
+    """
+    Puts the buckets from the rollups that are older than the tests (because those were compacted
+    away; see `results_store.compact`) in front of each level of `pyramid` that the rollups have.
+    """
+    pyramid = dict(pyramid)
+    for level in [level for level in levels.keys() if level in rollups.levels]:
+        buckets = pyramid[level]
+        end = None if not len(buckets['time']) \
+            else int(buckets['time'][0].astype('datetime64[s]').astype(numpy.int64))
+        records = rollups.load(filename, nickname, level, end=end)
+        if len(records):
+            older = _from_rollups(records, nickname)
+            pyramid[level] = {name: numpy.concatenate((older[name], column))
+                              for name, column in buckets.items()}
+    return pyramid
+
+
+_never = numpy.datetime64(numpy.iinfo(numpy.int64).max, 'ms')
+
+
+def _coverage(views: Dict[str, Tuple[Columns, Columns]],
+              pyramids: Dict[str, Dict[str, Columns]]) -> Dict[str, numpy.datetime64]:
+    """
+    The earliest time of each level ("raw" or one of `levels`) that doesn't go back as far as a
+    coarser one, i.e. whose older data was compacted away.
+    """
+    order = ('raw',) + tuple(levels.keys())
+    earliest: Dict[str, Optional[int]] = {}
+    for level in order:
+        tables = [tests for tests, _ in views.values()] if level == 'raw' \
+            else [pyramid[level] for pyramid in pyramids.values()]
+        earliest[level] = min((int(t['time'][0].astype('datetime64[ms]').astype(numpy.int64))
+                               for t in tables if len(t['time'])), default=None)
+    coverage: Dict[str, numpy.datetime64] = {}
+    for i, level in enumerate(order):
+        first = earliest[level]
+        for coarser in order[i + 1:]:
+            older = earliest[coarser]
+            width_ms = levels[coarser] * 1000
+            if older is not None and (first is None or older < first // width_ms * width_ms):
+                coverage[level] = _never if first is None else numpy.datetime64(first, 'ms')
+                break
+    return coverage
+
+
+def _decoded(column: numpy.ndarray) -> numpy.ndarray:
+    """Converts a string column of a snapshot (see `Dataset.load`) back to objects."""
+    return numpy.char.decode(column, 'utf-8').astype(object) if column.dtype.kind == 'S' \
+        else column
+
+
+class _Growing:
+    """
+    Columns that rows are added to at the end without copying the ones already there: each column
+    is a buffer with room to spare, of which the first `len` rows are in use. The last rows can be
+    replaced too, which is how the buckets and the run of failures that new tests extend are
+    updated.
+    """
+
+    def __init__(self, columns: Columns) -> None:
+        self._buffers = dict(columns)
+        self._len = len(next(iter(columns.values())))
+
+    def __len__(self) -> int:
+        return self._len
+
+    @property
+    def columns(self) -> Columns:
+        """Views of the rows in use."""
+        return {name: buffer[:self._len] for name, buffer in self._buffers.items()}
+
+    def replace_tail(self, start: int, rows: Columns) -> None:
+        """Replaces the rows from `start` on with `rows`."""
+        end = start + len(next(iter(rows.values())))
+        capacity = len(next(iter(self._buffers.values())))
+        # A snapshot's columns are read-only, and their strings are bytes.
+        if end > capacity or not all(b.flags.writeable for b in self._buffers.values()):
+            capacity = max(end, 2 * capacity, 64)
+            grown: Columns = {}
+            for name, buffer in self._buffers.items():
+                dtype = object if buffer.dtype.kind == 'S' \
+                    else numpy.result_type(buffer, rows[name])
+                grown[name] = numpy.empty(capacity, dtype=dtype)
+                grown[name][:start] = _decoded(buffer[:start])
+            self._buffers = grown
+        for name, buffer in self._buffers.items():
+            buffer[start:end] = rows[name]
+        self._len = end
+
+
+class _Interface:
+    """The tests of one interface, oldest first, and what `Dataset.window` shows of them."""
+
+    def __init__(self, nickname: str, tests: Columns, series: Columns, outages: Columns,
+                 pyramid: Dict[str, Columns]) -> None:
+        self.nickname = nickname
+        self.tests = _Growing(tests)
+        """`_test_columns` of the tests."""
+        self.series = _Growing(series)
+        self.outages = _Growing(outages)
+        """The output of `_series`."""
+        self.pyramid = {level: _Growing(buckets) for level, buckets in pyramid.items()}
+        """The buckets of each of `levels`."""
+
+    @classmethod
+    def empty(cls, nickname: str) -> '_Interface':
+        tests = {name: column for name, column in _ingest([], {}).items() if name in _test_columns}
+        series, outages = _series(tests, numpy.arange(0), nickname)
+        return cls(nickname, tests, series, outages,
+                   {level: _buckets(tests, width_sec, nickname)
+                    for level, width_sec in levels.items()})
+
+    def add(self, new: Columns) -> None:
+        """
+        Adds tests, sorted by time, and recomputes the outages, points and buckets from the first
+        one they change onwards.
+        """
+        tests = self.tests.columns
+        first = int(numpy.searchsorted(tests['time'], new['time'][0], side='right'))
+        if first < len(self.tests):
+            # Tests finish out of order by up to `config.max_disorder_sec`, so only the ones since
+            # the earliest new one need sorting again.
+            tail = {name: numpy.concatenate((_decoded(column[first:]), new[name]))
+                    for name, column in tests.items()}
+            order = numpy.argsort(tail['time'], kind='stable')
+            new = {name: column[order] for name, column in tail.items()}
+        self.tests.replace_tail(first, new)
+        tests = self.tests.columns
+        times, success = tests['time'], tests['success']
+
+        # Back up to the start of the run of failures the changes are in (whose first and last
+        # failures are shown and which is one outage), and past tests at the same time, so that
+        # everything before it stays as it is.
+        redo = first
+        while redo > 0 and (not success[redo - 1] or times[redo - 1] == times[redo]):
+            redo -= 1
+        series, outages = _series(tests, numpy.arange(redo, len(times)), self.nickname)
+        since = times[redo]
+        self.series.replace_tail(
+            int(numpy.searchsorted(self.series.columns['time'], since, side='left')), series)
+        self.outages.replace_tail(
+            int(numpy.searchsorted(self.outages.columns['start_time'], since, side='left')),
+            outages)
+
+        # Only the buckets from the one the first change falls in onwards.
+        since_ms = int(times[first].astype('datetime64[ms]').astype(numpy.int64))
+        for level, width_sec in levels.items():
+            width_ms = width_sec * 1000
+            cut = numpy.datetime64(since_ms // width_ms * width_ms, 'ms')
+            recent = int(numpy.searchsorted(times, cut, side='left'))
+            buckets = _buckets({name: tests[name][recent:] for name in _pyramid_columns},
+                               width_sec, self.nickname)
+            self.pyramid[level].replace_tail(
+                int(numpy.searchsorted(self.pyramid[level].columns['time'], cut, side='left')),
+                buckets)
+
+    def add_history(self, filename: str) -> None:
+        """Puts the buckets from the rollups in front of the pyramid; see `_with_history`."""
+        pyramid = _with_history(filename, self.nickname,
+                                {level: buckets.columns for level, buckets in self.pyramid.items()})
+        self.pyramid = {level: _Growing(buckets) for level, buckets in pyramid.items()}
+
+    def views(self) -> Tuple[Tuple[Columns, Columns], Dict[str, Columns]]:
+        """The series and outages, and the pyramid, as columns."""
+        return ((self.series.columns, self.outages.columns),
+                {level: buckets.columns for level, buckets in self.pyramid.items()})
+
+
+class Dataset:
+    """
+    The processed contents of a results file, kept in memory as arrays. `update` only processes
+    what's been appended since the previous call; if the file was rewritten or truncated, it starts
+    over. Each interface's tests are also summarized at the resolutions in `levels`. New tests are
+    added to the end of each interface's arrays, and only the last tests (those that new ones
+    arrived out of order with), the last run of failures and the buckets that new tests fall in are
+    recomputed. Where the results file no longer goes back as far as its rollups do (see
+    `config.retention_days`), the levels that the rollups have too start with the rollups; see
+    `covers`.
+
+    `update` can run in one thread while others call `window`. It replaces the views that `window`
+    returns with new ones rather than resizing them, but it rewrites the last few rows (the
+    recomputed ones above) in place, so a caller can see those change under it.
+    """
+
+    def __init__(self) -> None:
+        self._filename: Optional[str] = None
+        self._cursor: Optional[results_store.Cursor] = None
+        self._interfaces: Dict[str, _Interface] = {}
+        """Keyed by nickname."""
+        self._views: Dict[str, Tuple[Columns, Columns]] = {}
+        """The series and outages of each interface (see `_Interface.views`), by nickname."""
+        self._pyramids: Dict[str, Dict[str, Columns]] = {}
+        """The pyramid of each interface (see `_Interface.views`), by nickname."""
+        self._coverage: Dict[str, numpy.datetime64] = {}
+        """The output of `_coverage`."""
+        self.version = 0
+        """Goes up by one every time the data changes. Only meaningful within this process."""
+        self.modified = time.time()
+        """When the data last changed, in seconds since the epoch."""
+
+    def __len__(self) -> int:
+        return sum(len(interface.tests) for interface in self._interfaces.values())
+
+    @property
+    def identity(self) -> Tuple[Optional[str], Optional[Tuple[int, ...]], float]:
+        """
+        Identifies the data across processes, unlike `version`: the results file, where in it the
+        data goes up to, and when it was processed. A snapshot carries all three, so every process
+        that loads it has the same identity as the one that saved it.
+        """
+        return (self._filename, None if self._cursor is None else tuple(self._cursor),
+                self.modified)
+
+    def update(self, filename: str) -> int:
+        """
+        Brings the data up to date with `filename`.
+
+        Returns
+        -------
+        int
+            The number of new results.
+        """
+        if filename != self._filename:
+            self._filename = filename
+            self._cursor = None
+        table: Optional[columnar_file.Table] = None
+        first = 0
+        with TimeIt('Reading new results', log=_l):
+            if results_store.is_columnar(filename):
+                # Its columns are used as they are, without making result dictionaries of them.
+                table, first, self._cursor, restart = results_store.read_new_table(filename,
+                                                                                   self._cursor)
+                results: Sequence[Dict[str, Any]] = []
+                num_new = 0 if table is None else len(table) - first
+            else:
+                results, self._cursor, restart = results_store.read_new(filename, self._cursor)
+                num_new = len(results)
+        if not num_new and not restart:
+            return 0
+        if restart:
+            _l.debug(f'Loading all of "{filename}".')
+            # Interfaces whose results were all compacted away still have rollups.
+            interfaces = {nickname: _Interface.empty(nickname)
+                          for nickname in rollups.nicknames(filename)}
+        else:
+            interfaces = self._interfaces
+        if num_new:
+            with TimeIt(f'Processing {num_new} results', log=_l):
+                nickname_ids: Dict[str, int] = {}
+                new = _ingest(results, nickname_ids) if table is None \
+                    else _ingest_table(table, first, nickname_ids)
+                for nickname, nickname_id in nickname_ids.items():
+                    idx = numpy.flatnonzero(new['nickname_id'] == nickname_id)
+                    idx = idx[numpy.argsort(new['time'][idx], kind='stable')]
+                    if nickname not in interfaces:
+                        interfaces[nickname] = _Interface.empty(nickname)
+                    interfaces[nickname].add({name: new[name][idx] for name in _test_columns})
+        if restart:
+            for interface in interfaces.values():
+                interface.add_history(filename)
+        views = {nickname: interfaces[nickname].views() for nickname in sorted(interfaces)}
+        self._interfaces = interfaces
+        self._views = {nickname: series for nickname, (series, _) in views.items()}
+        self._pyramids = {nickname: pyramid for nickname, (_, pyramid) in views.items()}
+        self._coverage = _coverage(self._views, self._pyramids)
+        self.modified = time.time()
+        self.version += 1
+        return num_new
+
+    def reset(self) -> None:
+        """
+        Makes the next `update` process every result again, e.g. because
+        `config.keep_consecutive_failures` changed.
+        """
+        self._cursor = None
+
+    def window(self, start: Optional[float] = None,
+               end: Optional[float] = None,
+               level: str = 'raw') -> Tuple[Dict[str, Columns], Dict[str, Columns]]:
+        """
+        Returns the data for the time range `[start, end)`, as views into the dataset; nothing is
+        copied, so the arrays must not be modified.
+
+        Parameters
+        ----------
+        start : Optional[float]
+            Seconds since the epoch, or None to start at the beginning.
+        end : Optional[float]
+            Seconds since the epoch, or None to go to the end.
+        level : str
+            "raw" for individual tests, or one of `levels` for buckets of them.
+
+        Returns
+        -------
+        Tuple[Dict[str, Columns], Dict[str, Columns]]
+            Two dictionaries keyed by nickname; interfaces without data in the range are left out.
+
+            The first has the tests, oldest first: `date` (local time, which is how Bokeh shows
+            it), `time` (UTC), `weekday`, `hour`, `nickname`, `success`, `download_mbps`,
+            `upload_mbps`, `url`, and the latency stats. When `config.keep_consecutive_failures`
+            is False, only the first and last failure of each run of failures are included.
+
+            The second has the outages (runs of failed tests) that overlap the range, oldest first:
+
+            * `start`: the time of the first failure.
+            * `end`: the time of the first success after it, or of its last failure if it's
+              ongoing.
+            * `start_time` and `end_time`: `start` and `end` in UTC.
+            * `ongoing`: whether no test has succeeded since.
+            * `num_failed`: the number of failed tests.
+            * `duration_min`: `end - start` in minutes.
+
+            At the other levels, the first has the buckets that overlap the range and have tests,
+            oldest first: `time` and `date` (the start of the bucket), `nickname`, `num_tests`,
+            `num_failed`, `success` (whether any test succeeded), and `<direction>_mbps`,
+            `<direction>_min` and `<direction>_max`, the mean, minimum and maximum rate of the
+            successful tests (0 if there are none). Every failed test is counted, regardless of
+            `config.keep_consecutive_failures`.
+        """
+        start64 = _to_datetime64(start)
+        end64 = _to_datetime64(end)
+        first64 = start64
+        if start64 is not None and level != 'raw':
+            # Include the bucket `start` falls in.
+            first64 = start64 - numpy.timedelta64(levels[level] * 1000 - 1, 'ms')
+        series: Dict[str, Columns] = {}
+        outages: Dict[str, Columns] = {}
+        for nickname, (raw, runs) in self._views.items():
+            tests = raw if level == 'raw' else self._pyramids[nickname][level]
+            times = tests['time']
+            lo = 0 if first64 is None else numpy.searchsorted(times, first64, side='left')
+            hi = len(times) if end64 is None else numpy.searchsorted(times, end64, side='left')
+            if hi > lo:
+                series[nickname] = {name: column[lo:hi] for name, column in tests.items()}
+            # Runs don't overlap, so both their starts and ends are sorted.
+            lo = 0 if start64 is None else numpy.searchsorted(runs['end_time'], start64, 'left')
+            hi = len(runs['end_time']) if end64 is None \
+                else numpy.searchsorted(runs['start_time'], end64, 'left')
+            if hi > lo:
+                outages[nickname] = {name: column[lo:hi] for name, column in runs.items()}
+        return series, outages
+
+    def save(self, snapshot_path: str) -> None:
+        """
+        Publishes the data as a snapshot (see `snapshot`) for other processes to `load`, or for
+        this one to start from next time. It's tagged with where `update` left off in the results
+        file.
+        """
+        tables: snapshot.Tables = {}
+        for nickname, interface in self._interfaces.items():
+            tables[f'tests/{nickname}'] = interface.tests.columns
+        for nickname, (series, outages) in self._views.items():
+            tables[f'series/{nickname}'] = series
+            tables[f'outages/{nickname}'] = outages
+            for level, buckets in self._pyramids[nickname].items():
+                tables[f'{level}/{nickname}'] = buckets
+        snapshot.write(snapshot_path, tables, {
+            'modified': self.modified,
+            'filename': self._filename,
+            'cursor': None if self._cursor is None else list(self._cursor),
+        })
+
+    def load(self, snapshot_path: str) -> None:
+        """
+        Replaces the data with a snapshot published by `save`, memory-mapped rather than read; its
+        string columns are UTF-8 bytes until `update` adds to them. The next `update` carries on
+        from where the snapshot was taken, or starts over if the results file has since been
+        replaced.
+        """
+        tables, meta = snapshot.read(snapshot_path)
+        nicknames = [key.split('/', 1)[1] for key in tables.keys() if key.startswith('series/')]
+        views = {nickname: (tables[f'series/{nickname}'], tables[f'outages/{nickname}'])
+                 for nickname in nicknames}
+        pyramids = {nickname: {level: tables[f'{level}/{nickname}'] for level in levels.keys()}
+                    for nickname in nicknames}
+        # Snapshots from before the tests were kept per interface can't be carried on from.
+        if meta.get('cursor') is not None \
+                and all(f'tests/{nickname}' in tables for nickname in nicknames):
+            self._filename = meta['filename']
+            self._cursor = results_store.Cursor(*meta['cursor'])
+            self._interfaces = {nickname: _Interface(nickname, tables[f'tests/{nickname}'],
+                                                     *views[nickname], pyramids[nickname])
+                                for nickname in nicknames}
+        else:
+            self._filename = None
+            self._cursor = None
+            self._interfaces = {}
+        self._views, self._pyramids = views, pyramids
+        self._coverage = _coverage(views, pyramids)
+        self.modified = meta['modified']
+        self.version += 1
+
+    def covers(self, start: Optional[float], level: str = 'raw') -> bool:
+        """
+        Whether `level` ("raw" or one of `levels`) has data from `start` (seconds since the epoch,
+        or None for the beginning) onwards, rather than starting later than a coarser level
+        because older tests were compacted away (see `config.retention_days`).
+        """
+        first = self._coverage.get(level)
+        return first is None or (start is not None
+                                 and bool(numpy.datetime64(int(start * 1000), 'ms') >= first))
+
+    def level_for(self, start: Optional[float], end: Optional[float], points: int) -> str:
+        """
+        Returns the finest level ("raw" or one of `levels`) that `covers` `start` and at which no
+        interface has more than `points` tests or buckets in `[start, end)`, or the coarsest level
+        if there's none.
+        """
+        level = 'raw'
+        for level in ('raw',) + tuple(levels.keys()):
+            if not self.covers(start, level):
+                continue
+            series, _ = self.window(start, end, level)
+            if max((len(tests['time']) for tests in series.values()), default=0) <= points:
+                break
+        return level
@@ -0,0 +1,111 @@
+from typing import Callable, Dict
+import logging
+
+import numpy
+
+from .dataset import Columns
+
+_l = logging.getLogger(__name__)
+
+"""
+Decimation
+----------
+
+Picks which points of a time series to plot when there are more than the plot can show. Each
+method takes the x and y values and a point budget and returns the indices of the points to keep,
+sorted; `decimate` then adds back the points that must never be dropped.
+"""
+
+
+def lttb(x: numpy.ndarray, y: numpy.ndarray, n_out: int) -> numpy.ndarray:
+    """
+    Largest-Triangle-Three-Buckets: keeps the first and last points, and from each of `n_out - 2`
+    equal-count buckets in between, the point that makes the largest triangle with the point kept
+    from the previous bucket and the average of the next bucket.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return numpy.arange(n)
+    x = x.astype(numpy.float64)
+    y = y.astype(numpy.float64)
+    edges = numpy.linspace(1, n - 1, n_out - 1).astype(numpy.int64)
+    # Averages of each bucket, then of the last point, for the "next bucket" corner.
+    sums_x = numpy.add.reduceat(x[1:n - 1], edges[:-1] - 1)
+    sums_y = numpy.add.reduceat(y[1:n - 1], edges[:-1] - 1)
+    counts = numpy.diff(edges)
+    avg_x = numpy.append(sums_x / counts, x[-1])
+    avg_y = numpy.append(sums_y / counts, y[-1])
+    kept = numpy.empty(n_out, dtype=numpy.int64)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        cx, cy = avg_x[i + 1], avg_y[i + 1]
+        area = numpy.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(numpy.argmax(area))
+        kept[i + 1] = a
+    return kept
+
+
+def minmax(x: numpy.ndarray, y: numpy.ndarray, n_out: int) -> numpy.ndarray:
+    """
+    Splits the x range into `n_out // 2` equal-width buckets (e.g. one per pixel column) and keeps
+    the lowest and highest point of each, plus the first and last points.
+    """
+    n = len(x)
+    n_buckets = n_out // 2
+    if n_out >= n or n_buckets < 1:
+        return numpy.arange(n)
+    x = x.astype(numpy.float64)
+    span = x[-1] - x[0]
+    if span <= 0:
+        return numpy.array([0, n - 1])
+    bucket = numpy.minimum(((x - x[0]) / span * n_buckets).astype(numpy.int64), n_buckets - 1)
+    order = numpy.lexsort((y, bucket))
+    first = numpy.flatnonzero(numpy.diff(bucket[order], prepend=-1))
+    last = numpy.append(first[1:], n) - 1
+    return numpy.unique(numpy.concatenate(([0, n - 1], order[first], order[last])))
+
+
+methods: Dict[str, Callable[[numpy.ndarray, numpy.ndarray, int], numpy.ndarray]] = {
+    'lttb': lttb,
+    'minmax': minmax,
+}
+"""Decimation methods by name, as used in `config.decimation` and the `decimate` query parameter."""
+
+
+def decimate(series: Dict[str, Columns], *, method: str, points: int) -> Dict[str, Columns]:
+    """
+    Reduces each interface's tests to about `points` (more if there are many failures). Download and
+    upload rates get half the budget each, and the union of the points picked for each is kept.
+    Failures, and the successes right before and after them (the edges of each outage), are
+    always kept.
+
+    Parameters
+    ----------
+    series : Dict[str, Columns]
+        Tests of each interface, oldest first.
+    method : str
+        One of `methods`.
+    points : int
+        Point budget per interface; 0 to keep everything.
+    """
+    if points <= 0:
+        return series
+    decimated: Dict[str, Columns] = {}
+    for nickname, columns in series.items():
+        n = len(columns['date'])
+        if n <= points:
+            decimated[nickname] = columns
+            continue
+        x = columns['date'].astype('datetime64[ms]').astype(numpy.int64)
+        picked = [methods[method](x, columns[k], max(3, points // 2))
+                  for k in ('download_mbps', 'upload_mbps')]
+        failed = ~columns['success']
+        near_failure = failed.copy()
+        near_failure[1:] |= failed[:-1]
+        near_failure[:-1] |= failed[1:]
+        idx = numpy.union1d(numpy.union1d(*picked), numpy.flatnonzero(near_failure))
+        _l.debug(f'Decimated "{nickname}" from {n:,} to {len(idx):,} points.')
+        decimated[nickname] = {name: column[idx] for name, column in columns.items()}
+    return decimated
@@ -1,18 +1,40 @@
-from typing import Dict
-from threading import Thread
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+from datetime import datetime, timezone
+from threading import Thread, Event
+import functools
+import gzip
+import json
+import os
 import time
 
-from flask import Flask, request
+import dateutil.parser
+import numpy
+from dateutil import tz
+from flask import Flask, Response, request, abort, url_for
 from bokeh.models import ColumnDataSource
 
 import config
-from .data import (proc_results,
-                   filter,
-                   smooth,)
-from .plots import (log_plot,
+from .data import (smooth,
+                   down_up_by_val,
+                   down_up_by_val_from_rollups,
+                   to_json,
+                   with_ranges,
+                   series_columns,
+                   outage_columns,)
+from . import smoothing
+from . import decimation
+from . import snapshot
+from .dataset import Dataset, levels
+from .cache import PageCache
+from .plots import (log_plot_width,
+                    log_plot,
                     hourly_plot,
-                    daily_plot,)
+                    daily_plot,
+                    heatmap_plot,)
 
+from utils import results_store
+from utils import rollups
+from utils import config_watch
 from utils.timing import TimeIt
 
 
@@ -30,30 +52,143 @@ dictConfig({
 
 app = Flask(__name__)
 
-_all_data: Dict[str, ColumnDataSource] = {}
+_dataset = Dataset()
+_cache = PageCache(config.page_cache_entries, int(config.page_cache_mb * 1024 * 1024))
 
+_page_args = ('start', 'end', 'smooth', 'window', 'direction', 'nickname', 'decimate', 'points',
+              'level')
+"""Query parameters that change a page, other than `days` and `hours`."""
 
-def _data_grabber():
+_page_options = ('results_db', 'plot_hrs', 'rollup_plot_hrs', 'n_time_avg', 'smoothing',
+                 'decimation', 'points_per_px', 'decimation_headroom', 'keep_consecutive_failures')
+"""Config options that change pages."""
+
+_window_step_sec = 60
+"""
+Pages of windows that end now (no `end` query parameter) slide along with time: they're cached for
+this long, even if the data doesn't change.
+"""
+
+
+def _page_options_hash() -> str:
+    return PageCache.etag(tuple(repr(getattr(config, k, None)) for k in _page_options))
+
+
+_page_config = _page_options_hash()
+"""Identifies the values of `_page_options`, for the page cache."""
+
+_reload_data = Event()
+"""Set to make `_data_grabber` load the data right away."""
+
+
+def _on_config_change(changed: Set[str]) -> None:
+    """Drops whatever the config options in `changed` make out of date."""
+    global _page_config
+    if changed & set(_page_options):
+        _page_config = _page_options_hash()
+        _cache.clear()
+    if changed & {'page_cache_entries', 'page_cache_mb'}:
+        _cache.resize(config.page_cache_entries, int(config.page_cache_mb * 1024 * 1024))
+    if 'keep_consecutive_failures' in changed:
+        _dataset.reset()
+    if changed & {'keep_consecutive_failures', 'results_db', 'data_load_interval_min',
+                  'shared_snapshot'}:
+        _reload_data.set()
+
+
+config_watch.subscribe(_on_config_change)
+config_watch.start(config.__file__, config.refresh)
+
+
+def _load_data() -> None:
+    """Brings `_dataset` up to date with the results file."""
+    # In case the dashboard is started before the collector ever was.
+    results_store.migrate_legacy(os.path.abspath(config.results_db))
+    with TimeIt('Updating data (in a thread)', log=app.logger):
+        n_new = _dataset.update(config.results_db)
+    app.logger.debug(f'Read {n_new} new results. Page cache: {len(_cache)} pages, '
+                     f'{_cache.size_bytes:,} bytes, {_cache.hits} hits, '
+                     f'{_cache.misses} misses.')
+
+
+def _warm_start() -> Optional[Tuple[int, int, int]]:
+    """
+    Loads the latest snapshot, if there is one, so pages have data right away rather than after
+    `_data_grabber` has read every result. Returns its generation (see `snapshot.generation`).
     """
-    Data loader; runs on separate thread. NOTE: if the app is run with
-    `--reload`, you will get multiple threads.
+    snapshot_path = snapshot.path(config.results_db)
+    current = snapshot.generation(snapshot_path)
+    if current is None:
+        return None
+    try:
+        with TimeIt(f'Loading "{snapshot_path}"', log=app.logger):
+            _dataset.load(snapshot_path)
+    except Exception as e:
+        app.logger.error(f'Failed to load "{snapshot_path}"; will read the results instead:\n{e}')
+        return None
+    return current
+
+
+def _data_grabber(loaded: Optional[Tuple[int, int, int]]):
+    """
+    Data loader; runs on separate thread. It carries on from the snapshot `_warm_start` loaded (of
+    generation `loaded`), and saves a new one whenever the data changes.
+
+    When `config.shared_snapshot` is True, only one process (the one holding the snapshot lock; see
+    `snapshot`) loads the data and publishes it, and the others switch to each new snapshot; so
+    running several workers, or with `--reload`, doesn't multiply the work.
     """
-    global _all_data
     time.sleep(3)  # need to wait until the app starts.
+    lock = None
+    lock_path = None
+    published = None if loaded is None else _dataset.version
+    next_load = 0.0
     while True:
+        if _reload_data.is_set():
+            _reload_data.clear()
+            next_load = 0.0
         try:
             with app.app_context():
                 # Needs this context to use the app logger :/
-                with TimeIt('`proc_results` (in a thread)', log=app.logger):
-                    _all_data = proc_results(span_hrs=None)
+                config.refresh()
+                snapshot_path = snapshot.path(config.results_db)
+                if not config.shared_snapshot:
+                    producer = True
+                else:
+                    if lock is not None and lock_path != snapshot_path:
+                        lock.close()
+                        lock = None
+                    if lock is None:
+                        lock = snapshot.try_lock(snapshot_path)
+                        lock_path = snapshot_path
+                        if lock is not None:
+                            app.logger.info(f'Publishing data to "{snapshot_path}".')
+                            next_load = 0.0
+                    producer = lock is not None
+                if producer:
+                    if time.monotonic() >= next_load:
+                        next_load = time.monotonic() + config.data_load_interval_min * 60
+                        _load_data()
+                    if _dataset.version != published:
+                        with TimeIt('Saving snapshot', log=app.logger):
+                            _dataset.save(snapshot_path)
+                        published = _dataset.version
+                else:
+                    current = snapshot.generation(snapshot_path)
+                    if current is not None and current != loaded:
+                        with TimeIt('Switching to new snapshot', log=app.logger):
+                            _dataset.load(snapshot_path)
+                        loaded = current
+                        published = _dataset.version
         except Exception as e:
             app.logger.error(f'Failed to load data:\n{e}')
-        config.refresh()
-        app.logger.debug(f'Waiting {config.data_load_interval_min:.1f} minutes to read data again.')
-        time.sleep(config.data_load_interval_min*60)
+        if config.shared_snapshot:
+            _reload_data.wait(config.snapshot_poll_sec)
+        else:
+            _reload_data.wait(max(0.0, next_load - time.monotonic()))
 
 
-t = Thread(target=_data_grabber, daemon=True, name='_data_grabber')
+t = Thread(target=_data_grabber, args=(_warm_start(),), daemon=True, name='_data_grabber')
 t.start()
 
 
@@ -67,16 +202,6 @@ def _get_plot_hrs(endpoint: str) -> int:
     return plot_hrs
 
 
-@app.route('/')
-@app.route('/log')
-def main():
-    with TimeIt('`filter`', log=app.logger):
-        filtered = filter(_all_data, _get_plot_hrs('log'))
-    with TimeIt('`smooth`', log=app.logger):
-        smoothed = smooth(filtered)
-    return log_plot(smoothed)
-
-
 def _time_pretty(hrs: int) -> str:
     if hrs < 24:
         return f'{hrs:d} hours'
@@ -85,23 +210,235 @@ def _time_pretty(hrs: int) -> str:
         if days == int(days):
             return f'{days:.0f} days'
         else:
-            return f'{days:1.f} days'
+            return f'{days:.1f} days'
+
+
+def _parse_time(arg: str) -> float:
+    """Parses a date / time query parameter (local time unless it says otherwise)."""
+    t = dateutil.parser.parse(arg)
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=tz.tzlocal())
+    return t.timestamp()
+
+
+def _get_window(endpoint: str) -> Tuple[Optional[float], Optional[float], str]:
+    """
+    Returns the time range `[start, end)` to plot, in seconds since the epoch, and a description of
+    it. `start` and `end` query parameters select any range (either may be left out); otherwise it's
+    the most recent `days` or `hours`, or `config.plot_hrs`.
+    """
+    if 'start' in request.args.keys() or 'end' in request.args.keys():
+        start_arg = request.args.get('start')
+        end_arg = request.args.get('end')
+        start = None if start_arg is None else _parse_time(start_arg)
+        end = None if end_arg is None else _parse_time(end_arg)
+        return start, end, f'{start_arg or "Beginning"} to {end_arg or "now"}'
+    hrs = _get_plot_hrs(endpoint)
+    return time.time() - hrs * 60 * 60, None, f'Last {_time_pretty(hrs)}'
+
+
+def _get_smoothing() -> Tuple[Optional[str], Optional[int]]:
+    """Returns the smoothing kernel and window size from the query parameters, if given."""
+    kernel = request.args.get('smooth')
+    n_avg = request.args.get('window')
+    if kernel == 'none':
+        return None, 1
+    if kernel is not None and kernel not in smoothing.kernels:
+        abort(400, f'Unknown smoothing "{kernel}"; use one of '
+                   f'{", ".join(smoothing.kernels.keys())} or none.')
+    if n_avg is not None and (not n_avg.isdigit() or int(n_avg) < 1):
+        abort(400, f'Smoothing window must be a positive integer, not "{n_avg}".')
+    return kernel, None if n_avg is None else int(n_avg)
+
+
+def _cached_page(endpoint: str,
+                 mimetype: str = 'text/html',
+                 window: Optional[str] = None) -> Callable[[Callable[[], str]],
+                                                           Callable[[], Response]]:
+    """
+    Decorator for views that render a page (or other text, of `mimetype`). Pages are cached by
+    endpoint, query parameters, config and data (see `Dataset.identity`), and by the time for
+    windows that end now (see `_window_step_sec`), gzipped if the browser accepts it, and sent with
+    `ETag` and `Last-Modified` so browsers can revalidate them with a 304 response.
+    `window` is the key of the default time span in `config.plot_hrs`, if not `endpoint`.
+    """
+    window = endpoint if window is None else window
+
+    def decorator(view: Callable[[], str]) -> Callable[[], Response]:
+        @functools.wraps(view)
+        def cached_view() -> Response:
+            # `days` and `hours` are normalized to the number of hours they select.
+            plot_hrs = _get_plot_hrs(window) if window in config.plot_hrs else None
+            args = tuple((k, request.args[k]) for k in _page_args if k in request.args)
+            encoding = 'gzip' if request.accept_encodings['gzip'] else 'identity'
+            step = None if 'end' in request.args else int(time.time() // _window_step_sec)
+            # Not `_dataset.version`: other workers send pages of the same data with the same tag.
+            key = (endpoint, plot_hrs, args, encoding, _page_config, _dataset.identity, step)
+            etag = PageCache.etag(key)
+            if etag in request.if_none_match:
+                response = Response(status=304)
+            else:
+                page = _cache.get(key)
+                if page is None:
+                    page = view().encode('utf-8')
+                    if encoding == 'gzip':
+                        page = gzip.compress(page, compresslevel=6)
+                    _cache.put(key, page)
+                response = Response(page, mimetype=mimetype)
+                if encoding == 'gzip':
+                    response.content_encoding = 'gzip'
+            response.vary.add('Accept-Encoding')
+            response.set_etag(etag)
+            modified = _dataset.modified if step is None else max(_dataset.modified,
+                                                                  step * _window_step_sec)
+            response.last_modified = datetime.fromtimestamp(modified, timezone.utc)
+            response.cache_control.no_cache = True  # i.e. revalidate every time.
+            response.make_conditional(request)  # Turns it into a 304 if need be, in place.
+            return response
+        return cached_view
+    return decorator
+
+
+def _get_decimation() -> Tuple[str, int]:
+    """Returns the decimation method and point budget, from the query parameters or `config`."""
+    method = request.args.get('decimate', config.decimation)
+    points = request.args.get('points')
+    if method == 'none':
+        return config.decimation, 0
+    if method not in decimation.methods:
+        abort(400, f'Unknown decimation "{method}"; use one of '
+                   f'{", ".join(decimation.methods.keys())} or none.')
+    if points is None:
+        return method, int(log_plot_width * config.points_per_px)
+    if not points.isdigit():
+        abort(400, f'Points must be a non-negative integer, not "{points}".')
+    return method, int(points)
+
+
+def _get_level() -> Optional[str]:
+    """
+    Returns the `level` query parameter (see `Dataset.window`), or None to pick one by the point
+    budget (see `api_series`).
+    """
+    level = request.args.get('level', 'auto')
+    if level == 'auto':
+        return None
+    if level != 'raw' and level not in levels:
+        abort(400, f'Unknown level "{level}"; use one of raw, {", ".join(levels.keys())} or auto.')
+    return level
+
+
+def _local_ms(epoch_sec: float) -> float:
+    """
+    Converts seconds since the epoch to milliseconds since the epoch of local time, as Bokeh
+    expects.
+    """
+    return datetime.fromtimestamp(epoch_sec).replace(tzinfo=timezone.utc).timestamp() * 1000
+
+
+def _series_url(nickname: str) -> str:
+    """URL of the `api_series` data of one interface, for the current page's query parameters."""
+    args: Dict[str, Any] = request.args.to_dict()
+    args['nickname'] = nickname  # Replacing the page's own `nickname`, if any.
+    return url_for('api_series', **args)
+
+
+@app.route('/')
+@app.route('/log')
+@_cached_page('log')
+def main():
+    start, end, _ = _get_window('log')
+    # Only the coarser levels may go back as far as `start`; see `Dataset.covers`.
+    series, _ = _dataset.window(start, end, 'raw' if _dataset.covers(start)
+                                else tuple(levels.keys())[-1])
+    data_urls = {nickname: _series_url(nickname) for nickname in series.keys()}
+    first = [float(tests['date'][0].astype('datetime64[ms]').astype(numpy.int64))
+             for tests in series.values()]
+    x_end = _local_ms(time.time() if end is None else end)
+    if start is not None:
+        x_start = _local_ms(start)
+    else:
+        x_start = min(first, default=x_end - 24 * 60 * 60 * 1000)
+    return log_plot(data_urls, (x_start, x_end))
+
+
+@app.route('/api/series')
+@_cached_page('api_series', mimetype='application/json', window='log')
+def api_series():
+    """
+    The tests and outages plotted by `/log`, as JSON: `{"level": level, "series": {nickname:
+    {column: [...]}}, "outages": {nickname: {column: [...]}}}` (see `data.to_json`). Takes the same
+    query parameters as `/log`, plus `nickname` to only get one interface, and `level` (see
+    `Dataset.window`; "auto" by default, the finest level within `config.decimation_headroom` times
+    the point budget). Whichever level it is, it's then decimated to the budget. Smoothing only
+    applies to the raw level.
+    """
+    start, end, _ = _get_window('log')
+    method, points = _get_decimation()
+    level = _get_level()
+    if level is None:
+        level = _dataset.level_for(start, end, int(points * config.decimation_headroom)) \
+            if points > 0 else 'raw'
+    with TimeIt(f'`window` ({level})', log=app.logger):
+        series, outages = _dataset.window(start, end, level)
+    nickname = request.args.get('nickname')
+    if nickname is not None:
+        series = {k: v for k, v in series.items() if k == nickname}
+        outages = {k: v for k, v in outages.items() if k == nickname}
+    if level == 'raw':
+        with TimeIt('`smooth`', log=app.logger):
+            kernel, n_avg = _get_smoothing()
+            series = with_ranges(smooth(series, kernel=kernel, n_avg=n_avg))
+    with TimeIt('`decimate`', log=app.logger):
+        decimated = decimation.decimate(series, method=method, points=points)
+    return json.dumps({'level': level,
+                       'series': to_json(decimated, series_columns),
+                       'outages': to_json(outages, outage_columns)},
+                      separators=(',', ':'))
+
+
+def _by_val(endpoint: str, val_name: str) -> Tuple[Dict[str, ColumnDataSource], str]:
+    """
+    Statistics by `val_name` over the requested window, from the rollups if the window is longer
+    than `config.rollup_plot_hrs` or goes back further than the results do.
+    """
+    start, end, title = _get_window(endpoint)
+    span_hrs = ((time.time() if end is None else end) - (0 if start is None else start)) / 3600
+    if (span_hrs > config.rollup_plot_hrs or not _dataset.covers(start)) \
+            and rollups.exists(config.results_db):
+        with TimeIt('`down_up_by_val_from_rollups`', log=app.logger):
+            return down_up_by_val_from_rollups(config.results_db, val_name, start, end), title
+    series, _ = _dataset.window(start, end)
+    kernel, n_avg = _get_smoothing()
+    smoothed = smooth(series, kernel=kernel, n_avg=n_avg)
+    return down_up_by_val(smoothed, val_name), title
 
 
 @app.route('/hourly')
+@_cached_page('hourly')
 def hourly():
-    hrs = _get_plot_hrs('hourly')
-    filtered = filter(_all_data, hrs)
-    smoothed = smooth(filtered)
-    return hourly_plot(smoothed, title=f'Last {_time_pretty(hrs)}')
+    by_hour, title = _by_val('hourly', 'hour')
+    return hourly_plot(by_hour, title=title)
 
 
 @app.route('/daily')
+@_cached_page('daily')
 def daily():
-    hrs = _get_plot_hrs('daily')
-    filtered = filter(_all_data, hrs)
-    smoothed = smooth(filtered)
-    return daily_plot(smoothed, title=f'Last {_time_pretty(hrs)}')
+    by_weekday, title = _by_val('daily', 'weekday')
+    return daily_plot(by_weekday, title=title)
+
+
+@app.route('/heatmap')
+@_cached_page('heatmap')
+def heatmap():
+    start, end, title = _get_window('heatmap')
+    direction = request.args.get('direction', 'download')
+    if direction not in ('download', 'upload'):
+        abort(400, f'Direction must be download or upload, not "{direction}".')
+    series, _ = _dataset.window(start, end)
+    kernel, n_avg = _get_smoothing()
+    smoothed = smooth(series, kernel=kernel, n_avg=n_avg)
+    return heatmap_plot(smoothed, title=title, direction=direction)
 
 
 @app.route('/favicon.ico')
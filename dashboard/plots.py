@@ -1,19 +1,41 @@
-from typing import List, Dict
+from typing import List, Dict, Tuple, Union
 import itertools
 import logging
 
+import numpy
+
 from bokeh.plotting import figure
-from bokeh.models import ColumnDataSource, HoverTool, Scatter, OpenURL, TapTool, Legend
-from bokeh.palettes import Category10_10 as palette
+from bokeh.models import (ColumnDataSource, HoverTool, OpenURL, TapTool, LinearColorMapper,
+                          Range1d, AjaxDataSource, CustomJS)
+from bokeh.models.annotations import Legend, ColorBar
+from bokeh.models.renderers import DataRenderer, GlyphRenderer
+from bokeh.models.text import BaseText
+from bokeh.layouts import column
+from bokeh.palettes import Category10_10 as palette, Viridis256
+from bokeh.transform import transform
 from bokeh.resources import CDN
 from bokeh.embed import file_html
 
-from .data import down_up_by_val
+from .data import down_up_by_hour_of_week, series_columns, outage_columns
+from .dataset import Columns
 
 
 _l = logging.getLogger(__name__)
 
 
+log_plot_width = 1500
+"""Nominal width of the log plot, in pixels; it stretches to fit the page."""
+
+_weekdays: Dict[Union[float, str], Union[str, BaseText]] = {0: 'Mon',
+                                                            1: 'Tue',
+                                                            2: 'Wed',
+                                                            3: 'Thu',
+                                                            4: 'Fri',
+                                                            5: 'Sat',
+                                                            6: 'Sun'}
+"""Axis labels by weekday number; typed as Bokeh's `major_label_overrides` expects."""
+
+
 def _line_dot(fig: figure,
               source: ColumnDataSource,
               *,
@@ -21,7 +43,7 @@ def _line_dot(fig: figure,
               y: str,
               color: str,
               dashed: bool,
-              ) -> Scatter:
+              ) -> GlyphRenderer:
     if dashed:
         line_dash = 'dashed'
     else:
@@ -38,24 +60,94 @@ def _line_dot(fig: figure,
     return d
 
 
-def log_plot(sources: Dict[str, ColumnDataSource]) -> str:
-    fig = figure(height=500, width=1500, toolbar_location=None,
-                 x_axis_type='datetime', x_axis_location='below',
-                 sizing_mode='stretch_width', tools=[])
+def _bands(fig: figure, source: ColumnDataSource, *, x: str, color: str) -> None:
+    """Shades the 5th to 95th percentile of download and upload rates, and dots the medians."""
+    for direction, alpha in (('download', 0.15), ('upload', 0.08)):
+        fig.varea(x=x, y1=f'{direction}_mbps_p5', y2=f'{direction}_mbps_p95', source=source,
+                  fill_color=color, fill_alpha=alpha)
+        fig.line(x=x, y=f'{direction}_mbps_p50', source=source,
+                 line_width=1, line_color=color, line_dash='dotted')
+
+
+def _ajax_sources(data_url: str) -> Tuple[AjaxDataSource, ColumnDataSource]:
+    """
+    Sources for the tests and outages of one interface. The tests are fetched from `data_url` (see
+    `/api/series`), and the outages come with them.
+    """
+    no_series: Dict[str, list] = {c: [] for c in series_columns}
+    no_outages: Dict[str, list] = {c: [] for c in outage_columns}
+    outages = ColumnDataSource(data=no_outages)
+    adapter = CustomJS(args=dict(outages=outages, no_series=no_series, no_outages=no_outages),
+                       code='''
+        const response = cb_data.response
+        const nickname = Object.keys(response.series)[0]
+        outages.data = nickname in response.outages ? response.outages[nickname] : no_outages
+        return nickname === undefined ? no_series : response.series[nickname]
+    ''')
+    series = AjaxDataSource(data_url=data_url, method='GET', adapter=adapter,
+                            data={c: [] for c in series_columns})
+    return series, outages
+
+
+def _refetch_on_zoom(x_range: Range1d, sources: List[AjaxDataSource]) -> None:
+    """
+    Makes panning and zooming fetch the visible time range again, so the server can pick the level
+    of detail for it (see `/api/series`). Waits for the range to settle first.
+    """
+    callback = CustomJS(args=dict(x_range=x_range, sources=sources), code='''
+        // Dates are local time pretending to be UTC, which is how `/api/series` parses a time
+        // without a zone.
+        const iso = (ms) => new Date(ms).toISOString().slice(0, 23)
+        clearTimeout(x_range._refetch_timer)
+        x_range._refetch_timer = setTimeout(() => {
+            for (const source of sources) {
+                const url = new URL(source.data_url, window.location.href)
+                url.searchParams.delete('days')
+                url.searchParams.delete('hours')
+                url.searchParams.set('start', iso(x_range.start))
+                url.searchParams.set('end', iso(x_range.end))
+                source.data_url = url.pathname + url.search
+                source.get_data('replace')
+            }
+        }, 250)
+    ''')
+    x_range.js_on_change('start', callback)
+    x_range.js_on_change('end', callback)
+
+
+def log_plot(data_urls: Dict[str, str], x_range: Tuple[float, float]) -> str:
+    """
+    Plots transfer rate over time. The page only has the layout; the browser fetches the data for
+    each interface from the URL in `data_urls`, keyed by nickname, and fetches it again for the
+    visible range when the plot is panned or zoomed. `x_range` is the initial range, in
+    milliseconds since the epoch of local time.
+    """
+    visible = Range1d(start=x_range[0], end=x_range[1])
+    fig = figure(height=500, width=log_plot_width, toolbar_location=None,
+                 x_axis_type='datetime', x_axis_location='below', x_range=visible,
+                 sizing_mode='stretch_width', tools='xpan,xwheel_zoom,reset',
+                 active_drag='xpan', active_scroll='xwheel_zoom')
     fig.yaxis.axis_label = 'Transfer rate (Mbps)'
 
-    dots: List[Scatter] = []
-    legend_items: Dict[str, List[Scatter]] = {}
+    dots: List[DataRenderer] = []
+    strips: List[DataRenderer] = []
+    sources: List[AjaxDataSource] = []
+    legend_items: Dict[str, List[GlyphRenderer]] = {}
     color = itertools.cycle(palette)
-    for nickname, source in sources.items():
+    for nickname, data_url in data_urls.items():
         c = next(color)
-        dots.extend([
-            _line_dot(fig, source, x='date', y='download_mbps',
-                      color=c, dashed=False),
-            _line_dot(fig, source, x='date', y='upload_mbps',
-                      color=c, dashed=True)
-        ])
-        legend_items[nickname] = [dots[-1]]
+        source, outages = _ajax_sources(data_url)
+        sources.append(source)
+        strips.append(fig.vstrip(x0='start', x1='end', source=outages,
+                                 fill_color=c, fill_alpha=0.15, line_alpha=0))
+        # The range of each bucket of tests; collapses onto the line for individual tests.
+        for direction, alpha in (('download', 0.15), ('upload', 0.08)):
+            fig.varea(x='date', y1=f'{direction}_min', y2=f'{direction}_max', source=source,
+                      fill_color=c, fill_alpha=alpha)
+        download = _line_dot(fig, source, x='date', y='download_mbps', color=c, dashed=False)
+        upload = _line_dot(fig, source, x='date', y='upload_mbps', color=c, dashed=True)
+        dots.extend([download, upload])
+        legend_items[nickname] = [upload]
 
     legend = Legend(items=list(legend_items.items()), location='left')
     fig.add_layout(legend, 'center')
@@ -65,6 +157,9 @@ def log_plot(sources: Dict[str, ColumnDataSource]) -> str:
             ('Interface', '@nickname'),
             ('Date', '@date{%Y-%m-%d %H:%M:%S}'),
             ('Down / up rate', '@download_mbps{0.0} / @upload_mbps{0.0} Mbps'),
+            ('Down min - max', '@download_min{0.0} - @download_max{0.0} Mbps'),
+            ('Up min - max', '@upload_min{0.0} - @upload_max{0.0} Mbps'),
+            ('Num tests (total / failed)', '@num_tests{,} / @num_failed{,}'),
             ('Ping min - max (jitter)', '@idle_latency_stats'),
             ('Down latency min - max (jitter)', '@down_latency_stats'),
             ('Up latency min - max (jitter)', '@up_latency_stats'),
@@ -76,35 +171,45 @@ def log_plot(sources: Dict[str, ColumnDataSource]) -> str:
         mode='mouse',
         renderers=dots,
     )
-    tap = TapTool()
+    outage_hover = HoverTool(
+        tooltips=[
+            ('Interface', '@nickname'),
+            ('Outage', '@start{%Y-%m-%d %H:%M} to @end{%Y-%m-%d %H:%M} (@duration_min{0} min)'),
+            ('Failed tests', '@num_failed{,}'),
+        ],
+        formatters={
+            '@start': 'datetime',
+            '@end': 'datetime',
+        },
+        mode='mouse',
+        renderers=strips,
+    )
+    tap = TapTool(renderers=dots)
     tap.callback = OpenURL(url='@url')  # type: ignore[assignment]
-    fig.add_tools(hover, tap)
+    fig.add_tools(hover, outage_hover, tap)
+    _refetch_on_zoom(visible, sources)
 
     return file_html(fig, CDN, 'Speedtest log')
 
 
-def hourly_plot(sources: Dict[str, ColumnDataSource], title: str) -> str:
+def hourly_plot(by_hour: Dict[str, ColumnDataSource], title: str) -> str:
+    """Plots statistics by hour of day, from `down_up_by_val` (or its rollup equivalent)."""
     fig = figure(height=800, width=800, toolbar_location=None, x_axis_location='below', tools=[],
                  title=title)
     fig.yaxis.axis_label = 'Transfer rate (Mbps)'
     fig.xaxis.axis_label = 'Hour of day'
     fig.xaxis.ticker = list(range(24))
 
-    sources = down_up_by_val(sources, 'hour')
-
-    dots: List[Scatter] = []
-    legend_items: Dict[str, List[Scatter]] = {}
+    dots: List[DataRenderer] = []
+    legend_items: Dict[str, List[GlyphRenderer]] = {}
     color = itertools.cycle(palette)
-    for nickname, source in sources.items():
-        source.data['hour']
+    for nickname, source in by_hour.items():
         c = next(color)
-        dots.extend([
-            _line_dot(fig, source, x='hour', y='download_mbps_mean',
-                      color=c, dashed=False),
-            _line_dot(fig, source, x='hour', y='upload_mbps_mean',
-                      color=c, dashed=True)
-        ])
-        legend_items[nickname] = [dots[-1]]
+        _bands(fig, source, x='hour', color=c)
+        download = _line_dot(fig, source, x='hour', y='download_mbps_mean', color=c, dashed=False)
+        upload = _line_dot(fig, source, x='hour', y='upload_mbps_mean', color=c, dashed=True)
+        dots.extend([download, upload])
+        legend_items[nickname] = [upload]
 
     legend = Legend(items=list(legend_items.items()), location='center', orientation='horizontal')
     fig.add_layout(legend, 'below')
@@ -114,6 +219,10 @@ def hourly_plot(sources: Dict[str, ColumnDataSource], title: str) -> str:
             ('Interface', '@nickname'),
             ('Avg down', '@download_mbps_mean{0.0} +/- @download_mbps_std{0.0} Mbps'),
             ('Avg up rate', ' @upload_mbps_mean{0.0} +/- @upload_mbps_std{0.0} Mbps'),
+            ('Down 5% / 50% / 95%',
+             '@download_mbps_p5{0.0} / @download_mbps_p50{0.0} / @download_mbps_p95{0.0} Mbps'),
+            ('Up 5% / 50% / 95%',
+             '@upload_mbps_p5{0.0} / @upload_mbps_p50{0.0} / @upload_mbps_p95{0.0} Mbps'),
             ('Num tests (total / failed)', ' @num_tests{,} / @num_tests_failed{,}')
         ],
         mode='mouse',
@@ -124,36 +233,28 @@ def hourly_plot(sources: Dict[str, ColumnDataSource], title: str) -> str:
     return file_html(fig, CDN, 'Speedtest log')
 
 
-def daily_plot(sources: Dict[str, ColumnDataSource], title: str) -> str:
+def daily_plot(by_weekday: Dict[str, ColumnDataSource], title: str) -> str:
+    """Plots statistics by weekday, from `down_up_by_val` (or its rollup equivalent)."""
     fig = figure(height=800, width=800, toolbar_location=None, x_axis_location='below', tools=[],
                  title=title)
     fig.yaxis.axis_label = 'Transfer rate (Mbps)'
     fig.xaxis.axis_label = 'Weekday'
     fig
-    ticks = {0: 'Mon',
-             1: 'Tue',
-             2: 'Wed',
-             3: 'Thu',
-             4: 'Fri',
-             5: 'Sat',
-             6: 'Sun'}
-    fig.xaxis.ticker = list(ticks.keys())
+    ticks = _weekdays
+    fig.xaxis.ticker = list(range(7))
     fig.xaxis.major_label_overrides = ticks
-    sources = down_up_by_val(sources, 'weekday')
 
-    dots: List[Scatter] = []
-    legend_items: Dict[str, List[Scatter]] = {}
+    dots: List[DataRenderer] = []
+    legend_items: Dict[str, List[GlyphRenderer]] = {}
     color = itertools.cycle(palette)
-    for nickname, source in sources.items():
-        source.data['weekday']
+    for nickname, source in by_weekday.items():
         c = next(color)
-        dots.extend([
-            _line_dot(fig, source, x='weekday', y='download_mbps_mean',
-                      color=c, dashed=False),
-            _line_dot(fig, source, x='weekday', y='upload_mbps_mean',
-                      color=c, dashed=True)
-        ])
-        legend_items[nickname] = [dots[-1]]
+        _bands(fig, source, x='weekday', color=c)
+        download = _line_dot(fig, source, x='weekday', y='download_mbps_mean',
+                             color=c, dashed=False)
+        upload = _line_dot(fig, source, x='weekday', y='upload_mbps_mean', color=c, dashed=True)
+        dots.extend([download, upload])
+        legend_items[nickname] = [upload]
 
     legend = Legend(items=list(legend_items.items()), location='center', orientation='horizontal')
     fig.add_layout(legend, 'below')
@@ -163,6 +264,10 @@ def daily_plot(sources: Dict[str, ColumnDataSource], title: str) -> str:
             ('Interface', '@nickname'),
             ('Avg down', '@download_mbps_mean{0.0} +/- @download_mbps_std{0.0} Mbps'),
             ('Avg up rate', ' @upload_mbps_mean{0.0} +/- @upload_mbps_std{0.0} Mbps'),
+            ('Down 5% / 50% / 95%',
+             '@download_mbps_p5{0.0} / @download_mbps_p50{0.0} / @download_mbps_p95{0.0} Mbps'),
+            ('Up 5% / 50% / 95%',
+             '@upload_mbps_p5{0.0} / @upload_mbps_p50{0.0} / @upload_mbps_p95{0.0} Mbps'),
             ('Num tests (total / failed)', ' @num_tests{,} / @num_tests_failed{,}')
         ],
         mode='mouse',
@@ -171,3 +276,51 @@ def daily_plot(sources: Dict[str, ColumnDataSource], title: str) -> str:
     fig.add_tools(hover)
 
     return file_html(fig, CDN, 'Speedtest log')
+
+
+def heatmap_plot(sources: Dict[str, Columns], title: str, direction: str) -> str:
+    """
+    Mean transfer rate by hour of the week; one heat map per interface.
+
+    Parameters
+    ----------
+    direction : str
+        "download" or "upload".
+    """
+    by_hour = down_up_by_hour_of_week(sources)
+    value = f'{direction}_mbps_mean'
+    means = [source.data[value] for source in by_hour.values()]
+    high = max([float(numpy.nanmax(m)) for m in means if not numpy.all(numpy.isnan(m))],
+               default=1.0)
+    mapper = LinearColorMapper(palette=Viridis256, low=0, high=high, nan_color='lightgray')
+
+    figs = []
+    for nickname, source in by_hour.items():
+        fig = figure(height=300, width=1000, toolbar_location=None, tools=[],
+                     title=f'{nickname}: {title}', sizing_mode='stretch_width',
+                     x_range=Range1d(start=-0.5, end=23.5), y_range=Range1d(start=6.5, end=-0.5))
+        fig.xaxis.axis_label = 'Hour of day'
+        fig.xaxis.ticker = list(range(24))
+        fig.yaxis.ticker = list(range(7))
+        fig.yaxis.major_label_overrides = _weekdays
+        fig.grid.visible = False
+        fig.rect(x='hour', y='weekday', width=1, height=1, source=source,
+                 fill_color=transform(value, mapper), line_color=None)
+        hover = HoverTool(
+            tooltips=[
+                ('Interface', '@nickname'),
+                ('Avg down', '@download_mbps_mean{0.0} +/- @download_mbps_std{0.0} Mbps'),
+                ('Avg up rate', ' @upload_mbps_mean{0.0} +/- @upload_mbps_std{0.0} Mbps'),
+                ('Down 5% / 50% / 95%',
+                 '@download_mbps_p5{0.0} / @download_mbps_p50{0.0} / @download_mbps_p95{0.0} Mbps'),
+                ('Up 5% / 50% / 95%',
+                 '@upload_mbps_p5{0.0} / @upload_mbps_p50{0.0} / @upload_mbps_p95{0.0} Mbps'),
+                ('Num tests (total / failed)', ' @num_tests{,} / @num_tests_failed{,}')
+            ],
+            mode='mouse',
+        )
+        fig.add_tools(hover)
+        fig.add_layout(ColorBar(color_mapper=mapper, title=f'Mean {direction} (Mbps)'), 'right')
+        figs.append(fig)
+
+    return file_html(column(figs, sizing_mode='stretch_width'), CDN, 'Speedtest log')
@@ -0,0 +1,96 @@
+from typing import Callable, Dict
+import logging
+import math
+
+import numpy
+
+_l = logging.getLogger(__name__)
+
+"""
+Smoothing kernels
+-----------------
+
+Each kernel takes a series of values in chronological order and a window size, and returns the
+smoothed series as `float64`, computed with array operations. Windows are trailing: each point is
+smoothed with the points before it. Before the first point, the series is taken to hold the first
+value.
+"""
+
+
+def _padded(vals: numpy.ndarray, n: int) -> numpy.ndarray:
+    return numpy.concatenate((numpy.full(n - 1, vals[0], dtype=numpy.float64),
+                              vals.astype(numpy.float64)))
+
+
+def moving_average(vals: numpy.ndarray, n: int) -> numpy.ndarray:
+    """Mean of each point and the `n - 1` before it, from a cumulative sum."""
+    sums = numpy.concatenate(([0.0], numpy.cumsum(_padded(vals, n))))
+    return (sums[n:] - sums[:-n]) / n
+
+
+def ewma(vals: numpy.ndarray, n: int) -> numpy.ndarray:
+    """
+    Exponentially weighted moving average with the same center of mass as an `n` point moving
+    average, i.e. `alpha = 2 / (n + 1)`.
+    """
+    alpha = 2 / (n + 1)
+    decay = 1 - alpha
+    x = vals.astype(numpy.float64)
+    y = numpy.empty_like(x)
+    if decay == 0:
+        y[:] = x
+        return y
+    # Within a block, y[k] = decay^(k+1) y[-1] + alpha decay^k cumsum(x[j] decay^-j)[k]. Blocks are
+    # short enough for decay^-j not to overflow.
+    block = max(1, int(300 / -math.log(decay)))
+    powers = decay ** numpy.arange(min(block, len(x)) + 1)
+    prev = x[0] if len(x) else 0.0
+    for b in range(0, len(x), block):
+        chunk = x[b:b + block]
+        k = len(chunk)
+        y[b:b + k] = (powers[1:k + 1] * prev
+                      + alpha * powers[:k] * numpy.cumsum(chunk / powers[:k]))
+        prev = y[b + k - 1]
+    return y
+
+
+def rolling_median(vals: numpy.ndarray, n: int) -> numpy.ndarray:
+    """Median of each point and the `n - 1` before it."""
+    windows = numpy.lib.stride_tricks.sliding_window_view(_padded(vals, n), n)
+    return numpy.median(windows, axis=1)
+
+
+kernels: Dict[str, Callable[[numpy.ndarray, int], numpy.ndarray]] = {
+    'mean': moving_average,
+    'ewma': ewma,
+    'median': rolling_median,
+}
+"""Smoothing kernels by name, as used in `config.smoothing` and the `smooth` query parameter."""
+
+
+def smooth(vals: numpy.ndarray, *, kernel: str, n: int, keep_zero: bool) -> numpy.ndarray:
+    """
+    Smooths a series of values.
+
+    Parameters
+    ----------
+    vals : numpy.ndarray
+        The values, in chronological order.
+    kernel : str
+        One of `kernels`.
+    n : int
+        Window size. 1 leaves the values as they are.
+    keep_zero : bool
+        True to leave zeros (failed tests) as zeros; they're still part of their neighbors' windows.
+
+    Returns
+    -------
+    numpy.ndarray
+        The smoothed values.
+    """
+    if n <= 1 or len(vals) == 0:
+        return vals
+    smoothed = kernels[kernel](vals, n)
+    if keep_zero:
+        smoothed[vals == 0] = 0
+    return smoothed
@@ -0,0 +1,149 @@
+from typing import Dict, Any, Optional, Tuple, IO
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+
+import numpy
+
+_l = logging.getLogger(__name__)
+
+
+"""
+Dataset snapshots
+-----------------
+
+A snapshot is the processed contents of a `Dataset` in one file, `<results filename>.snapshot`, so
+that several dashboard processes (e.g. gunicorn workers) can share one copy of it. One of them, the
+producer, holds an advisory lock on `<snapshot>.lock`, keeps its dataset up to date and publishes a
+new snapshot whenever it changes. The others memory-map the latest snapshot read-only, so they
+neither parse the results nor keep a private copy of them. If the producer exits, the next process
+to try the lock takes over. A snapshot also records where in the results file it was taken, so a
+restarted dashboard can load it right away and only read the results added since.
+
+The file is a 16-byte header (magic, version, JSON length), a JSON object, and the arrays, each
+aligned to 64 bytes. The JSON object has the dataset's metadata (`meta`), and the name, dtype, shape
+and offset of each array of each table. Strings are stored as UTF-8 bytes (`S` dtype), since object
+arrays can't be mapped.
+
+Snapshots are written to a temporary file and renamed over the previous one, so a reader maps either
+generation whole; the old one stays valid for as long as it's mapped.
+"""
+
+
+_magic = b'STLSNAP\n'
+_version = 1
+_header = struct.Struct('<8sII')
+_align = 64
+
+Tables = Dict[str, Dict[str, numpy.ndarray]]
+"""Named tables of named columns."""
+
+
+def path(filename: str) -> str:
+    """Returns the snapshot path of results file `filename`."""
+    return filename + '.snapshot'
+
+
+def try_lock(snapshot_path: str) -> Optional[IO]:
+    """
+    Tries to become the producer of the snapshot at `snapshot_path`.
+
+    Returns
+    -------
+    Optional[IO]
+        The lock file, which holds the lock until it's closed, or None if another process holds it.
+    """
+    lock = open(snapshot_path + '.lock', 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
+
+def generation(snapshot_path: str) -> Optional[Tuple[int, int, int]]:
+    """Identifies the current snapshot, or returns None if there isn't one."""
+    try:
+        st = os.stat(snapshot_path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _storable(column: numpy.ndarray) -> numpy.ndarray:
+    if column.dtype.kind == 'O':
+        return numpy.array([s.encode('utf-8') for s in column], dtype='S')
+    return numpy.ascontiguousarray(column)
+
+
+def write(snapshot_path: str, tables: Tables, meta: Dict[str, Any]) -> None:
+    """
+    Publishes a snapshot.
+
+    Parameters
+    ----------
+    snapshot_path : str
+        Where to write it.
+    tables : Tables
+        The data.
+    meta : Dict[str, Any]
+        JSON-serializable metadata.
+    """
+    arrays = []
+    index: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    offset = 0
+    for table, columns in tables.items():
+        index[table] = {}
+        for name, column in columns.items():
+            stored = _storable(column)
+            index[table][name] = {'dtype': stored.dtype.str, 'shape': stored.shape,
+                                  'offset': offset}
+            arrays.append((offset, stored))
+            offset += -(-stored.nbytes // _align) * _align
+    header = json.dumps({'meta': meta, 'tables': index}).encode('utf-8')
+    data_start = -(-(_header.size + len(header)) // _align) * _align
+    # Processes that don't share the snapshot (see `config.shared_snapshot`) may all write it.
+    temp = f'{snapshot_path}.{os.getpid()}.tmp'
+    with open(temp, 'wb') as f:
+        f.write(_header.pack(_magic, _version, len(header)))
+        f.write(header)
+        for array_offset, stored in arrays:
+            f.seek(data_start + array_offset)
+            f.write(stored.tobytes())
+        f.truncate(data_start + offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, snapshot_path)
+
+
+def read(snapshot_path: str) -> Tuple[Tables, Dict[str, Any]]:
+    """
+    Memory-maps a snapshot. The arrays are read-only views of the mapping, which is unmapped once
+    none of them are left.
+
+    Returns
+    -------
+    Tuple[Tables, Dict[str, Any]]
+        The data and metadata passed to `write`.
+    """
+    with open(snapshot_path, 'rb') as f:
+        magic, version, header_len = _header.unpack(f.read(_header.size))
+        if magic != _magic or version != _version:
+            raise ValueError(f'"{snapshot_path}" is not a version {_version} snapshot.')
+        header = json.loads(f.read(header_len))
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    data_start = -(-(_header.size + header_len) // _align) * _align
+    tables: Tables = {}
+    for table, columns in header['tables'].items():
+        tables[table] = {}
+        for name, column in columns.items():
+            dtype = numpy.dtype(column['dtype'])
+            shape = tuple(column['shape'])
+            tables[table][name] = numpy.frombuffer(
+                mapped, dtype=dtype, count=int(numpy.prod(shape)),
+                offset=data_start + column['offset']).reshape(shape)
+    return tables, header['meta']
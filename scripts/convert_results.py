@@ -0,0 +1,26 @@
+# Converts a results file between any two formats supported by `utils.results_store`, e.g.
+#   python scripts/convert_results.py results/results.jsonl results/results.col
+import os
+import sys
+
+from utils import results_store
+from utils.timing import TimeIt
+
+if len(sys.argv) != 3:
+    print(f'Usage: {sys.argv[0]} <source results file> <destination results file>')
+    sys.exit(1)
+
+src_filename, dst_filename = sys.argv[1:]
+if os.path.exists(dst_filename):
+    print(f'"{dst_filename}" already exists.')
+    sys.exit(2)
+
+with TimeIt(f'Loading "{src_filename}"'):
+    results = results_store.load(src_filename)
+
+with TimeIt(f'Writing {len(results):,} results to "{dst_filename}"'):
+    for result in results:
+        results_store.append(dst_filename, result)
+
+with TimeIt(f'Reading "{dst_filename}"'):
+    results_store.load(dst_filename)
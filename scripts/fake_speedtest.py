@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# Stands in for Ookla's `speedtest` so the collector can be exercised locally: point
+# `config.speedtest_path` at this file. It accepts the same arguments the collector passes and
+# writes the same kind of `--format=jsonl` output, quickly.
+#
+# Behavior is picked with environment variables:
+#   FAKE_SPEEDTEST_MODE: "ok" (default), "fail" (exit 2), "limit" (exit 173, too many requests),
+#     "hang" (stop responding during FAKE_SPEEDTEST_HANG_PHASE, default "download"), or
+#     "silent-hang" (close output, but never exit).
+#   FAKE_SPEEDTEST_PHASE_SEC: seconds each phase takes (default 0.5).
+from typing import Any, Dict
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+mode = os.environ.get('FAKE_SPEEDTEST_MODE', 'ok')
+hang_phase = os.environ.get('FAKE_SPEEDTEST_HANG_PHASE', 'download')
+phase_sec = float(os.environ.get('FAKE_SPEEDTEST_PHASE_SEC', '0.5'))
+interface = 'eth0'
+for arg in sys.argv[1:]:
+    if arg.startswith('--interface='):
+        interface = arg.split('=', 1)[1]
+
+
+def emit(event: dict) -> None:
+    event['timestamp'] = datetime.utcnow().isoformat(timespec='seconds') + 'Z'
+    print(json.dumps(event), flush=True)
+
+
+if mode == 'fail':
+    print('[error] Configuration - Could not retrieve or read configuration (ConfigurationError)',
+          flush=True)
+    sys.exit(2)
+if mode == 'limit':
+    print('[error] Limit reached: Too many requests received.', flush=True)
+    sys.exit(173)
+
+emit({'type': 'testStart', 'isp': 'Fake ISP', 'interface': {'name': interface}})
+latency = {'iqm': 20.0, 'low': 15.0, 'high': 35.0, 'jitter': 2.5}
+measured: Dict[str, Dict[str, Any]] = {
+    'ping': {'jitter': 1.5, 'latency': 12.0, 'low': 10.0, 'high': 14.0},
+    'download': {'bandwidth': 12_500_000, 'bytes': 100_000_000, 'elapsed': 8000,
+                 'latency': latency},
+    'upload': {'bandwidth': 2_500_000, 'bytes': 20_000_000, 'elapsed': 8000, 'latency': latency},
+}
+for phase in ('ping', 'download', 'upload'):
+    steps = 5
+    for step in range(1, steps + 1):
+        if mode == 'hang' and phase == hang_phase and step == 3:
+            time.sleep(3600)
+        if mode == 'silent-hang' and phase == 'upload' and step == steps:
+            sys.stdout.close()
+            time.sleep(3600)
+        progress = dict(measured[phase], progress=step / steps)
+        emit({'type': phase, phase: progress})
+        time.sleep(phase_sec / steps)
+
+result = dict(measured, type='result', isp='Fake ISP',
+              interface={'name': interface, 'externalIp': '192.0.2.1'},
+              server={'id': 9436, 'name': 'Fake server'},
+              result={'id': 'fake', 'url': 'https://www.speedtest.net/result/c/fake'})
+emit(result)
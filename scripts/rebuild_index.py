@@ -0,0 +1,17 @@
+# Rebuilds the timestamp index of a binary results file, e.g. one written by `json2bin.py` before
+# the index existed.
+import sys
+
+from utils import results_file
+from utils.timing import TimeIt
+
+if len(sys.argv) != 2:
+    print(f'Usage: {sys.argv[0]} <binary results file>')
+    sys.exit(1)
+
+bin_filename = sys.argv[1]
+
+with TimeIt(f'Rebuilding index of "{bin_filename}"'):
+    n = results_file.rebuild_index(bin_filename)
+
+print(f'Indexed {n:,} records.')
@@ -0,0 +1,18 @@
+# Rebuilds the rollups of a results file, e.g. after it was edited or converted by hand.
+# Rollups of results that were dropped by compaction (see `config.retention_days`) are lost.
+import sys
+
+from utils import results_store
+from utils import rollups
+from utils.timing import TimeIt
+
+if len(sys.argv) != 2:
+    print(f'Usage: {sys.argv[0]} <results file>')
+    sys.exit(1)
+
+filename = sys.argv[1]
+
+with TimeIt(f'Rebuilding rollups of "{filename}"'):
+    n = rollups.rebuild(filename, results_store.load(filename))
+
+print(f'Summarized {n:,} results.')
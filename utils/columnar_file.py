@@ -0,0 +1,493 @@
+from typing import List, Dict, Any, Optional, Tuple
+from datetime import datetime, timezone
+import json
+import logging
+import math
+import os
+import struct
+import zlib
+
+import numpy
+
+import config
+from utils.timestamps import result_epoch_sec
+
+
+_l = logging.getLogger(__name__)
+
+
+"""
+Columnar results file format
+----------------------------
+
+A results file `<filename>` (extension `.col`) is three files:
+
+1. `<filename>`: a 16-byte header (magic, version, row size) followed by fixed-width rows of
+   `row_dtype`, one per result, in the order they were appended. The fields are the ones the
+   dashboard uses, so the whole file can be memory-mapped and each field read as a NumPy column.
+   Missing numbers are NaN.
+2. `<filename>.dict`: JSON object mapping each dictionary-encoded field (e.g. "nickname") to the
+   list of values its ids index into. Rewritten atomically, only when a new value shows up. Values
+   repeat from one result to the next, so this stays small: the interface and nickname, and the
+   server block, ISP and external IP address from the `speedtest` output.
+3. `<filename>.blob`: the raw result of each test as zlib-compressed JSON, concatenated. Rows point
+   into it with `blob_offset` and `blob_length`. It's only read by `load_raw`. It's optional (see
+   `append`); rows of results that weren't archived have a `blob_length` of 0.
+
+`append` writes the blob, then the dictionary (if needed), and the row last, so a row is never
+visible before the data it refers to. A torn last row is ignored by `load_table` and truncated by
+the next `append`.
+"""
+
+
+_magic = b'STLCOL\r\n'
+_version = 2
+_header = struct.Struct('<8sII')
+
+_dict_fields = ('interface', 'nickname', 'server', 'isp', 'external_ip')
+"""
+Fields stored as `uint16` ids into the `.dict` file, so each can have at most 65,536 distinct
+values; `append` refuses results past that. Version 1 files only have the first two.
+"""
+
+_url_len = 96
+
+_v1_fields = [
+    ('timestamp', '<f8'),  # seconds since the epoch
+    ('interface', '<u2'),
+    ('nickname', '<u2'),
+    ('return_code', '<i2'),
+    ('download_bandwidth', '<f4'),  # bytes per second, as reported by `speedtest`
+    ('upload_bandwidth', '<f4'),
+    ('ping_latency', '<f4'),  # all latencies in milliseconds
+    ('ping_low', '<f4'),
+    ('ping_high', '<f4'),
+    ('ping_jitter', '<f4'),
+    ('download_latency_low', '<f4'),
+    ('download_latency_high', '<f4'),
+    ('download_latency_jitter', '<f4'),
+    ('upload_latency_low', '<f4'),
+    ('upload_latency_high', '<f4'),
+    ('upload_latency_jitter', '<f4'),
+    ('url', f'S{_url_len}'),
+    ('blob_offset', '<u8'),
+    ('blob_length', '<u4'),
+]
+
+row_dtype = numpy.dtype(_v1_fields + [
+    ('server', '<u2'),
+    ('isp', '<u2'),
+    ('external_ip', '<u2'),
+])
+
+_row_dtypes = {1: numpy.dtype(_v1_fields), 2: row_dtype}
+"""Row format of each version. Files keep the version they were created with."""
+
+
+class Table:
+    """
+    A memory-mapped columnar results file.
+
+    Attributes
+    ----------
+    rows: numpy.ndarray
+        Structured array of `row_dtype` (or an older version's), oldest first. Read-only.
+    strings: Dict[str, List[Any]]
+        The values each dictionary-encoded field's ids refer to, e.g.
+        `strings['nickname'][rows['nickname'][0]]`.
+    """
+
+    def __init__(self, filename: str, rows: numpy.ndarray,
+                 strings: Dict[str, List[Any]]) -> None:
+        self.filename = filename
+        self.rows = rows
+        self.strings = strings
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def decode(self, field: str) -> numpy.ndarray:
+        """Returns a dictionary-encoded column as an object array of its values."""
+        lookup = numpy.empty(len(self.strings[field]) + 1, dtype=object)
+        lookup[:-1] = self.strings[field]
+        return lookup[self.rows[field]]
+
+    def raw(self, idx: int) -> Dict[str, Any]:
+        """
+        Returns the complete result as originally recorded for row `idx`, or as `to_results`
+        rebuilds it if it wasn't archived.
+        """
+        row = self.rows[idx]
+        if row['blob_length'] == 0:
+            return to_results(self, idx, idx + 1)[0]
+        with open(self.filename + '.blob', 'rb') as f:
+            f.seek(int(row['blob_offset']))
+            blob = f.read(int(row['blob_length']))
+        return json.loads(zlib.decompress(blob))
+
+
+def _read_strings(filename: str) -> Dict[str, List[Any]]:
+    dict_filename = filename + '.dict'
+    if not os.path.exists(dict_filename):
+        return {field: [] for field in _dict_fields}
+    with open(dict_filename, 'r') as f:
+        strings = json.loads(f.read())
+    for field in _dict_fields:
+        strings.setdefault(field, [])
+    return strings
+
+
+def _write_strings(filename: str, strings: Dict[str, List[Any]]) -> None:
+    dict_filename = filename + '.dict'
+    temp_filename = dict_filename + '.tmp'
+    with open(temp_filename, 'w') as f:
+        f.write(json.dumps(strings))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_filename, dict_filename)
+
+
+def _check_header(filename: str, header: bytes) -> numpy.dtype:
+    """Returns the row format of the file with `header`."""
+    magic, version, row_size = _header.unpack(header)
+    if magic != _magic or version not in _row_dtypes or row_size != _row_dtypes[version].itemsize:
+        raise ValueError(f'"{filename}" is not a version {", ".join(map(str, _row_dtypes))} '
+                         f'columnar results file.')
+    return _row_dtypes[version]
+
+
+def load_table(filename: str) -> Table:
+    """
+    Memory-maps a columnar results file. This doesn't read the rows themselves, so it takes the
+    same (negligible) time no matter how big the file is.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the columnar results file.
+
+    Returns
+    -------
+    Table
+        The results.
+    """
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        dtype = _check_header(filename, f.read(_header.size))
+    n_rows = (size - _header.size) // dtype.itemsize
+    if n_rows * dtype.itemsize != size - _header.size:
+        _l.warning(f'Ignoring torn last row of "{filename}".')
+    if n_rows == 0:
+        rows = numpy.zeros(0, dtype=dtype)
+    else:
+        rows = numpy.memmap(filename, dtype=dtype, mode='r', offset=_header.size,
+                            shape=(n_rows,))
+    return Table(filename, rows, _read_strings(filename))
+
+
+def _float(d: Dict[str, Any], *keys: str) -> float:
+    for k in keys:
+        if not isinstance(d, dict) or k not in d.keys():
+            return math.nan
+        d = d[k]
+    try:
+        return float(d)  # type: ignore[arg-type]
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def _dict_values(result: Dict[str, Any]) -> Dict[str, Any]:
+    """The values of the dictionary-encoded fields of a result (None where it has none)."""
+    output = result.get('output', {}) if result.get('returnCode') == 0 else {}
+    if not isinstance(output, dict):
+        output = {}
+    interface = output.get('interface')
+    return {'interface': result.get('interface'),
+            'nickname': result.get('nickname'),
+            'server': output.get('server'),
+            'isp': output.get('isp'),
+            'external_ip': interface.get('externalIp') if isinstance(interface, dict) else None}
+
+
+def _encode_row(result: Dict[str, Any], ids: Dict[str, int],
+                blob_offset: int, blob_length: int, dtype: numpy.dtype) -> numpy.ndarray:
+    row = numpy.zeros(1, dtype=dtype)
+    row['timestamp'] = result_epoch_sec(result)
+    for field, value in ids.items():
+        row[field] = value
+    row['return_code'] = result.get('returnCode', -1)
+    output = result.get('output', {}) if result.get('returnCode') == 0 else {}
+    row['download_bandwidth'] = _float(output, 'download', 'bandwidth')
+    row['upload_bandwidth'] = _float(output, 'upload', 'bandwidth')
+    row['ping_latency'] = _float(output, 'ping', 'latency')
+    for stat in ('low', 'high', 'jitter'):
+        row[f'ping_{stat}'] = _float(output, 'ping', stat)
+        row[f'download_latency_{stat}'] = _float(output, 'download', 'latency', stat)
+        row[f'upload_latency_{stat}'] = _float(output, 'upload', 'latency', stat)
+    url = output.get('result', {}).get('url', '') if isinstance(output, dict) else ''
+    encoded_url = url.encode('utf-8')
+    if len(encoded_url) > _url_len:
+        _l.warning(f'Result URL "{url}" is longer than {_url_len} bytes; it will be truncated.')
+    row['url'] = encoded_url[:_url_len]
+    row['blob_offset'] = blob_offset
+    row['blob_length'] = blob_length
+    return row
+
+
+def append(filename: str, result: Dict[str, Any], archive_raw: bool = True) -> None:
+    """
+    Appends a result to the columnar results file, creating it if needed.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the columnar results file.
+    result : Dict[str, Any]
+        The result to append.
+    archive_raw : bool
+        Whether to keep the complete result in the `.blob` archive. If not, only the fields in the
+        columns and the `.dict` file are kept.
+    """
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        size = os.fstat(fd).st_size
+        if size == 0:
+            os.write(fd, _header.pack(_magic, _version, row_dtype.itemsize))
+            size = _header.size
+            dtype = row_dtype
+        else:
+            dtype = _check_header(filename, os.pread(fd, _header.size, 0))
+
+        strings = _read_strings(filename)
+        ids: Dict[str, int] = {}
+        new_strings = False
+        for field, value in _dict_values(result).items():
+            if field not in (dtype.names or ()):
+                continue
+            if value not in strings[field]:
+                max_id = numpy.iinfo(dtype[field]).max
+                if len(strings[field]) > max_id:
+                    # The id would wrap around to some other value.
+                    raise ValueError(f'"{filename}" already has {max_id + 1:,} distinct values of '
+                                     f'"{field}"; start a new results file.')
+                strings[field].append(value)
+                new_strings = True
+            ids[field] = strings[field].index(value)
+
+        blob_offset, blob_length = 0, 0
+        if archive_raw:
+            blob = zlib.compress(json.dumps(result, sort_keys=True).encode('utf-8'))
+            with open(filename + '.blob', 'ab') as f:
+                blob_offset, blob_length = f.tell(), len(blob)
+                f.write(blob)
+                f.flush()
+                os.fsync(f.fileno())
+
+        if new_strings:
+            _write_strings(filename, strings)
+
+        row = _encode_row(result, ids, blob_offset, blob_length, dtype)
+        torn = (size - _header.size) % dtype.itemsize
+        if torn:
+            _l.warning(f'Truncating {torn} bytes of torn last row from "{filename}".')
+            size -= torn
+            os.ftruncate(fd, size)
+        os.pwrite(fd, row.tobytes(), size)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def copy_from(filename: str, dst_filename: str, row: int,
+              start: Optional[float] = None) -> Tuple[int, int]:
+    """
+    Appends the rows of the columnar results file added since row `row` to another one, leaving
+    out the results older than `start`. Rows are copied as they are, archive and all; the
+    destination gets the same dictionary, so their ids stay valid, and must be of the same
+    version.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the columnar results file to copy from.
+    dst_filename : str
+        Path to the columnar results file to append to. It's created if needed.
+    row : int
+        The first row to copy; 0, or a value previously returned by this function.
+    start : Optional[float]
+        Seconds since the epoch of the earliest result to copy. None to copy them all.
+
+    Returns
+    -------
+    Tuple[int, int]
+        The number of results left out, and the row to pass next time.
+    """
+    table = load_table(filename)
+    rows = table.rows[row:]
+    if start is not None:
+        rows = rows[rows['timestamp'] >= start]
+    rows = numpy.array(rows)  # A copy, and no longer mapped.
+    blobs = []
+    with open(dst_filename + '.blob', 'ab') as dst_blob:
+        blob_offset = dst_blob.tell()
+        archived = numpy.flatnonzero(rows['blob_length'])
+        if len(archived):
+            with open(filename + '.blob', 'rb') as src_blob:
+                for i in archived:
+                    src_blob.seek(int(rows['blob_offset'][i]))
+                    blobs.append(src_blob.read(int(rows['blob_length'][i])))
+                    rows['blob_offset'][i] = blob_offset
+                    blob_offset += len(blobs[-1])
+            dst_blob.write(b''.join(blobs))
+            dst_blob.flush()
+            os.fsync(dst_blob.fileno())
+    _write_strings(dst_filename, table.strings)
+    fd = os.open(dst_filename, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        size = os.fstat(fd).st_size
+        if size == 0:
+            version = next(v for v, dtype in _row_dtypes.items() if dtype == rows.dtype)
+            os.write(fd, _header.pack(_magic, version, rows.dtype.itemsize))
+            size = _header.size
+        os.pwrite(fd, rows.tobytes(), size)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return len(table) - row - len(rows), len(table)
+
+
+def _isotime(timestamp: float) -> str:
+    t = datetime.fromtimestamp(timestamp, timezone.utc).replace(tzinfo=None)
+    return t.isoformat(timespec='microseconds')[:-4] + 'Z'
+
+
+def _latency(low: float, high: float, jitter: float) -> Dict[str, float]:
+    return {'low': low, 'high': high, 'jitter': jitter}
+
+
+def to_results(table: Table, start: int = 0, stop: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Rebuilds result dictionaries for rows `start` to `stop` from the columns alone, without
+    touching the blob segment. Only the fields stored in the columns (and the `.dict` file) are
+    present in `output`.
+    """
+    rows = table.rows[start:stop]
+    interfaces = table.strings['interface']
+    nicknames = table.strings['nickname']
+    extra = [field for field in ('server', 'isp', 'external_ip') if field in rows.dtype.names]
+    results: List[Dict[str, Any]] = []
+    for row in rows.tolist():
+        r = dict(zip(rows.dtype.names, row))  # type: ignore[arg-type]
+        result: Dict[str, Any] = {'timestamp': _isotime(r['timestamp']),
+                                  'interface': interfaces[r['interface']],
+                                  'nickname': nicknames[r['nickname']],
+                                  'returnCode': r['return_code']}
+        if r['return_code'] == 0:
+            download: Dict[str, Any] = {'bandwidth': r['download_bandwidth']}
+            if not math.isnan(r['download_latency_low']):
+                download['latency'] = _latency(r['download_latency_low'],
+                                               r['download_latency_high'],
+                                               r['download_latency_jitter'])
+            upload: Dict[str, Any] = {'bandwidth': r['upload_bandwidth']}
+            if not math.isnan(r['upload_latency_low']):
+                upload['latency'] = _latency(r['upload_latency_low'],
+                                             r['upload_latency_high'],
+                                             r['upload_latency_jitter'])
+            ping = _latency(r['ping_low'], r['ping_high'], r['ping_jitter'])
+            ping['latency'] = r['ping_latency']
+            output = {'download': download,
+                      'upload': upload,
+                      'ping': ping,
+                      'result': {'url': r['url'].decode('utf-8')}}
+            values = {field: table.strings[field][r[field]] for field in extra}
+            if values.get('server') is not None:
+                output['server'] = values['server']
+            if values.get('isp') is not None:
+                output['isp'] = values['isp']
+            if values.get('external_ip') is not None:
+                output['interface'] = {'externalIp': values['external_ip']}
+            result['output'] = output
+        results.append(result)
+    return results
+
+
+def load(filename: str) -> List[Dict[str, Any]]:
+    """
+    Loads the columnar results file as result dictionaries. See `to_results`.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the columnar results file.
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        The results in chronological order (oldest first)
+    """
+    return to_results(load_table(filename))
+
+
+def read_from(filename: str, row: int) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Reads the rows appended since row `row` as result dictionaries (see `to_results`).
+
+    Returns
+    -------
+    Tuple[List[Dict[str, Any]], int]
+        The new results, oldest first, and the row to pass next time.
+    """
+    table = load_table(filename)
+    return to_results(table, row), len(table)
+
+
+def load_range(filename: str,
+               start: Optional[float] = None,
+               end: Optional[float] = None) -> List[Dict[str, Any]]:
+    """
+    Loads only the results with `start <= timestamp < end` as result dictionaries.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the columnar results file.
+    start : Optional[float]
+        Seconds since the epoch of the earliest result to load. None to start at the beginning.
+    end : Optional[float]
+        Seconds since the epoch past the latest result to load. None to read to the end.
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        The results in chronological order (oldest first)
+    """
+    table = load_table(filename)
+    first, last = _range_slice(table, start, end)
+    rows = table.rows['timestamp'][first:last]
+    keep = numpy.ones(len(rows), dtype=bool)
+    if start is not None:
+        keep &= rows >= start
+    if end is not None:
+        keep &= rows < end
+    results = to_results(table, first, last)
+    return [r for r, k in zip(results, keep) if k]
+
+
+def _range_slice(table: Table, start: Optional[float], end: Optional[float]) -> Tuple[int, int]:
+    """
+    Returns the slice of rows that contains every row with `start <= timestamp < end`, allowing for
+    timestamps being out of order by up to `config.max_disorder_sec`.
+    """
+    timestamps = table.rows['timestamp']
+    first = 0
+    last = len(table)
+    if start is not None:
+        first = int(numpy.searchsorted(timestamps, start - config.max_disorder_sec, side='left'))
+    if end is not None:
+        last = int(numpy.searchsorted(timestamps, end + config.max_disorder_sec, side='left'))
+    return first, last
+
+
+def load_raw(filename: str, idx: int) -> Dict[str, Any]:
+    """Returns the complete result, as originally recorded, of row `idx` of the file."""
+    return load_table(filename).raw(idx)
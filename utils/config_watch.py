@@ -0,0 +1,195 @@
+from typing import Callable, Dict, Any, List, Optional, Set, Tuple
+import ctypes
+import ctypes.util
+import hashlib
+import logging
+import os
+import struct
+import threading
+import time
+import types
+
+_l = logging.getLogger(__name__)
+
+
+"""
+Config change detection
+-----------------------
+
+`config.refresh` only re-executes the config file when it has really changed: when its modification
+time or size differs from the last time, and then its contents too (by hash). It then tells every
+subscriber (see `subscribe`) which options changed, so each can redo only what those affect.
+
+This module keeps that state, since the `config` module itself is replaced on every reload. `watch`
+follows the file in a background thread, with inotify where available (Linux), so changes are picked
+up as soon as the file is saved; elsewhere, it polls. An event loop can watch the descriptor from
+`open_watch` itself instead.
+"""
+
+
+lock = threading.RLock()
+"""Held while the config is checked and reloaded."""
+
+_signature: Optional[Tuple[int, int]] = None
+_digest = ''
+_subscribers: List[Callable[[Set[str]], None]] = []
+
+default_poll_sec: float = 2
+"""How often `watch` checks the file's time and size by default, if inotify isn't available."""
+
+_IN_ATTRIB = 0x4
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_event = struct.Struct('iIII')
+
+
+def read_if_changed(filename: str) -> Optional[str]:
+    """
+    Returns the contents of `filename` if they changed since the last call, or None. Only a `stat`
+    when the file's time and size haven't changed. Call with `lock` held.
+    """
+    global _signature, _digest
+    st = os.stat(filename)
+    signature = (st.st_mtime_ns, st.st_size)
+    if signature == _signature:
+        return None
+    with open(filename, 'rb') as f:
+        data = f.read()
+    _signature = signature
+    digest = hashlib.sha1(data).hexdigest()
+    if digest == _digest:
+        return None
+    _digest = digest
+    return data.decode('utf-8')
+
+
+def digest() -> str:
+    """Hash of the config file as last loaded."""
+    return _digest
+
+
+def changed_options(old: Dict[str, Any], new: Dict[str, Any]) -> Set[str]:
+    """Names of the options (public, non-module, non-function globals) that differ."""
+    def options(d: Dict[str, Any]) -> Dict[str, Any]:
+        return {k: v for k, v in d.items() if not k.startswith('_')
+                and not isinstance(v, (types.ModuleType, types.FunctionType, type))}
+    old_options, new_options = options(old), options(new)
+    return {k for k in old_options.keys() | new_options.keys()
+            if k not in old_options or k not in new_options or old_options[k] != new_options[k]}
+
+
+def subscribe(callback: Callable[[Set[str]], None]) -> None:
+    """Makes `config.refresh` call `callback` with the names of the options that changed."""
+    with lock:
+        _subscribers.append(callback)
+
+
+def notify(changed: Set[str]) -> None:
+    """Calls the subscribers; an exception in one doesn't keep the others from being called."""
+    _l.info(f'Config changed: {", ".join(sorted(changed))}.')
+    for callback in list(_subscribers):
+        try:
+            callback(changed)
+        except Exception as e:
+            _l.error(f'Config change subscriber failed: {e!r}')
+
+
+def _open_inotify(directory: str) -> Optional[int]:
+    """Returns an inotify descriptor that reports files written or moved into `directory`."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+        if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+            os.close(fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+        return fd
+    except (AttributeError, OSError, TypeError) as e:
+        _l.debug(f'inotify not available ({e!r}); will poll the config file.')
+        return None
+
+
+def _names(events: bytes) -> Set[str]:
+    """The file names in a buffer of inotify events."""
+    names = set()
+    offset = 0
+    while offset + _event.size <= len(events):
+        _, _, _, length = _event.unpack_from(events, offset)
+        offset += _event.size
+        names.add(os.fsdecode(events[offset:offset + length].rstrip(b'\0')))
+        offset += length
+    return names
+
+
+def open_watch(filename: str) -> Optional[int]:
+    """
+    Returns an inotify descriptor that becomes readable when `filename` may have changed (see
+    `read_watch`), or None if inotify isn't available. Editors often save by replacing the file, so
+    it watches the file's directory.
+    """
+    return _open_inotify(os.path.dirname(os.path.abspath(filename)))
+
+
+def read_watch(fd: int, filename: str) -> bool:
+    """
+    Reads the pending events of a descriptor from `open_watch`. Returns True if any of them were
+    about `filename`. Returns False if there were none, for a non-blocking descriptor.
+    """
+    try:
+        events = os.read(fd, 64 * 1024)
+    except BlockingIOError:
+        return False
+    return os.path.basename(filename) in _names(events)
+
+
+def watch(filename: str, on_change: Callable[[], Any],
+          poll_sec: float = default_poll_sec) -> None:
+    """
+    Calls `on_change` whenever `filename` may have changed (see `open_watch`); never returns.
+
+    Parameters
+    ----------
+    filename : str
+        The file to watch.
+    on_change : Callable[[], Any]
+        What to call, e.g. `config.refresh`.
+    poll_sec : float
+        How often to check the file's time and size, if inotify isn't available.
+    """
+    def changed() -> None:
+        try:
+            on_change()
+        except Exception as e:
+            _l.error(f'Failed to handle config file change: {e!r}')
+
+    def file_signature() -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    fd = open_watch(filename)
+    if fd is not None:
+        while True:
+            if read_watch(fd, filename):
+                changed()
+    signature = file_signature()
+    while True:
+        time.sleep(poll_sec)
+        new_signature = file_signature()
+        if new_signature != signature:
+            signature = new_signature
+            changed()
+
+
+def start(filename: str, on_change: Callable[[], Any],
+          poll_sec: float = default_poll_sec) -> threading.Thread:
+    """Runs `watch` in a daemon thread."""
+    thread = threading.Thread(target=watch, args=(filename, on_change, poll_sec), daemon=True,
+                              name='config_watch')
+    thread.start()
+    return thread
@@ -0,0 +1,214 @@
+from typing import List, Dict, Any, Optional, Tuple
+import json
+import logging
+import os
+
+from utils.timestamps import result_epoch_sec
+
+
+_l = logging.getLogger(__name__)
+
+
+"""
+JSON Lines results file format
+------------------------------
+
+One JSON-encoded result per line, oldest first. Each append is a single `write` of a complete line
+followed by `fsync`, so the worst a crash can leave behind is a torn (partial) last line. `load`
+ignores such a line and `append` truncates it away before writing.
+"""
+
+
+def _encode(result: Dict[str, Any]) -> bytes:
+    return (json.dumps(result, sort_keys=True, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def _last_newline_end(fd: int, size: int) -> int:
+    """Returns the offset just past the last newline in the file (0 if there is none)."""
+    chunk = 4096
+    end = size
+    while end > 0:
+        start = max(0, end - chunk)
+        data = os.pread(fd, end - start, start)
+        idx = data.rfind(b'\n')
+        if idx >= 0:
+            return start + idx + 1
+        end = start
+    return 0
+
+
+def recover(filename: str) -> int:
+    """
+    Truncates a torn last line, if any.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the JSON Lines results file.
+
+    Returns
+    -------
+    int
+        The number of bytes removed.
+    """
+    if not os.path.exists(filename):
+        return 0
+    fd = os.open(filename, os.O_RDWR)
+    try:
+        return _recover(fd, filename)
+    finally:
+        os.close(fd)
+
+
+def _recover(fd: int, filename: str) -> int:
+    size = os.fstat(fd).st_size
+    if size == 0 or os.pread(fd, 1, size - 1) == b'\n':
+        return 0
+    good = _last_newline_end(fd, size)
+    _l.warning(f'Truncating {size - good} bytes of torn last line from "{filename}".')
+    os.ftruncate(fd, good)
+    os.fsync(fd)
+    return size - good
+
+
+def load(filename: str) -> List[Dict[str, Any]]:
+    """
+    Loads the JSON Lines results file. A torn last line is skipped, as are corrupt lines.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the JSON Lines results file.
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        The results in chronological order (oldest first)
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    results: List[Dict[str, Any]] = []
+    lines = data.split(b'\n')
+    torn = lines.pop()  # Empty if the file ends with a newline.
+    for n, line in enumerate(lines):
+        if not line:
+            continue
+        try:
+            results.append(json.loads(line))
+        except ValueError:
+            _l.error(f'Skipping corrupt line {n+1} of "{filename}".')
+    if torn:
+        _l.warning(f'Ignoring torn last line of "{filename}" ({len(torn)} bytes).')
+    return results
+
+
+def read_from(filename: str, offset: int) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Reads the complete lines appended since `offset`.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the JSON Lines results file.
+    offset : int
+        Byte offset to start at; 0, or a value previously returned by this function.
+
+    Returns
+    -------
+    Tuple[List[Dict[str, Any]], int]
+        The new results, oldest first, and the offset to pass next time.
+    """
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b'\n') + 1  # A torn or still-being-written line is left for next time.
+    results: List[Dict[str, Any]] = []
+    for line in data[:end].split(b'\n'):
+        if not line:
+            continue
+        try:
+            results.append(json.loads(line))
+        except ValueError:
+            _l.error(f'Skipping corrupt line in "{filename}".')
+    return results, offset + end
+
+
+def append(filename: str, result: Dict[str, Any]) -> None:
+    """
+    Appends a result to the JSON Lines results file and flushes it to disk.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the JSON Lines results file.
+    result : Dict[str, Any]
+        The result to append.
+    """
+    line = _encode(result)
+    fd = os.open(filename, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        _recover(fd, filename)
+        os.write(fd, line)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def copy_from(filename: str, dst_filename: str, offset: int,
+              start: Optional[float] = None) -> Tuple[int, int]:
+    """
+    Appends the lines of the JSON Lines results file added since `offset` (see `read_from`) to
+    another one, leaving out the results older than `start`.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the JSON Lines results file to copy from.
+    dst_filename : str
+        Path to the JSON Lines results file to append to. It's created if needed.
+    offset : int
+        Byte offset to start at; 0, or a value previously returned by this function.
+    start : Optional[float]
+        Seconds since the epoch of the earliest result to copy. None to copy them all.
+
+    Returns
+    -------
+    Tuple[int, int]
+        The number of results left out, and the offset to pass next time.
+    """
+    results, offset = read_from(filename, offset)
+    kept = [r for r in results if start is None or result_epoch_sec(r) >= start]
+    with open(dst_filename, 'ab') as f:
+        f.write(b''.join(_encode(r) for r in kept))
+        f.flush()
+        os.fsync(f.fileno())
+    return len(results) - len(kept), offset
+
+
+def migrate(json_filename: str, jsonl_filename: str) -> int:
+    """
+    Converts a results file in the old JSON array format to JSON Lines. The new file is written
+    under a temporary name and moved into place, so an interrupted migration leaves nothing behind.
+
+    Parameters
+    ----------
+    json_filename : str
+        Path to the JSON array results file. It is left untouched.
+    jsonl_filename : str
+        Path to the JSON Lines results file to create.
+
+    Returns
+    -------
+    int
+        The number of results migrated.
+    """
+    with open(json_filename, 'r') as f:
+        results: List[Dict[str, Any]] = json.loads(f.read())
+    temp_filename = jsonl_filename + '.tmp'
+    with open(temp_filename, 'wb') as f:
+        for result in results:
+            f.write(_encode(result))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_filename, jsonl_filename)
+    return len(results)
@@ -1,6 +1,15 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 import io
+import logging
+import os
 import pickle
+import struct
+
+import config
+from utils.timestamps import result_epoch_sec
+
+
+_l = logging.getLogger(__name__)
 
 
 """
@@ -12,9 +21,55 @@ It's a sequence of records, where each record is:
 2. 4 bytes containing the start offset of the pickled contents.
 
 Thus a results file is simply read sequentially from back to front.
+
+Index file format
+-----------------
+
+Next to each results file lives an index, `<filename>.idx`, with one 16-byte entry per record in
+the order they were appended:
+1. 8 bytes: the record's timestamp in seconds since the epoch (little-endian double).
+2. 8 bytes: the start offset of the record's pickled contents (little-endian unsigned).
+
+`append` keeps it up to date, and rebuilds it if it isn't; `rebuild_index` recreates it from the
+results file. `load_range` only reads it: if it's out of date, it scans the results file instead,
+since readers don't hold the lock that writers do (see `results_store.append`).
 """
 
 
+_entry = struct.Struct('<dQ')
+
+
+def _index_filename(filename: str) -> str:
+    return filename + '.idx'
+
+
+def _read_record(f: io.BufferedReader, pos: int) -> Dict[str, Any]:
+    f.seek(pos)
+    return pickle.load(f)
+
+
+def _walk_back(f: io.BufferedReader) -> List[Tuple[int, Dict[str, Any]]]:
+    """Returns `(offset, result)` for every record, most recent first."""
+    records: List[Tuple[int, Dict[str, Any]]] = []
+    f.seek(0, io.SEEK_END)  # go to the end of the file.
+    addr = f.tell() - 4  # record the start of #2
+    if addr < 0:
+        return records
+    while True:
+        f.seek(addr)
+        bytes = f.read(4)
+        result_pos = int.from_bytes(bytes, 'little', signed=False)
+        result_len = addr - result_pos
+        f.seek(result_pos)  # go to the start of #1
+        blob = f.read(result_len)  # read #1
+        records.append((result_pos, pickle.loads(blob)))
+        addr = result_pos - 4  # record the start of #2 for the previous record.
+        if addr == -4:
+            # Very strict condition here so we can "catch" mistakes.
+            break
+    return records
+
+
 def load(filename: str) -> List[Dict[str, Any]]:
     """
     Loads the binary results file.
@@ -29,28 +84,46 @@ def load(filename: str) -> List[Dict[str, Any]]:
     List[Dict[str, Any]]
         The results in chronological order (most recent first)
     """
+    with open(filename, 'rb') as f:
+        return [result for _, result in _walk_back(f)]
+
+
+def read_from(filename: str, offset: int) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Reads the records appended since `offset`, front to back.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the binary-format results file.
+    offset : int
+        Byte offset of the first record to read; 0, or a value previously returned by this
+        function.
+
+    Returns
+    -------
+    Tuple[List[Dict[str, Any]], int]
+        The new results in the order they were appended, and the offset to pass next time.
+    """
     results: List[Dict[str, Any]] = []
     with open(filename, 'rb') as f:
-        f.seek(0, io.SEEK_END)  # go to the end of the file.
-        addr = f.tell() - 4  # record the start of #2
-        while True:
-            f.seek(addr)
-            bytes = f.read(4)
-            result_pos = int.from_bytes(bytes, 'little', signed=False)
-            result_len = addr - result_pos
-            f.seek(result_pos)  # go to the start of #1
-            blob = f.read(result_len)  # read #1
-            results.append(pickle.loads(blob))
-            addr = result_pos - 4  # record the start of #2 for the previous record.
-            if addr == -4:
-                # Very strict condition here so we can "catch" mistakes.
+        size = f.seek(0, io.SEEK_END)
+        f.seek(offset)
+        while offset < size:
+            try:
+                result = pickle.load(f)  # read #1
+            except (EOFError, pickle.UnpicklingError):
+                break  # Still being written.
+            if len(f.read(4)) != 4:  # skip #2
                 break
-    return results
+            results.append(result)
+            offset = f.tell()
+    return results, offset
 
 
 def append(filename: str, result: Dict[str, Any]) -> None:
     """
-    Appends a result to the binary results file.
+    Appends a result to the binary results file and its index.
 
     Parameters
     ----------
@@ -59,9 +132,168 @@ def append(filename: str, result: Dict[str, Any]) -> None:
     result : Dict[str, Any]
         The result to append.
     """
+    if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+        # Starting a new file; the index must start empty too.
+        with open(_index_filename(filename), 'wb'):
+            pass
+        index_ok = True
+    else:
+        index_ok = _index_in_sync(filename)
     with open(filename, 'a+b') as f:
         f.seek(0, io.SEEK_END)  # go to the end of the file.
         addr = f.tell()  # record the start of #2
         blob = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
         f.write(blob)  # write #1
         f.write(addr.to_bytes(4, 'little'))
+    if index_ok:
+        with open(_index_filename(filename), 'ab') as i:
+            i.write(_entry.pack(result_epoch_sec(result), addr))
+    else:
+        rebuild_index(filename)
+
+
+def copy_from(filename: str, dst_filename: str, offset: int,
+              start: Optional[float] = None) -> Tuple[int, int]:
+    """
+    Appends the records of the binary results file added since `offset` (see `read_from`) to
+    another one and its index, leaving out the results older than `start`.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the binary-format results file to copy from.
+    dst_filename : str
+        Path to the binary-format results file to append to. It's created if needed, and its index
+        must be in sync.
+    offset : int
+        Byte offset of the first record to copy; 0, or a value previously returned by this
+        function.
+    start : Optional[float]
+        Seconds since the epoch of the earliest result to copy. None to copy them all.
+
+    Returns
+    -------
+    Tuple[int, int]
+        The number of results left out, and the offset to pass next time.
+    """
+    results, offset = read_from(filename, offset)
+    n_dropped = 0
+    with open(dst_filename, 'ab') as f, open(_index_filename(dst_filename), 'ab') as i:
+        for result in results:
+            t = result_epoch_sec(result)
+            if start is not None and t < start:
+                n_dropped += 1
+                continue
+            addr = f.tell()
+            f.write(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+            f.write(addr.to_bytes(4, 'little'))
+            i.write(_entry.pack(t, addr))
+        f.flush()
+        os.fsync(f.fileno())
+    return n_dropped, offset
+
+
+def _index_in_sync(filename: str) -> bool:
+    """
+    True if the index describes every record in the results file. Only the last entry is checked,
+    since both files are only ever appended to.
+    """
+    index_filename = _index_filename(filename)
+    if os.path.getsize(filename) == 0:
+        return os.path.exists(index_filename) and os.path.getsize(index_filename) == 0
+    if not os.path.exists(index_filename):
+        return False
+    index_size = os.path.getsize(index_filename)
+    if index_size == 0 or index_size % _entry.size != 0:
+        return False
+    with open(index_filename, 'rb') as i:
+        i.seek(index_size - _entry.size)
+        _, last_pos = _entry.unpack(i.read(_entry.size))
+    with open(filename, 'rb') as f:
+        f.seek(-4, io.SEEK_END)
+        return int.from_bytes(f.read(4), 'little', signed=False) == last_pos
+
+
+def rebuild_index(filename: str) -> int:
+    """
+    Recreates the index of a binary results file from scratch.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the binary-format results file.
+
+    Returns
+    -------
+    int
+        The number of records indexed.
+    """
+    _l.info(f'Rebuilding index of "{filename}"...')
+    index = _build_index(filename)
+    index_filename = _index_filename(filename)
+    temp_filename = index_filename + '.tmp'
+    with open(temp_filename, 'wb') as i:
+        i.write(index)
+    os.replace(temp_filename, index_filename)
+    return len(index) // _entry.size
+
+
+def _build_index(filename: str) -> bytes:
+    """Returns the contents of the index of the results file, built from scratch."""
+    with open(filename, 'rb') as f:
+        records = _walk_back(f)
+    return b''.join(_entry.pack(result_epoch_sec(result), pos) for pos, result in reversed(records))
+
+
+def _bisect(index: bytes, t: float) -> int:
+    """Returns the number of index entries with a timestamp strictly less than `t`."""
+    lo = 0
+    hi = len(index) // _entry.size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if _entry.unpack_from(index, mid * _entry.size)[0] < t:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def load_range(filename: str,
+               start: Optional[float] = None,
+               end: Optional[float] = None) -> List[Dict[str, Any]]:
+    """
+    Loads only the results with `start <= timestamp < end`, using the index to find them.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the binary-format results file.
+    start : Optional[float]
+        Seconds since the epoch of the earliest result to load. None to start at the beginning.
+    end : Optional[float]
+        Seconds since the epoch past the latest result to load. None to read to the end.
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        The results in chronological order (most recent first)
+    """
+    if _index_in_sync(filename):
+        with open(_index_filename(filename), 'rb') as i:
+            index = i.read()
+    else:
+        # Only writers (see `append`) may fix the index; this may be a reader in another process.
+        _l.warning(f'Index of "{filename}" is out of date; scanning the results file instead.')
+        index = _build_index(filename)
+    first = 0 if start is None else _bisect(index, start - config.max_disorder_sec)
+    last = (len(index) // _entry.size if end is None
+            else _bisect(index, end + config.max_disorder_sec))
+    lo = float('-inf') if start is None else start
+    hi = float('inf') if end is None else end
+    results: List[Dict[str, Any]] = []
+    with open(filename, 'rb') as f:
+        for n in range(last - 1, first - 1, -1):
+            timestamp, pos = _entry.unpack_from(index, n * _entry.size)
+            if lo <= timestamp < hi:
+                results.append(_read_record(f, pos))
+    return results
@@ -0,0 +1,433 @@
+from typing import List, Dict, Any, Optional, NamedTuple, Tuple, Iterator
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import os
+import shutil
+import threading
+
+from utils import columnar_file
+from utils import jsonl_file
+from utils import results_file
+from utils import rollups
+from utils.timestamps import result_epoch_sec
+
+
+_l = logging.getLogger(__name__)
+
+
+"""
+Results storage
+---------------
+
+Picks the on-disk format from the extension of the results filename:
+
+* `.json`: the original format; a single JSON array, rewritten in full on every append.
+* `.jsonl`: JSON Lines; append-only, one result per line. See `jsonl_file`.
+* `.bin`: back-linked pickle records with a timestamp index. See `results_file`.
+* `.col`: fixed-width, memory-mappable columns of the fields the dashboard uses, with repeated
+  values (interface, server, ISP...) dictionary-encoded, plus an optional compressed archive of the
+  raw output. See `columnar_file`.
+
+Appends are serialized, both between threads and between processes (through an advisory lock on
+`<filename>.lock`), so concurrent writers never interleave records. Each append also updates the
+file's rollups (see `rollups`). Reads of the formats that span several files take the same lock,
+shared, so they never see some of those files before a `compact` and the others after it.
+
+`compact` drops old results, and old rollups of the finer levels, leaving the coarser rollups as
+the record of them. It rewrites the file (and the files next to it that are part of it) under a
+temporary name while appends carry on, and only holds them (and reads) up to copy over what was
+appended in the meantime and move the new files into place. Likewise, if there are no rollups yet,
+it builds them before taking the lock, and only folds in what was appended in the meantime under it.
+"""
+
+
+_append_lock = threading.Lock()
+
+_held = threading.local()
+"""`exclusive` is True while the current thread holds the lock of `_locked`."""
+
+_sidecars: Dict[str, Tuple[str, ...]] = {'json': (), 'jsonl': (), 'bin': ('.idx',),
+                                         'col': ('.dict', '.blob')}
+"""Suffixes of the files next to a results file that are part of it, by format."""
+
+
+def _format(filename: str) -> str:
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in ('.json', '.jsonl', '.bin', '.col'):
+        return ext[1:]
+    raise ValueError(f'Unknown results file format for "{filename}".')
+
+
+def _load_json(filename: str) -> List[Dict[str, Any]]:
+    with open(filename, 'r') as f:
+        return json.loads(f.read())
+
+
+def _append_json(filename: str, result: Dict[str, Any]) -> None:
+    if os.path.exists(filename):
+        results = _load_json(filename)
+    else:
+        results = []
+    results.append(result)
+    temp_filename = filename + '.tmp'
+    _l.debug(f'Saving results to "{temp_filename}".')
+    with open(temp_filename, 'w') as f:
+        f.write(json.dumps(results, sort_keys=True, indent=4))
+    _l.debug(f'Transferring results to "{filename}".')
+    os.replace(temp_filename, filename)
+
+
+def load(filename: str) -> List[Dict[str, Any]]:
+    """
+    Loads a results file of any supported format.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the results file.
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        The results in chronological order (oldest first)
+    """
+    fmt = _format(filename)
+    if fmt == 'json':
+        return _load_json(filename)
+    elif fmt == 'jsonl':
+        return jsonl_file.load(filename)
+    with _shared(filename):
+        if fmt == 'col':
+            return columnar_file.load(filename)
+        else:
+            return list(reversed(results_file.load(filename)))
+
+
+def load_range(filename: str,
+               start: Optional[float] = None,
+               end: Optional[float] = None) -> List[Dict[str, Any]]:
+    """
+    Loads the results with `start <= timestamp < end` from a results file of any supported format.
+    Only the binary and columnar formats can seek to `start`; the others are loaded in full and then
+    filtered.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the results file.
+    start : Optional[float]
+        Seconds since the epoch of the earliest result to load. None to start at the beginning.
+    end : Optional[float]
+        Seconds since the epoch past the latest result to load. None to read to the end.
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        The results in chronological order (oldest first)
+    """
+    fmt = _format(filename)
+    if fmt == 'bin':
+        with _shared(filename):
+            return list(reversed(results_file.load_range(filename, start, end)))
+    elif fmt == 'col':
+        with _shared(filename):
+            return columnar_file.load_range(filename, start, end)
+    results = load(filename)
+    if start is None and end is None:
+        return results
+    lo = float('-inf') if start is None else start
+    hi = float('inf') if end is None else end
+    return [r for r in results if lo <= result_epoch_sec(r) < hi]
+
+
+class Cursor(NamedTuple):
+    """Where `read_new` left off in a results file."""
+    inode: int
+    size: int
+    position: int
+    """Format-specific: a byte offset, or a row number for `.col` files."""
+
+
+def read_new(filename: str,
+             cursor: Optional[Cursor]) -> Tuple[List[Dict[str, Any]], Cursor, bool]:
+    """
+    Reads the results added to a results file since `cursor`. Reads everything if there's no
+    cursor yet, or if the file has been replaced or truncated since (or is in the `.json` format,
+    which is rewritten on every append).
+
+    Parameters
+    ----------
+    filename : str
+        Path to the results file.
+    cursor : Optional[Cursor]
+        What the previous call returned, or None.
+
+    Returns
+    -------
+    Tuple[List[Dict[str, Any]], Cursor, bool]
+        The new results (oldest first), the cursor for next time, and True if the results are
+        everything in the file rather than just what was added.
+    """
+    fmt = _format(filename)
+    with _shared(filename):
+        return _read_new(fmt, filename, cursor)
+
+
+def _read_new(fmt: str, filename: str,
+              cursor: Optional[Cursor]) -> Tuple[List[Dict[str, Any]], Cursor, bool]:
+    st, position, restart = _start(fmt, filename, cursor)
+    if cursor is not None and position is None:
+        return [], cursor, False
+    position = position or 0
+    if fmt == 'json':
+        results = _load_json(filename)
+    elif fmt == 'jsonl':
+        results, position = jsonl_file.read_from(filename, position)
+    elif fmt == 'col':
+        results, position = columnar_file.read_from(filename, position)
+    else:
+        results, position = results_file.read_from(filename, position)
+    return results, Cursor(st.st_ino, st.st_size, position), restart
+
+
+def _start(fmt: str, filename: str,
+           cursor: Optional[Cursor]) -> Tuple[os.stat_result, Optional[int], bool]:
+    """
+    Where `read_new` should start reading: the file's `stat`, the position (None if nothing has
+    changed since `cursor`), and whether that's the beginning because the file was replaced.
+    """
+    st = os.stat(filename)
+    if cursor is not None and cursor.inode == st.st_ino and cursor.size == st.st_size:
+        return st, None, False
+    restart = (cursor is None or cursor.inode != st.st_ino or st.st_size < cursor.size
+               or fmt == 'json')
+    return st, 0 if restart or cursor is None else cursor.position, restart
+
+
+def is_columnar(filename: str) -> bool:
+    """Whether the results file is in the `.col` format, which `read_new_table` can read."""
+    return _format(filename) == 'col'
+
+
+def read_new_table(filename: str, cursor: Optional[Cursor]
+                   ) -> Tuple[Optional[columnar_file.Table], int, Cursor, bool]:
+    """
+    `read_new` for `.col` files, without turning the rows into result dictionaries.
+
+    Returns
+    -------
+    Tuple[Optional[columnar_file.Table], int, Cursor, bool]
+        The memory-mapped file (None if nothing was added) and its first new row, then the same as
+        `read_new`: the cursor for next time, and True if the new rows are every row.
+    """
+    with _shared(filename):
+        st, position, restart = _start('col', filename, cursor)
+        if cursor is not None and position is None:
+            return None, cursor.position, cursor, False
+        table = columnar_file.load_table(filename)
+    return table, position or 0, Cursor(st.st_ino, st.st_size, len(table)), restart
+
+
+@contextmanager
+def _locked(filename: str) -> Iterator[None]:
+    """
+    Keeps other threads and processes from writing to the results file, or (see `_shared`) reading
+    it.
+    """
+    with _append_lock, open(filename + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        _held.exclusive = True
+        try:
+            yield
+        finally:
+            _held.exclusive = False
+
+
+@contextmanager
+def _shared(filename: str) -> Iterator[None]:
+    """
+    Keeps other threads and processes from writing to the results file, but not from reading it.
+    Only needed to read the formats that span several files; a no-op if this thread is writing.
+    """
+    if _format(filename) not in ('bin', 'col') or getattr(_held, 'exclusive', False):
+        yield
+        return
+    with open(filename + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        yield
+
+
+def append(filename: str, result: Dict[str, Any], archive_raw: bool = True) -> None:
+    """
+    Appends a result to a results file of any supported format, creating it if needed.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the results file.
+    result : Dict[str, Any]
+        The result to append.
+    archive_raw : bool
+        For `.col` files, whether to keep the complete result (see `columnar_file.append`). Other
+        formats always do.
+    """
+    fmt = _format(filename)
+    with _locked(filename):
+        if fmt == 'json':
+            _append_json(filename, result)
+        elif fmt == 'jsonl':
+            jsonl_file.append(filename, result)
+        elif fmt == 'col':
+            columnar_file.append(filename, result, archive_raw)
+        else:
+            results_file.append(filename, result)
+        _update_rollups(filename, result)
+
+
+def _build_rollups(filename: str) -> None:
+    _l.info(f'Building rollups of "{filename}"...')
+    n = rollups.rebuild(filename, load(filename))
+    _l.info(f'Summarized {n:,} results.')
+
+
+def _build_rollups_unlocked(filename: str) -> None:
+    """
+    Like `_build_rollups`, but without holding up appends (or reads) other than to fold in the
+    results appended meanwhile. Must be called without the lock.
+    """
+    _l.info(f'Building rollups of "{filename}"...')
+    results, cursor, _ = read_new(filename, None)
+    temp_dir, n = rollups.build(filename, results)
+    try:
+        with _locked(filename):
+            if rollups.exists(filename):
+                return  # An append beat us to it.
+            results, cursor, restart = _read_new(_format(filename), filename, cursor)
+            if restart:
+                # Replaced meanwhile (or `.json`, which always is); start over.
+                shutil.rmtree(temp_dir)
+                temp_dir, n = rollups.build(filename, results)
+                results = []
+            rollups.publish(filename, temp_dir, results)
+        _l.info(f'Summarized {n + len(results):,} results.')
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def _update_rollups(filename: str, result: Dict[str, Any]) -> None:
+    """Folds a just-appended result into the rollups, building them first if there are none."""
+    try:
+        if not rollups.exists(filename):
+            _build_rollups(filename)
+        else:
+            rollups.add(filename, result)
+    except Exception as e:
+        # The result is safely stored; the rollups can be rebuilt.
+        _l.error(f'Failed to update rollups of "{filename}".')
+        _l.exception(e)
+
+
+def _copy_from(fmt: str, filename: str, dst_filename: str, position: int,
+               start: Optional[float] = None) -> Tuple[int, int]:
+    if fmt == 'jsonl':
+        return jsonl_file.copy_from(filename, dst_filename, position, start)
+    elif fmt == 'col':
+        return columnar_file.copy_from(filename, dst_filename, position, start)
+    else:
+        return results_file.copy_from(filename, dst_filename, position, start)
+
+
+def _remove(filename: str, fmt: str) -> None:
+    for suffix in ('',) + _sidecars[fmt]:
+        try:
+            os.remove(filename + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def compact(filename: str, starts: Dict[str, Optional[float]]) -> Dict[str, int]:
+    """
+    Drops the history of a results file that's older than it should be kept at each resolution.
+    The results that are dropped remain in the rollups, which are built first if there are none.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the results file.
+    starts : Dict[str, Optional[float]]
+        Seconds since the epoch of the oldest data to keep, or None to keep all of it, by
+        resolution: "raw" for the results themselves, and the rollup `levels`. Missing resolutions
+        are kept whole.
+
+    Returns
+    -------
+    Dict[str, int]
+        The number of results ("raw") or rollup records dropped, by resolution.
+    """
+    fmt = _format(filename)
+    dropped = {level: 0 for level in starts.keys()}
+    if not os.path.exists(filename):
+        return dropped
+    if not rollups.exists(filename):
+        _build_rollups_unlocked(filename)
+    with _locked(filename):
+        for level in rollups.levels.keys():
+            start = starts.get(level)
+            if start is not None:
+                dropped[level] = rollups.trim(filename, level, start)
+        start = starts.get('raw')
+        if start is None:
+            return dropped
+        if fmt == 'json':
+            # It's rewritten on every append anyway.
+            results = _load_json(filename)
+            kept = [r for r in results if result_epoch_sec(r) >= start]
+            if len(kept) < len(results):
+                temp_filename = filename + '.tmp'
+                with open(temp_filename, 'w') as f:
+                    f.write(json.dumps(kept, sort_keys=True, indent=4))
+                os.replace(temp_filename, filename)
+            dropped['raw'] = len(results) - len(kept)
+            return dropped
+        inode = os.stat(filename).st_ino
+
+    temp_filename = filename + '.compact'
+    _remove(temp_filename, fmt)
+    try:
+        n, position = _copy_from(fmt, filename, temp_filename, 0, start)
+        if n == 0:
+            return dropped
+        with _locked(filename):
+            if os.stat(filename).st_ino != inode:
+                _l.warning(f'"{filename}" was replaced while it was being compacted; leaving it.')
+                return dropped
+            # Everything appended since is recent enough to keep.
+            _copy_from(fmt, filename, temp_filename, position)
+            # Readers (see `_shared`) wait for all of them, so the order doesn't matter.
+            for suffix in _sidecars[fmt] + ('',):
+                os.replace(temp_filename + suffix, filename + suffix)
+        dropped['raw'] = n
+        return dropped
+    finally:
+        _remove(temp_filename, fmt)
+
+
+def migrate_legacy(filename: str) -> None:
+    """
+    One-shot migration to JSON Lines: if `filename` is a `.jsonl` file that does not exist yet but
+    a `.json` file with the same base name does, the latter is converted. Both the collector and the
+    dashboard call this at startup, whichever comes first; only one of them migrates.
+    """
+    if _format(filename) != 'jsonl' or os.path.exists(filename):
+        return
+    legacy = os.path.splitext(filename)[0] + '.json'
+    if not os.path.exists(legacy):
+        return
+    with _locked(filename):
+        if os.path.exists(filename):
+            return  # Someone else just did.
+        _l.info(f'Migrating results from "{legacy}" to "{filename}"...')
+        n = jsonl_file.migrate(legacy, filename)
+    _l.info(f'Migrated {n:,} results. "{legacy}" can be deleted.')
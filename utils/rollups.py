@@ -0,0 +1,381 @@
+from typing import List, Dict, Any, Optional, Iterable, Tuple
+import logging
+import os
+import shutil
+import tempfile
+import urllib.parse
+
+import numpy
+
+import config
+from utils import sketch
+from utils.timestamps import result_epoch_sec
+
+
+_l = logging.getLogger(__name__)
+
+
+"""
+Rollup tables
+-------------
+
+Per-interface summaries of the results in fixed time buckets, so that long time ranges can be
+plotted without reading every result. They live in the directory `<results filename>.rollups`, one
+file per interface and level, named `<nickname, URL-quoted>.<level>`.
+
+Each file is an array of `record_dtype`, sorted by bucket start, one record per bucket that has
+tests. Buckets are aligned in UTC: hours, days, and weeks starting on Monday. Transfer rate sums,
+minimums and maximums only cover successful tests; `count` covers all of them, so e.g. the mean
+rate counting failures as 0 is `download_sum / count`. Each record also has a quantile sketch of
+each rate, so percentiles can be estimated over any set of buckets.
+
+`results_store.append` keeps the rollups up to date (building them from the results file the first
+time), updating the affected record in place or appending a new one. A torn last record is ignored
+by `load` and truncated by the next `add`.
+
+The rollups outlive the results they summarize: `results_store.compact` drops old results (and old
+records of the finer levels, see `trim`), and the rollups are then all that's left of them. So once
+a results file has been compacted, `rebuild` would lose that history.
+"""
+
+
+levels: Dict[str, int] = {'hourly': 60 * 60, 'daily': 24 * 60 * 60, 'weekly': 7 * 24 * 60 * 60}
+"""Bucket width in seconds, by level."""
+
+_origin: Dict[str, int] = {'weekly': 4 * 24 * 60 * 60}
+"""Where buckets are aligned to, in seconds since the epoch, if not 0. 1970-01-05 was a Monday."""
+
+_directions = ('download', 'upload')
+
+record_dtype = numpy.dtype([
+    ('start', '<i8'),  # seconds since the epoch
+    ('count', '<u4'),
+    ('failures', '<u4'),
+] + [(f'{d}_{stat}', '<f8') for d in _directions for stat in ('sum', 'sumsq')]
+  + [(f'{d}_{stat}', '<f4') for d in _directions for stat in ('min', 'max')]
+  + [(f'{d}_sketch', sketch.dtype, (sketch.n_bins,)) for d in _directions])
+"""Transfer rates are in Mbps. Sketches (see `sketch`) count failures as 0."""
+
+_version = 2
+"""Of `record_dtype`; stored in `<directory>/version`. Rollups of another version are rebuilt."""
+
+
+def directory(filename: str) -> str:
+    """Returns the rollups directory of results file `filename`."""
+    return filename + '.rollups'
+
+
+def _version_path(filename: str) -> str:
+    return os.path.join(directory(filename), 'version')
+
+
+def exists(filename: str) -> bool:
+    """Whether results file `filename` has rollups, of the current version."""
+    try:
+        with open(_version_path(filename), 'r') as f:
+            return f.read().strip() == str(_version)
+    except FileNotFoundError:
+        return False
+
+
+def _basename(nickname: str, level: str) -> str:
+    return f'{urllib.parse.quote(nickname, safe="")}.{level}'
+
+
+def _path(filename: str, nickname: str, level: str) -> str:
+    return os.path.join(directory(filename), _basename(nickname, level))
+
+
+def nicknames(filename: str) -> List[str]:
+    """Returns the nicknames of the interfaces that have rollups."""
+    if not exists(filename):
+        return []
+    names = set()
+    for entry in os.listdir(directory(filename)):
+        name, ext = os.path.splitext(entry)
+        if ext[1:] in levels:
+            names.add(urllib.parse.unquote(name))
+    return sorted(names)
+
+
+def bucket_start(t: numpy.ndarray, level: str) -> numpy.ndarray:
+    """Start of the bucket of each time `t` (seconds since the epoch)."""
+    width = levels[level]
+    origin = _origin.get(level, 0)
+    return (numpy.floor((numpy.asarray(t) - origin) / width).astype(numpy.int64) * width
+            + origin)
+
+
+_Measurements = Tuple[numpy.ndarray, List[str], numpy.ndarray, numpy.ndarray, numpy.ndarray]
+
+
+def _measurements(results: Iterable[Dict[str, Any]]) -> _Measurements:
+    """
+    Returns time (seconds since the epoch), nickname, success, and download and upload rates (Mbps)
+    of each result. Results that can't be read are left out.
+    """
+    rows = []
+    for result in results:
+        try:
+            success = result['returnCode'] == 0
+            if success:
+                output = result['output']
+                dn = float(output['download']['bandwidth']) * 8e-6
+                up = float(output['upload']['bandwidth']) * 8e-6
+            else:
+                dn = up = 0.0
+            rows.append((result_epoch_sec(result), str(result['nickname']), success, dn, up))
+        except (KeyError, TypeError, ValueError) as e:
+            _l.error(f'Leaving unreadable result out of rollups: {e!r}')
+    if not rows:
+        return (numpy.empty(0), [], numpy.empty(0, dtype=bool), numpy.empty(0), numpy.empty(0))
+    columns = list(zip(*rows))
+    return (numpy.array(columns[0]), list(columns[1]), numpy.array(columns[2], dtype=bool),
+            numpy.array(columns[3]), numpy.array(columns[4]))
+
+
+def _summarize(starts: numpy.ndarray, success: numpy.ndarray,
+               rates: Dict[str, numpy.ndarray]) -> numpy.ndarray:
+    """Builds the records for measurements that fall in buckets `starts`."""
+    order = numpy.argsort(starts, kind='stable')
+    starts, success = starts[order], success[order]
+    bucket, first = numpy.unique(starts, return_index=True)
+    idx = numpy.repeat(numpy.arange(len(bucket)), numpy.diff(numpy.append(first, len(starts))))
+    records = numpy.zeros(len(bucket), dtype=record_dtype)
+    records['start'] = bucket
+    records['count'] = numpy.bincount(idx, minlength=len(bucket))
+    records['failures'] = numpy.bincount(idx, weights=~success, minlength=len(bucket))
+    for d in _directions:
+        vals = numpy.where(success, rates[d][order], 0.0)
+        records[f'{d}_sum'] = numpy.bincount(idx, weights=vals, minlength=len(bucket))
+        records[f'{d}_sumsq'] = numpy.bincount(idx, weights=vals ** 2, minlength=len(bucket))
+        lo = numpy.where(success, vals, numpy.inf)
+        hi = numpy.where(success, vals, -numpy.inf)
+        mins = numpy.minimum.reduceat(lo, first)
+        maxs = numpy.maximum.reduceat(hi, first)
+        records[f'{d}_min'] = numpy.where(numpy.isinf(mins), numpy.nan, mins)
+        records[f'{d}_max'] = numpy.where(numpy.isinf(maxs), numpy.nan, maxs)
+        records[f'{d}_sketch'] = sketch.build(idx, vals, len(bucket))
+    return records
+
+
+def _merge(a: numpy.ndarray, b: numpy.ndarray) -> None:
+    """Adds the records in `b` into those in `a`, bucket for bucket."""
+    a['count'] += b['count']
+    a['failures'] += b['failures']
+    for d in _directions:
+        a[f'{d}_sum'] += b[f'{d}_sum']
+        a[f'{d}_sumsq'] += b[f'{d}_sumsq']
+        a[f'{d}_min'] = numpy.fmin(a[f'{d}_min'], b[f'{d}_min'])
+        a[f'{d}_max'] = numpy.fmax(a[f'{d}_max'], b[f'{d}_max'])
+        a[f'{d}_sketch'] = sketch.saturate(a[f'{d}_sketch'].astype(numpy.int64)
+                                           + b[f'{d}_sketch'])
+
+
+def _write(path: str, records: numpy.ndarray) -> None:
+    temp = path + '.tmp'
+    with open(temp, 'wb') as f:
+        f.write(records.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, path)
+
+
+def _add_record(path: str, record: numpy.ndarray) -> None:
+    """
+    Folds `record` (an array of one record) into the file at `path`, in place if it's one of the
+    latest buckets.
+    """
+    size = record_dtype.itemsize
+    # Results arrive nearly in order, so the bucket is one of the last few.
+    tail_records = int(config.max_disorder_sec // min(levels.values())) + 2
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        file_size = os.fstat(fd).st_size
+        n = file_size // size
+        if file_size != n * size:
+            _l.warning(f'Truncating torn last record of "{path}".')
+            os.ftruncate(fd, n * size)
+        first = max(0, n - tail_records)
+        tail = numpy.frombuffer(os.pread(fd, (n - first) * size, first * size),
+                                dtype=record_dtype).copy()
+        if n == 0 or record['start'][0] > tail['start'][-1]:
+            os.pwrite(fd, record.tobytes(), n * size)
+            return
+        match = numpy.flatnonzero(tail['start'] == record['start'][0])
+        if len(match):
+            i = int(match[0])
+            _merge(tail[i:i + 1], record)
+            os.pwrite(fd, tail[i:i + 1].tobytes(), (first + i) * size)
+            return
+    finally:
+        os.close(fd)
+    # An older bucket than expected; insert it and rewrite the file.
+    records = numpy.fromfile(path, dtype=record_dtype)
+    i = int(numpy.searchsorted(records['start'], record['start'][0]))
+    _write(path, numpy.insert(records, i, record))
+
+
+def _fold(path: str, result: Dict[str, Any]) -> None:
+    """Folds a result into the rollups in directory `path`."""
+    t, names, success, dn, up = _measurements([result])
+    if not names:
+        return
+    os.makedirs(path, exist_ok=True)
+    for level in levels.keys():
+        record = _summarize(bucket_start(t, level), success, {'download': dn, 'upload': up})
+        _add_record(os.path.join(path, _basename(names[0], level)), record)
+
+
+def add(filename: str, result: Dict[str, Any]) -> None:
+    """
+    Folds a new result into the rollups of results file `filename`. Callers must serialize calls
+    (`results_store.append` does).
+    """
+    _fold(directory(filename), result)
+
+
+def rebuild(filename: str, results: Iterable[Dict[str, Any]]) -> int:
+    """
+    Builds the rollups of results file `filename` from scratch.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the results file.
+    results : Iterable[Dict[str, Any]]
+        Every result in it.
+
+    Returns
+    -------
+    int
+        The number of results summarized.
+    """
+    temp_dir, n = build(filename, results)
+    publish(filename, temp_dir)
+    return n
+
+
+def build(filename: str, results: Iterable[Dict[str, Any]]) -> Tuple[str, int]:
+    """
+    Builds the rollups of results file `filename` from scratch, in a temporary directory next to
+    them, and leaves them there for `publish`, so that results can keep being appended meanwhile.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the results file.
+    results : Iterable[Dict[str, Any]]
+        Every result in it so far.
+
+    Returns
+    -------
+    Tuple[str, int]
+        The temporary directory, and the number of results summarized.
+    """
+    t, names, success, dn, up = _measurements(results)
+    temp_dir = tempfile.mkdtemp(prefix=os.path.basename(directory(filename)) + '.',
+                                dir=os.path.dirname(os.path.abspath(filename)))
+    os.chmod(temp_dir, 0o755)  # Not just for us: the dashboard may run as another user.
+    name_arr = numpy.array(names, dtype=object)
+    for nickname in sorted(set(names)):
+        mine = name_arr == nickname
+        for level in levels.keys():
+            records = _summarize(bucket_start(t[mine], level), success[mine],
+                                 {'download': dn[mine], 'upload': up[mine]})
+            path = os.path.join(temp_dir, _basename(nickname, level))
+            _write(path, records)
+    return temp_dir, len(names)
+
+
+def publish(filename: str, temp_dir: str, results: Iterable[Dict[str, Any]] = ()) -> None:
+    """
+    Replaces the rollups of results file `filename` with those that `build` left in `temp_dir`,
+    after folding into them `results`: those appended since they were built. Callers must serialize
+    this with `add` (`results_store.compact` does).
+    """
+    for result in results:
+        _fold(temp_dir, result)
+    with open(os.path.join(temp_dir, 'version'), 'w') as f:
+        f.write(f'{_version}\n')
+    # Readers don't lock the rollups, so there mustn't be a moment without them: move the old ones
+    # aside rather than deleting them first.
+    old_dir = temp_dir + '.old'
+    try:
+        os.replace(directory(filename), old_dir)
+    except FileNotFoundError:
+        pass
+    os.replace(temp_dir, directory(filename))
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def trim(filename: str, level: str, start: float) -> int:
+    """
+    Drops the records of every interface at one level that end before `start` (seconds since the
+    epoch). Callers must serialize this with `add` (`results_store.compact` does).
+
+    Returns
+    -------
+    int
+        The number of records dropped.
+    """
+    n_dropped = 0
+    first = int(bucket_start(numpy.array(start), level))
+    for nickname in nicknames(filename):
+        path = _path(filename, nickname, level)
+        if not os.path.exists(path):
+            continue
+        records = numpy.fromfile(path, dtype=record_dtype)
+        keep = int(numpy.searchsorted(records['start'], first))
+        if keep:
+            _write(path, records[keep:])
+            n_dropped += keep
+    return n_dropped
+
+
+def first_start(filename: str, nickname: str, level: str) -> Optional[int]:
+    """Start of the oldest bucket of one interface at one level, or None if it has none."""
+    try:
+        with open(_path(filename, nickname, level), 'rb') as f:
+            data = f.read(record_dtype.itemsize)
+    except FileNotFoundError:
+        return None
+    if len(data) < record_dtype.itemsize:
+        return None
+    return int(numpy.frombuffer(data, dtype=record_dtype)['start'][0])
+
+
+def load(filename: str, nickname: str, level: str,
+         start: Optional[float] = None, end: Optional[float] = None) -> numpy.ndarray:
+    """
+    Loads the records of one interface at one level.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the results file.
+    nickname : str
+        Which interface.
+    level : str
+        One of `levels`.
+    start : Optional[float]
+        Seconds since the epoch; buckets that end before this are left out. None for no limit.
+    end : Optional[float]
+        Seconds since the epoch; buckets that start at or after this are left out. None for no
+        limit.
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of `record_dtype`, oldest first; empty if there are no rollups.
+    """
+    path = _path(filename, nickname, level)
+    if not os.path.exists(path):
+        return numpy.empty(0, dtype=record_dtype)
+    with open(path, 'rb') as f:
+        data = f.read()
+    n = len(data) // record_dtype.itemsize
+    records = numpy.frombuffer(data[:n * record_dtype.itemsize], dtype=record_dtype)
+    lo = 0 if start is None else numpy.searchsorted(records['start'], start - levels[level] + 1)
+    hi = n if end is None else numpy.searchsorted(records['start'], end)
+    return records[lo:hi]
@@ -0,0 +1,106 @@
+from typing import Sequence, Dict
+import math
+
+import numpy
+
+
+"""
+Quantile sketches
+-----------------
+
+A sketch is a histogram of transfer rates over logarithmically spaced bins, so any quantile it
+reports is within `relative_accuracy` of a true value (as in DDSketch). Sketches have a fixed size
+and are merged by adding them, which makes them easy to store in fixed-width records (see
+`rollups`) and to combine for any set of buckets.
+
+Bin 0 holds values below `min_value`, including the 0 recorded for failed tests, and reports them as
+0. Values above `max_value` go in the last bin.
+"""
+
+
+relative_accuracy = 0.05
+min_value = 0.1
+"""Mbps"""
+max_value = 100_000
+"""Mbps"""
+
+_gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+n_bins = 2 + math.ceil(math.log(max_value / min_value, _gamma))
+
+dtype = numpy.dtype('<u2')
+"""Bin counts saturate rather than overflow."""
+
+_max_count = numpy.iinfo(dtype).max
+
+
+def bins(values: numpy.ndarray) -> numpy.ndarray:
+    """Returns the bin of each value."""
+    values = numpy.asarray(values, dtype=numpy.float64)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        idx = 1 + numpy.floor(numpy.log(values / min_value) / math.log(_gamma))
+    idx = numpy.where(values < min_value, 0, numpy.clip(idx, 1, n_bins - 1))
+    return idx.astype(numpy.int64)
+
+
+def build(group: numpy.ndarray, values: numpy.ndarray, n_groups: int) -> numpy.ndarray:
+    """
+    Builds a sketch of the values in each group.
+
+    Parameters
+    ----------
+    group : numpy.ndarray
+        Group of each value, in `range(n_groups)`.
+    values : numpy.ndarray
+        The values.
+    n_groups : int
+        Number of groups.
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape `(n_groups, n_bins)`.
+    """
+    counts = numpy.bincount(numpy.asarray(group, dtype=numpy.int64) * n_bins + bins(values),
+                            minlength=n_groups * n_bins)
+    return saturate(counts.reshape(n_groups, n_bins))
+
+
+def saturate(counts: numpy.ndarray) -> numpy.ndarray:
+    """Converts (summed) bin counts to `dtype`."""
+    return numpy.minimum(counts, _max_count).astype(dtype)
+
+
+def merge(group: numpy.ndarray, sketches: numpy.ndarray, n_groups: int) -> numpy.ndarray:
+    """Merges `sketches` (shape `(n, n_bins)`) by group, as `build` does for values."""
+    merged = numpy.zeros((n_groups, n_bins), dtype=numpy.int64)
+    numpy.add.at(merged, numpy.asarray(group, dtype=numpy.int64), sketches)
+    return saturate(merged)
+
+
+def quantiles(sketches: numpy.ndarray, percentiles: Sequence[float]) -> Dict[float, numpy.ndarray]:
+    """
+    Estimates percentiles from sketches.
+
+    Parameters
+    ----------
+    sketches : numpy.ndarray
+        Array of shape `(..., n_bins)`.
+    percentiles : Sequence[float]
+        Which percentiles.
+
+    Returns
+    -------
+    Dict[float, numpy.ndarray]
+        Each percentile, of shape `sketches.shape[:-1]`; NaN for empty sketches.
+    """
+    cum = numpy.cumsum(sketches, axis=-1, dtype=numpy.int64)
+    total = cum[..., -1]
+    # Each bin reports the value with the same relative error to both of its edges.
+    upper = min_value * _gamma ** numpy.arange(n_bins)
+    value = numpy.concatenate(([0.0], upper[:-1] * 2 * _gamma / (1 + _gamma)))
+    result: Dict[float, numpy.ndarray] = {}
+    for q in percentiles:
+        rank = numpy.floor((total - 1) * (q / 100))
+        idx = numpy.minimum(numpy.sum(cum <= rank[..., numpy.newaxis], axis=-1), n_bins - 1)
+        result[q] = numpy.where(total > 0, value[idx], numpy.nan)
+    return result
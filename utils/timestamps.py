@@ -0,0 +1,13 @@
+from typing import Dict, Any
+
+import dateutil.parser
+
+
+def to_epoch_sec(iso: str) -> float:
+    """Converts a result timestamp, e.g. "2024-08-12T17:03:41.52Z", to seconds since the epoch."""
+    return dateutil.parser.isoparse(iso).timestamp()
+
+
+def result_epoch_sec(result: Dict[str, Any]) -> float:
+    """Returns the timestamp of a result in seconds since the epoch."""
+    return to_epoch_sec(result['timestamp'])